@@ -1,22 +1,149 @@
 import os
 import json
+import atexit
+import functools
 import random
 import time
 import threading
 import datetime
 import hashlib
-import requests
-from flask import Flask, jsonify, request, session, render_template
+import hmac
+import math
+import click
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, jsonify, request, session, render_template, stream_with_context
+
+import economy
+import httpcache
+import metrics
+import traffic
+from events import EventBus, stream_events
+from gamedata import BONECRAFT_RECIPES, BOT_LISTABLE_ITEMS, BOT_NAMES, REFERENCE_PRICES
+from history import PriceHistory, Rollups, RESOLUTIONS, candle_dict
+from ledger import Ledger, delta, read_events, replay
+from leaderboard import Leaderboard
+from market import AuctionCompactor, MarketCache, InvalidCursor, SORT_ORDERS, TIME_FORMAT, is_expired
+from players import PlayerStateCache
+from storage import (
+    call_origin, create_backend, generate_push_id, increment, set_call_origin,
+    LeaderLease, TransactionAborted, TransactionConflict,
+)
 
 # ==========================================
 # CONFIGURATION & DATA
 # ==========================================
 
 # !!! IMPORTANT !!!
-# PASTE YOUR FIREBASE REALTIME DATABASE URL HERE
-FIREBASE_DB_URL = "https://bonecraftsim-default-rtdb.firebaseio.com/" 
+# PASTE YOUR FIREBASE REALTIME DATABASE URL HERE (or set FIREBASE_DB_URL)
+FIREBASE_DB_URL = os.environ.get("FIREBASE_DB_URL", "https://bonecraftsim-default-rtdb.firebaseio.com/")
 # -----------------
 
+# Storage engine: "firebase" (REST, default) or "local" (embedded SQLite, no network)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firebase")
+LOCAL_DB_PATH = os.environ.get("LOCAL_DB_PATH", "bonecraft_local.db")
+
+# Firebase HTTP client: shared keep-alive pool, per-call timeout (seconds), GET retries
+FIREBASE_POOL_SIZE = int(os.environ.get("FIREBASE_POOL_SIZE", "20"))
+FIREBASE_TIMEOUT = float(os.environ.get("FIREBASE_TIMEOUT", "5"))
+FIREBASE_READ_RETRIES = int(os.environ.get("FIREBASE_READ_RETRIES", "2"))
+
+# Seconds a cached /auction_house copy is trusted when the backend has no change log
+MARKET_CACHE_TTL = float(os.environ.get("MARKET_CACHE_TTL", "5"))
+
+# Leaderboard: rows returned, and seconds the cached /leaderboard projection is trusted
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", "100"))
+LEADERBOARD_CACHE_TTL = float(os.environ.get("LEADERBOARD_CACHE_TTL", "10"))
+
+# Player write-behind: max seconds a mutation may live only in memory, and how long
+# a clean cached player is trusted before it's re-read
+PLAYER_MAX_DIRTY_AGE = float(os.environ.get("PLAYER_MAX_DIRTY_AGE", "5"))
+PLAYER_CACHE_TTL = float(os.environ.get("PLAYER_CACHE_TTL", "30"))
+
+# Server-sent events: watcher poll interval for other workers' writes, heartbeat
+# and maximum stream length in seconds (clients reconnect with Last-Event-ID)
+EVENTS_POLL_INTERVAL = float(os.environ.get("EVENTS_POLL_INTERVAL", "2"))
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", "15"))
+EVENTS_MAX_STREAM = float(os.environ.get("EVENTS_MAX_STREAM", "300"))
+
+# Open event streams per worker. Each one holds a worker thread for its whole life,
+# so keep this well below the thread count (GUNICORN_THREADS, 32 in the Procfile);
+# clients turned away with 503 poll instead
+EVENTS_MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", "8"))
+
+# Price history: seconds before other workers' sales are pulled in, and how many days
+# of /trades are folded into candles at startup
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", "5"))
+HISTORY_WARM_DAYS = float(os.environ.get("HISTORY_WARM_DAYS", "7"))
+
+# Bots price from the average sale price over this many seconds, blended with the
+# static reference value at this weight (see economy.HistoryPricing)
+BOT_PRICE_WINDOW = float(os.environ.get("BOT_PRICE_WINDOW", "3600"))
+BOT_HISTORY_WEIGHT = float(os.environ.get("BOT_HISTORY_WEIGHT", "0.5"))
+
+# Listing expiry: hours a player / bot listing stays up before its items go back to
+# the seller. Compaction archives expired listings (once they're `COMPACTION_GRACE`
+# seconds past expiry, so no purchase can still be claiming them) and /trades older
+# than TRADES_RETENTION_DAYS, every COMPACTION_INTERVAL seconds, on one worker only.
+LISTING_TTL_HOURS = float(os.environ.get("LISTING_TTL_HOURS", "24"))
+BOT_LISTING_TTL_HOURS = float(os.environ.get("BOT_LISTING_TTL_HOURS", "6"))
+COMPACTION_ENABLED = os.environ.get("COMPACTION_ENABLED", "1") == "1"
+COMPACTION_INTERVAL = float(os.environ.get("COMPACTION_INTERVAL", "60"))
+COMPACTION_GRACE = float(os.environ.get("COMPACTION_GRACE", "300"))
+TRADES_RETENTION_DAYS = max(float(os.environ.get("TRADES_RETENTION_DAYS", "30")), HISTORY_WARM_DAYS)
+
+# Bot economy: whether this worker may lead it at all, seconds between ticks of each
+# bot agent (+/- jitter), number of agents, and the leader lease length. Only the
+# worker holding the lease ticks bots, however many gunicorn workers there are.
+ECONOMY_ENABLED = os.environ.get("ECONOMY_ENABLED", "1") == "1"
+ECONOMY_TICK_INTERVAL = float(os.environ.get("ECONOMY_TICK_INTERVAL", "4.5"))
+ECONOMY_TICK_JITTER = float(os.environ.get("ECONOMY_TICK_JITTER", "1.5"))
+ECONOMY_AGENTS = int(os.environ.get("ECONOMY_AGENTS", "1"))
+ECONOMY_LEASE_TTL = float(os.environ.get("ECONOMY_LEASE_TTL", "15"))
+
+# Sampled profiling: fraction of requests run under cProfile, and the duration (ms)
+# above which a sampled request's profile is printed (and saved to PROFILE_DIR if set)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "500"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+# Token for /api/admin/* (X-Admin-Token header); admin routes are off when unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Page sizes for /api/ah/market, and default candles per /api/ah/history response
+MARKET_PAGE_DEFAULT = 50
+MARKET_PAGE_MAX = 200
+HISTORY_PAGE_DEFAULT = 120
+
+# Bulk trading: most lines per /api/ah/list_many request or listings bought by one
+# /api/ah/buy_many, and how many listing claims a sweep runs in parallel
+BULK_MAX_LINES = int(os.environ.get("BULK_MAX_LINES", "50"))
+SWEEP_CLAIM_WORKERS = int(os.environ.get("SWEEP_CLAIM_WORKERS", "8"))
+
+# Sale settlement (seller credit, trade record): attempts inside the purchase request,
+# then seconds between retries of the ones still queued
+SETTLE_ATTEMPTS = int(os.environ.get("SETTLE_ATTEMPTS", "3"))
+SETTLE_RETRY_INTERVAL = float(os.environ.get("SETTLE_RETRY_INTERVAL", "5"))
+
+# Event ledger: events per segment write, most seconds an event waits in memory, and
+# seconds between snapshots (taken by one worker, see LEDGER_SNAPSHOT_LAG)
+LEDGER_BATCH_SIZE = int(os.environ.get("LEDGER_BATCH_SIZE", "500"))
+LEDGER_FLUSH_INTERVAL = float(os.environ.get("LEDGER_FLUSH_INTERVAL", "2"))
+LEDGER_SNAPSHOT_INTERVAL = float(os.environ.get("LEDGER_SNAPSHOT_INTERVAL", "600"))
+LEDGER_SNAPSHOT_LAG = float(os.environ.get("LEDGER_SNAPSHOT_LAG", "60"))
+
+# Serialized market / leaderboard bodies kept per data version: how many, and the most
+# seconds one is reused (listings also drop out of the market as they expire)
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_MAX_AGE = float(os.environ.get("RESPONSE_CACHE_MAX_AGE", "30"))
+
+# Traffic recording for benchmarks/replay.py: API requests and the RNG seeds behind
+# synth rolls and bot ticks are logged to this file (gzipped if it ends in .gz;
+# "{worker}" becomes the process id, so gunicorn workers write separate files).
+# Off when unset.
+TRAFFIC_RECORD_PATH = os.environ.get("TRAFFIC_RECORD_PATH")
+# Sessions whose call numbering a worker keeps; the least recently seen are forgotten
+TRAFFIC_MAX_SESSIONS = int(os.environ.get("TRAFFIC_MAX_SESSIONS", "10000"))
+
 # Flask Setup
 app = Flask(__name__)
 # Set a secret key for session management (CHANGE THIS!)
@@ -26,68 +153,81 @@ app.config['SESSION_COOKIE_SECURE'] = True        # Must be True for production/
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'    # Allows cookies to be sent cross-site (required for iFrames)
 app.config['SESSION_COOKIE_DOMAIN'] = None
 
-# Comprehensive Bonecraft recipes (Same as original)
-BONECRAFT_RECIPES = [
-    # Tier 5 (Amateur - Skill 1-10)
-    {"name": "Bone Hairpin", "price": 100, "tier": 5, "material": "Bone Chip", "qty": 1},
-    {"name": "Shell Ring", "price": 200, "tier": 5, "material": "Seashell", "qty": 1},
-    
-    # Tier 4 (Recruit - Skill 11-20)
-    {"name": "Gelatin", "price": 300, "tier": 4, "material": "Chicken Bone", "qty": 2},
-    {"name": "Bone Ring", "price": 450, "tier": 4, "material": "Sheep Tooth", "qty": 1},
-    {"name": "Bone Mask", "price": 600, "tier": 4, "material": "Giant Femur", "qty": 1},
-    {"name": "Carapace Powder", "price": 800, "tier": 4, "material": "Beetle Shell", "qty": 2},
-    
-    # Tier 3 (Initiate/Novice - Skill 21-40)
-    {"name": "Beetle Ring", "price": 1200, "tier": 3, "material": "Beetle Jaw", "qty": 1},
-    {"name": "Beetle Earring", "price": 1500, "tier": 3, "material": "Beetle Jaw", "qty": 1},
-    {"name": "Horn Ring", "price": 2500, "tier": 3, "material": "Ram Horn", "qty": 1},
-    {"name": "Turtle Shield", "price": 5000, "tier": 3, "material": "Turtle Shell", "qty": 1},
-    
-    # Tier 2 (Apprentice/Journeyman - Skill 41-60)
-    {"name": "Carapace Helm", "price": 8500, "tier": 2, "material": "Turtle Shell", "qty": 2},
-    {"name": "Scorpion Ring", "price": 15000, "tier": 2, "material": "Scorpion Shell", "qty": 1},
-    
-    # Tier 1 (Craftsman/Artisan - Skill 61-80)
-    {"name": "Demon's Ring", "price": 30000, "tier": 1, "material": "Demon Horn", "qty": 1},
-    {"name": "Tigerfang", "price": 45000, "tier": 1, "material": "Black Tiger Fang", "qty": 2},
-    {"name": "Coral Gorget", "price": 60000, "tier": 1, "material": "Coral Fragment", "qty": 3},
+# Recipe lookup by name (instead of scanning BONECRAFT_RECIPES per request)
+RECIPES_BY_NAME = {r["name"]: r for r in BONECRAFT_RECIPES}
+
+# Game data that never changes at runtime, served once per client from /api/game/static.
+# The version is a hash of the content, so a new deploy gets a new URL.
+STATIC_PAYLOAD = httpcache.Payload.of({
+    "recipes": BONECRAFT_RECIPES,
+    "prices": REFERENCE_PRICES,
+    "materials": BOT_LISTABLE_ITEMS,
+})
+STATIC_VERSION = STATIC_PAYLOAD.hash[:12]
 
-    # Tier 0 (Adept/Veteran - Skill 81-100+)
-    {"name": "Dragon Mask", "price": 120000, "tier": 0, "material": "Wyvern Scales", "qty": 2},
-    {"name": "Trumpet Ring", "price": 500000, "tier": 0, "material": "Titanictus Shell", "qty": 1},
-    {"name": "Chronos Tooth", "price": 800000, "tier": 0, "material": "Titanictus Shell", "qty": 1},
-    {"name": "Gavial Mask", "price": 1000000, "tier": 0, "material": "Gavial Fish", "qty": 1},
-]
+# Synthesis odds per tier on a 1-100 roll: roll <= break_max breaks, roll > hq_min is HQ
+SYNTH_THRESHOLDS = {5: (10, 40), 4: (15, 50), 3: (20, 60), 2: (25, 70), 1: (30, 80), 0: (35, 90)}
+SYNTH_OUTCOMES = ("BREAK", "NQ", "HQ")
+# Precomputed per tier: outcome for every roll, and cumulative weights for batch rolls
+SYNTH_ROLL_TABLE = {
+    tier: [None] + ["BREAK" if roll <= b else ("HQ" if roll > h else "NQ") for roll in range(1, 101)]
+    for tier, (b, h) in SYNTH_THRESHOLDS.items()
+}
+SYNTH_CUM_WEIGHTS = {tier: (b, h, 100) for tier, (b, h) in SYNTH_THRESHOLDS.items()}
 
-# All primary materials used in the recipes, available for bot listing/purchase
-BOT_LISTABLE_ITEMS = [
-    "Bone Chip", "Seashell", "Chicken Bone", "Sheep Tooth", "Giant Femur", 
-    "Beetle Shell", "Beetle Jaw", "Ram Horn", "Turtle Shell", "Scorpion Shell", 
-    "Demon Horn", "Black Tiger Fang", "Coral Fragment", "Wyvern Scales", 
-    "Titanictus Shell", "Gavial Fish"
-]
+MAX_BATCH_SYNTHS = int(os.environ.get("MAX_BATCH_SYNTHS", "1000"))
 
-BOT_NAMES = ["SephirothXX", "VanaFan99", "CrafterMain", "GilBuyer", "ChocoRacer"]
+
+def synth_tier(recipe):
+    # Unknown tiers use the hardest (tier 0) odds
+    return recipe["tier"] if recipe["tier"] in SYNTH_THRESHOLDS else 0
+
+def synth_cost(recipe):
+    return int(recipe["price"] * 0.1)
+
+def hq_item_name(recipe):
+    return f"HQ {recipe['name']} (+1)"
+
+def roll_synths(recipe, count, rng=random):
+    """Resolve `count` synths in one pass; returns {"BREAK": n, "NQ": n, "HQ": n}."""
+    outcomes = rng.choices(SYNTH_OUTCOMES, cum_weights=SYNTH_CUM_WEIGHTS[synth_tier(recipe)], k=count)
+    return {outcome: outcomes.count(outcome) for outcome in SYNTH_OUTCOMES}
 
 
 # ==========================================
 # CLOUD AUTHENTICATION & DATABASE ENGINE
-# (Integrated into Flask, uses direct Firebase calls)
+# (Integrated into Flask, talks to a pluggable StorageBackend)
 # ==========================================
 
 class CloudAuthServer:
-    def __init__(self, base_url):
-        self.base_url = base_url.rstrip('/')
+    def __init__(self, storage, market_ttl=5.0, leaderboard_ttl=10.0, on_event=None,
+                 player_max_dirty_age=5.0, player_ttl=30.0, history_ttl=5.0, history_warm_days=7,
+                 listing_ttl=86400.0, bot_listing_ttl=21600.0, claim_workers=8, settle_attempts=3,
+                 ledger_batch=500, ledger_flush_interval=2.0, ledger_snapshot_lag=60.0):
+        self.storage = storage
+        self.ledger = Ledger(storage, batch_size=ledger_batch, flush_interval=ledger_flush_interval,
+                             snapshot_lag=ledger_snapshot_lag)
+        self._claims = ThreadPoolExecutor(max_workers=claim_workers, thread_name_prefix="claim")
+        self.settle_attempts = settle_attempts
+        self._unsettled_lock = threading.Lock()
+        self._unsettled = []        # (multi-path update, marker, seller credits) still to write
+        self.listing_ttl = listing_ttl
+        self.bot_listing_ttl = bot_listing_ttl
+        self.market = MarketCache(storage, ttl=market_ttl, on_event=on_event)
+        self.history = PriceHistory(storage, ttl=history_ttl, warm_days=history_warm_days)
+        self.leaderboard = Leaderboard(storage, ttl=leaderboard_ttl, excluded=BOT_NAMES, on_event=on_event)
+        self.players = PlayerStateCache(
+            self.fetch_player_data, self.sync_user_data,
+            max_dirty_age=player_max_dirty_age, clean_ttl=player_ttl,
+        )
 
     def hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
 
     def register(self, username, password):
-        check_url = f"{self.base_url}/users/{username}.json"
+        user_path = f"users/{username}"
         try:
-            resp = requests.get(check_url)
-            if resp.json() is not None:
+            if self.storage.get(user_path) is not None:
                 return False, "Username already taken."
         except Exception:
             return False, "Connection failed."
@@ -103,16 +243,18 @@ class CloudAuthServer:
         }
         
         try:
-            requests.put(check_url, json=user_profile)
+            self.storage.put(user_path, user_profile)
+            self.ledger.record("register", deltas={username: delta(
+                gil=user_profile["data"]["gil"], items=user_profile["data"]["inventory"],
+            )}, player=username)
+            self.leaderboard.update(username, gil=user_profile["data"]["gil"], synths=0)
             return True, "Account created! Login to play."
         except Exception as e:
             return False, f"Cloud Error: {e}"
 
     def login(self, username, password):
-        url = f"{self.base_url}/users/{username}.json"
         try:
-            resp = requests.get(url)
-            user_data = resp.json()
+            user_data = self.storage.get(f"users/{username}")
             
             if not user_data:
                 return False, None, "User not found."
@@ -125,158 +267,648 @@ class CloudAuthServer:
         except Exception:
             return False, None, "Network error during login."
 
-    def sync_user_data(self, username, data):
-        url = f"{self.base_url}/users/{username}/data.json"
-        data['last_active'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def fetch_player_data(self, username):
+        return self.storage.get(f"users/{username}/data")
+
+    def sync_user_data(self, username, player):
+        """Write a player's unflushed changes and the matching leaderboard increments
+        in one multi-path update. Called by the write-behind flusher; raises on
+        network errors. Nothing is read back: the cache reloads a player once it
+        has been clean for its TTL."""
+        data_path = f"users/{username}/data"
+        updates = {f"{data_path}/{key}": value for key, value in player.pending_fields().items()}
+        updates[f"{data_path}/last_active"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        updates.update(self.leaderboard.stage(username, gil=player.pending_leaderboard_gil(), synths=player.pending_synths()))
+        self.storage.patch("", updates)
+
+    def take_items(self, username, wanted, player=None, gil=0):
+        """Take {item: qty}, and `gil`, out of the player's stored data with one
+        compare-and-set, checked against the stored values plus `player`'s unflushed
+        changes, so the same items or gil can't be spent twice from two workers'
+        caches. Raises TransactionAborted when something is short."""
+        def take(data):
+            if not data:
+                raise TransactionAborted("Player not found.")
+            data = dict(data)
+            if gil and data.get("gil", 0) + (player.pending_gil() if player else 0) < gil:
+                raise TransactionAborted("Not enough Gil.")
+            inventory = dict(data.get("inventory") or {})
+            for item_name, qty in wanted.items():
+                pending = player.pending_item(item_name) if player else 0
+                if inventory.get(item_name, 0) + pending < qty:
+                    raise TransactionAborted("You don't have enough of this item.")
+                inventory[item_name] = inventory.get(item_name, 0) - qty
+            data["gil"] = data.get("gil", 0) - gil
+            data["inventory"] = inventory
+            return data
+
+        self.storage.transaction(f"users/{username}/data", take)
+        if player:
+            for item_name, qty in wanted.items():
+                player.mirror_item(item_name, -qty)
+            if gil:
+                player.mirror_gil(-gil, leaderboard=True)
+
+    def return_items(self, username, taken, player=None):
+        """Undo take_items() after the write it was for failed."""
         try:
-            requests.patch(url, json=data)
-            return True
+            self.storage.patch(f"users/{username}/data/inventory", {
+                item_name: increment(qty) for item_name, qty in taken.items()
+            })
         except Exception as e:
-            print(f"Failed to sync: {e}")
-            return False
+            print(f"Item refund failed for {username} ({taken}): {e}")
+            metrics.ERRORS.inc("list_refund")
+            return
+        if player:
+            for item_name, qty in taken.items():
+                player.mirror_item(item_name, qty)
             
     # --- AH Methods ---
-    def list_item_to_cloud(self, item_name, price, seller_name, qty=1):
-        url = f"{self.base_url}/auction_house.json"
-        listing = {
+    def new_listing(self, item_name, price, seller_name, qty=1):
+        ttl = self.bot_listing_ttl if seller_name in BOT_NAMES else self.listing_ttl
+        now = int(time.time())
+        return {
             "item": item_name,
             "price": price, 
             "seller": seller_name,
             "qty": qty, 
-            "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "time": datetime.datetime.fromtimestamp(now).strftime(TIME_FORMAT),     # display / older readers
+            "ts": now,
+            "expires": now + int(ttl),
         }
+
+    def list_item_to_cloud(self, item_name, price, seller_name, qty=1, seller=None):
+        """Take the items from a player seller's stored inventory (take_items; bots list
+        from thin air), then post the listing. Raises TransactionAborted if the seller
+        doesn't have the items; returns (None, None) if the write failed."""
+        listing = self.new_listing(item_name, price, seller_name, qty)
+        taken = {} if seller_name in BOT_NAMES else {item_name: qty}
+        if taken:
+            try:
+                self.take_items(seller_name, taken, seller)
+            except (TransactionAborted, TransactionConflict):
+                raise
+            except Exception as e:
+                print(f"Cloud List Error: {e}")
+                metrics.ERRORS.inc("list")
+                return None, None
         try:
-            resp = requests.post(url, json=listing)
-            return resp.json().get('name'), listing
+            listing_id = self.storage.post("auction_house", listing)
+            self.market.add(listing_id, listing)
+            self.record_listing(listing_id, listing)
+            metrics.LISTINGS_CREATED.inc("bot" if seller_name in BOT_NAMES else "player")
+            return listing_id, listing
         except Exception as e:
             print(f"Cloud List Error: {e}")
+            metrics.ERRORS.inc("list")
+            if taken:
+                self.return_items(seller_name, taken, seller)
             return None, None
 
-    def buy_item_from_cloud(self, listing_id, buyer_name):
-        listing_url = f"{self.base_url}/auction_house/{listing_id}.json"
-        try:
-            resp = requests.get(listing_url)
-            listing = resp.json()
+    def buy_item_from_cloud(self, listing_id, buyer_name, buyer=None):
+        """Buy a listing with conditional writes so it can only ever be sold once.
 
+        1. Debit the buyer with a compare-and-set on their gil (funds checked
+           against stored gil plus `buyer`'s unflushed changes). Bots pay nothing.
+        2. Claim the listing by deleting it only if it is unchanged since read
+           (claim_listing). Losing that race, or a claim that can't be resolved,
+           refunds the buyer through settle().
+        3. Settle in one multi-path update: the seller's credit (a server-side
+           increment, no lost updates), both leaderboard entries and the trade.
+           Once the listing is claimed the purchase stands: the settle is retried
+           and, failing that, queued (see settle()); the item goes to the buyer
+           through the player cache either way.
+
+        The listing and the buyer's gil are read together, concurrently.
+        """
+        listing_path = f"auction_house/{listing_id}"
+        gil_path = f"users/{buyer_name}/data/gil"
+        buyer_kind = "bot" if buyer_name in BOT_NAMES else "player"
+        charged = buyer_name not in BOT_NAMES
+        try:
+            if charged:
+                (listing, listing_etag), gil_read = self.storage.gather(
+                    ("get_with_etag", listing_path), ("get_with_etag", gil_path),
+                )
+            else:
+                listing, listing_etag = self.storage.get_with_etag(listing_path)
             if not listing:
+                self.market.remove(listing_id)
+                metrics.PURCHASES.inc(buyer_kind, "sold_out")
                 return False, "Item already sold.", None
+            if is_expired(listing):
+                metrics.PURCHASES.inc(buyer_kind, "expired")
+                return False, "Listing has expired.", None
+            price = listing['price']
 
-            # 2. Delete the item from the auction house
-            requests.delete(listing_url)
-
-            # 3. Update the seller's Gil (unless it's a bot)
-            if listing['seller'] != buyer_name and listing['seller'] not in BOT_NAMES:
-                seller_url = f"{self.base_url}/users/{listing['seller']}/data/gil.json"
-                
-                gil_resp = requests.get(seller_url)
-                seller_gil = gil_resp.json() or 0
-                new_gil = seller_gil + listing['price']
-                
-                requests.put(seller_url, json=new_gil)
-            
+            # 1. Debit the buyer
+            if charged:
+                pending = buyer.pending_gil() if buyer else 0
+
+                def debit(gil):
+                    if (gil or 0) + pending < price:
+                        raise TransactionAborted("Insufficient Gil.")
+                    return (gil or 0) - price
+
+                self.storage.transaction(gil_path, debit, current=gil_read)
+
+            # 2. Claim the listing; from here on the debit is only undone through settle()
+            try:
+                claimed, listing_now = self.claim_listing(listing_path, listing_etag, price)
+            except Exception as e:
+                print(f"Cloud Buy Error: {e}")
+                if charged:
+                    self.settle({gil_path: increment(price)})
+                metrics.PURCHASES.inc(buyer_kind, "error")
+                return False, "Network error during purchase.", None
+            if not claimed:
+                if charged:
+                    self.settle({gil_path: increment(price)})
+                if not listing_now:
+                    self.market.remove(listing_id)
+                metrics.PURCHASES.inc(buyer_kind, "sold_out")
+                return False, "Item already sold.", None
+            self.market.remove(listing_id)
+            if charged and buyer:
+                buyer.mirror_gil(-price)
+
+            # 3. Settle: seller credit (unless it's a bot or the buyer themselves),
+            #    leaderboard and the trade for price history
+            seller = listing['seller']
+            credit_seller = seller != buyer_name and seller not in BOT_NAMES
+            trade_key, trade = generate_push_id(), self.history.new_trade(listing)
+            updates = {f"{self.history.collection}/{trade_key}": trade}
+            if charged:
+                updates.update(self.leaderboard.stage_gil(buyer_name, -price))
+            if credit_seller:
+                updates[f"users/{seller}/data/gil"] = increment(price)
+                updates.update(self.leaderboard.stage_gil(seller, price))
+            self.settle(updates, f"{self.history.collection}/{trade_key}", {seller: price} if credit_seller else {})
+            self.history.add(trade_key, trade)
+            self.record_sale(listing_id, listing, buyer_name, charged, credit_seller)
+
+            metrics.PURCHASES.inc(buyer_kind, "ok")
             return True, "Purchase successful.", listing
 
+        except TransactionAborted as e:
+            metrics.PURCHASES.inc(buyer_kind, "insufficient_funds")
+            return False, f"Transaction failed: {e}", None
+        except TransactionConflict:
+            metrics.PURCHASES.inc(buyer_kind, "conflict")
+            return False, "Auction house busy, please retry.", None
         except Exception as e:
             print(f"Cloud Buy Error: {e}")
+            metrics.PURCHASES.inc(buyer_kind, "error")
             return False, "Network error during purchase.", None
             
-    def fetch_market_data(self):
-        url = f"{self.base_url}/auction_house.json"
+    def claim_listing(self, listing_path, listing_etag, price):
+        """Delete a listing only if it is unchanged since read, retrying while only
+        unrelated fields changed. Returns (claimed, listing_now).
+
+        A claim that errors may have landed anyway, so the listing is read again
+        before claiming again: gone counts as claimed (a reply lost after the delete
+        is far likelier than a rival buyer in that window), still there means the
+        claim is retried. Raises once `settle_attempts` calls have failed."""
+        errors, unsure = 0, False
+        while True:
+            try:
+                if unsure:
+                    listing_now, listing_etag = self.storage.get_with_etag(listing_path)
+                    claimed, unsure = listing_now is None, False
+                else:
+                    claimed, listing_now, listing_etag = self.storage.put_if_match(listing_path, None, listing_etag)
+            except Exception as e:
+                errors += 1
+                print(f"Claim error for {listing_path}: {e}")
+                metrics.ERRORS.inc("buy")
+                if errors >= self.settle_attempts:
+                    raise
+                time.sleep(0.05 * 2 ** errors)
+                unsure = True
+                continue
+            if claimed or not listing_now or listing_now.get('price') != price:
+                return claimed, listing_now
+
+    def settle(self, updates, marker=None, credits=None, attempts=None):
+        """Write a sale's multi-path update. `marker` is a path only this update writes
+        (its trade record): the update is atomic, so after a failed attempt the marker
+        tells whether it landed anyway and its increments are never applied twice.
+        Without one (a refund with no trade) a failed attempt is simply repeated, like
+        a player flush. Gives up after `attempts` and queues the update for
+        retry_settlements(); returns whether it landed. `credits` ({seller: gil}) are
+        mirrored into cached sellers once it has."""
+        for attempt in range(attempts or self.settle_attempts):
+            if attempt:
+                time.sleep(0.05 * 2 ** attempt)
+            try:
+                self.storage.patch("", updates)
+            except Exception as e:
+                print(f"Settle error ({marker or 'refund'}): {e}")
+                metrics.ERRORS.inc("settle")
+                try:
+                    if marker is None or self.storage.get(marker) is None:
+                        continue
+                except Exception:
+                    continue
+            for seller, gil in (credits or {}).items():
+                self.players.credit(seller, gil)
+            return True
+        with self._unsettled_lock:
+            self._unsettled.append((updates, marker, credits))
+        return False
+
+    def retry_settlements(self):
+        """One more attempt at every sale whose settle was queued."""
+        with self._unsettled_lock:
+            queued, self._unsettled = self._unsettled, []
+        for updates, marker, credits in queued:
+            self.settle(updates, marker, credits, attempts=1)
+
+    def unsettled(self):
+        with self._unsettled_lock:
+            return len(self._unsettled)
+
+    def list_items_to_cloud(self, lines, seller_name, seller=None):
+        """List several (item, price, qty) lines: take all their items out of the seller's
+        stored inventory in one compare-and-set (take_items), then write every listing
+        in one multi-path update. Raises TransactionAborted if any item is short.
+        Returns [(listing_id, listing)], or None if a write failed."""
+        updates, listed, taken = {}, [], {}
+        for item_name, price, qty in lines:
+            listing_id = generate_push_id()
+            listing = self.new_listing(item_name, price, seller_name, qty)
+            updates[f"auction_house/{listing_id}"] = listing
+            listed.append((listing_id, listing))
+            taken[item_name] = taken.get(item_name, 0) + qty
         try:
-            resp = requests.get(url)
-            listings_dict = resp.json() or {}
-            
-            listings_list = []
-            for listing_id, listing_data in listings_dict.items():
-                listing_data['id'] = listing_id
-                listing_data['qty'] = listing_data.get('qty', 1) 
-                listings_list.append(listing_data)
-            
-            listings_list.sort(key=lambda x: x['time'], reverse=True)
-            
-            return listings_list
+            self.take_items(seller_name, taken, seller)
+        except (TransactionAborted, TransactionConflict):
+            raise
         except Exception as e:
-            print(f"Market fetch error: {e}")
-            return []
+            print(f"Cloud Bulk List Error: {e}")
+            metrics.ERRORS.inc("list")
+            return None
+        try:
+            self.storage.patch("", updates)
+        except Exception as e:
+            print(f"Cloud Bulk List Error: {e}")
+            metrics.ERRORS.inc("list")
+            self.return_items(seller_name, taken, seller)
+            return None
+        for listing_id, listing in listed:
+            self.market.add(listing_id, listing)
+            self.record_listing(listing_id, listing)
+        metrics.LISTINGS_CREATED.inc("bot" if seller_name in BOT_NAMES else "player", amount=len(listed))
+        return listed
+
+    def record_listing(self, listing_id, listing):
+        """Ledger: items leave the seller's inventory (bots list from thin air)."""
+        seller = listing['seller']
+        deltas = {} if seller in BOT_NAMES else {seller: delta(items={listing['item']: -listing['qty']})}
+        traffic.listing_created(listing_id)
+        self.ledger.record(
+            "list", deltas=deltas, opened={listing_id: listing},
+            listing=listing_id, seller=seller, item=listing['item'], qty=listing['qty'], price=listing['price'],
+        )
+
+    def record_sale(self, listing_id, listing, buyer_name, charged, credit_seller):
+        """Ledger: gil moves from buyer to seller, items to the buyer."""
+        item, qty, price, seller = listing['item'], listing.get('qty', 1), listing['price'], listing['seller']
+        deltas = {}
+        if buyer_name not in BOT_NAMES:
+            deltas[buyer_name] = delta(gil=-price if charged else 0, items={item: qty})
+        if credit_seller:
+            deltas[seller] = delta(gil=price)
+        self.ledger.record(
+            "buy", deltas=deltas, closed=[listing_id],
+            listing=listing_id, buyer=buyer_name, seller=seller, item=item, qty=qty, price=price,
+        )
 
-    def fetch_leaderboard(self):
-        url = f"{self.base_url}/users.json"
+    def plan_sweep(self, item_name, qty, max_unit, buyer_name, max_lines):
+        """Cheapest open listings of `item_name` at or under `max_unit` per unit that
+        fit in `qty` units together, skipping the buyer's own. Whole stacks only."""
+        plan, remaining, cursor = [], qty, None
+        while remaining > 0 and len(plan) < max_lines:
+            page, cursor = self.market.query(item=item_name, max_unit=max_unit, sort="price", limit=50, cursor=cursor)
+            for listing in page:
+                if listing['seller'] != buyer_name and listing['qty'] <= remaining:
+                    plan.append(listing)
+                    remaining -= listing['qty']
+                    if remaining == 0 or len(plan) == max_lines:
+                        break
+            if cursor is None:
+                break
+        return plan
+
+    def _claim(self, listing, origin):
+        """Conditionally delete one planned listing. Returns None on success, else why not."""
+        set_call_origin(origin)
         try:
-            resp = requests.get(url)
-            all_users = resp.json()
-            if not all_users: return []
-            
-            leaderboard = []
-            for name, profile in all_users.items():
-                if "data" in profile and name not in BOT_NAMES:
-                    d = profile["data"]
-                    leaderboard.append({
-                        "name": name,
-                        "gil": d.get("gil", 0),
-                        "synths": d.get("total_synths", 0)
-                    })
-            return leaderboard
-        except Exception:
-            return []
+            path = f"auction_house/{listing['id']}"
+            current, etag = self.storage.get_with_etag(path)
+            while True:
+                if not current or is_expired(current):
+                    return "sold_out"
+                if current.get('price') != listing['price'] or current.get('qty', 1) != listing['qty']:
+                    return "changed"
+                claimed, current, etag = self.storage.put_if_match(path, None, etag)
+                if claimed:
+                    return None
+        except Exception as e:
+            print(f"Claim error for {listing['id']}: {e}")
+            metrics.ERRORS.inc("sweep")
+            return "error"
+        finally:
+            set_call_origin(None)
 
-# ==========================================
-# HELPER CLASSES (Simplified for Web Context)
-# ==========================================
+    def sweep_buy(self, item_name, qty, max_unit, buyer_name, buyer=None, max_lines=50):
+        """Buy up to `qty` units of an item at `max_unit` per unit or less.
 
-class Player:
-    def __init__(self, name, data):
-        self.name = name
-        self.gil = data.get("gil", 5000)
-        self.inventory = data.get("inventory") or {}
-        self.total_synths = data.get("total_synths", 0)
+        1. Plan against the order book, cheapest first, and debit the buyer for the
+           affordable prefix of the plan in one compare-and-set.
+        2. Claim every planned listing with a conditional delete, in parallel, so
+           each can still only be sold once.
+        3. Settle in a single multi-path update: seller credits, the buyer's items,
+           a refund for lines that couldn't be claimed, and the trade records.
+           Claimed listings are gone and the debit stands, so the settle is retried
+           and, failing that, queued (see settle()); the sweep is reported either way.
 
-    def to_dict(self):
-        return {
-            "gil": self.gil,
-            "inventory": self.inventory,
-            "total_synths": self.total_synths
-        }
+        Returns (ok, message, lines) with one {listing_id, qty, price, status} per planned listing.
+        """
+        plan = self.plan_sweep(item_name, qty, max_unit, buyer_name, max_lines)
+        if not plan:
+            return False, "No listings match.", []
+        pending = buyer.pending_gil() if buyer else 0
+        affordable = []
 
-    def add_item(self, item_name, qty=1):
-        self.inventory[item_name] = self.inventory.get(item_name, 0) + qty
+        def debit(gil):
+            budget = (gil or 0) + pending
+            del affordable[:]
+            for listing in plan:
+                if listing['price'] > budget:
+                    break
+                budget -= listing['price']
+                affordable.append(listing)
+            if not affordable:
+                raise TransactionAborted("Insufficient Gil.")
+            return (gil or 0) - sum(l['price'] for l in affordable)
 
-    def remove_item(self, item_name, qty=1):
-        if self.inventory.get(item_name, 0) >= qty:
-            self.inventory[item_name] -= qty
-            if self.inventory[item_name] <= 0:
-                del self.inventory[item_name]
-            return True
-        return False
-        
-# Initialize the Auth Server globally
-auth_server = CloudAuthServer(FIREBASE_DB_URL)
+        try:
+            self.storage.transaction(f"users/{buyer_name}/data/gil", debit)
+        except TransactionAborted as e:
+            metrics.PURCHASES.inc("player", "insufficient_funds")
+            return False, f"Transaction failed: {e}", []
+        except TransactionConflict:
+            metrics.PURCHASES.inc("player", "conflict")
+            return False, "Auction house busy, please retry.", []
+        except Exception as e:
+            print(f"Cloud Sweep Error: {e}")
+            metrics.PURCHASES.inc("player", "error")
+            return False, "Network error during purchase.", []
+        charged = sum(l['price'] for l in affordable)
+
+        origin = call_origin()
+        outcomes = list(self._claims.map(lambda l: self._claim(l, origin), affordable))
+
+        now = time.time()
+        updates, bought, credits, trades = {}, [], {}, []
+        for listing, outcome in zip(affordable, outcomes):
+            if outcome is not None:
+                continue
+            bought.append(listing)
+            seller = listing['seller']
+            if seller not in BOT_NAMES:
+                credits[seller] = credits.get(seller, 0) + listing['price']
+            trade = self.history.new_trade(listing, now)
+            key = generate_push_id()
+            updates[f"{self.history.collection}/{key}"] = trade
+            trades.append((key, trade))
+        spent = sum(l['price'] for l in bought)
+        units = sum(l['qty'] for l in bought)
+        for seller, gil in credits.items():
+            updates[f"users/{seller}/data/gil"] = increment(gil)
+            updates.update(self.leaderboard.stage_gil(seller, gil))
+        updates.update(self.leaderboard.stage_gil(buyer_name, -spent))
+        if charged > spent:
+            updates[f"users/{buyer_name}/data/gil"] = increment(charged - spent)
+        if units:
+            updates[f"users/{buyer_name}/data/inventory/{item_name}"] = increment(units)
+        marker = f"{self.history.collection}/{trades[0][0]}" if trades else None
+        self.settle(updates, marker, credits)
+
+        for listing, outcome in zip(affordable, outcomes):
+            if outcome != "changed":
+                self.market.remove(listing['id'])
+        if buyer:
+            buyer.mirror_gil(-spent)
+            buyer.mirror_item(item_name, units)
+        for key, trade in trades:
+            self.history.add(key, trade)
+        for listing in bought:
+            self.record_sale(listing['id'], listing, buyer_name, True, listing['seller'] not in BOT_NAMES)
+
+        statuses = {l['id']: outcome or "ok" for l, outcome in zip(affordable, outcomes)}
+        lines = []
+        for listing in plan:
+            status = statuses.get(listing['id'], "insufficient_funds")
+            metrics.PURCHASES.inc("player", status)
+            lines.append({"listing_id": listing['id'], "qty": listing['qty'], "price": listing['price'], "status": status})
+        return bool(bought), f"Bought {units}x {item_name} for {spent:,}g.", lines
+
+    def fetch_leaderboard(self, limit):
+        try:
+            return self.leaderboard.top(limit)
+        except Exception as e:
+            print(f"Leaderboard fetch error: {e}")
+            metrics.ERRORS.inc("leaderboard")
+            return []
+
+# Initialize the Auth Server globally (every storage call is timed for /metrics)
+storage_backend = metrics.InstrumentedBackend(create_backend(
+    STORAGE_BACKEND,
+    firebase_url=FIREBASE_DB_URL,
+    local_db_path=LOCAL_DB_PATH,
+    pool_size=FIREBASE_POOL_SIZE,
+    timeout=FIREBASE_TIMEOUT,
+    read_retries=FIREBASE_READ_RETRIES,
+))
+event_bus = EventBus()
+event_stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+auth_server = CloudAuthServer(
+    storage_backend,
+    market_ttl=MARKET_CACHE_TTL,
+    leaderboard_ttl=LEADERBOARD_CACHE_TTL,
+    on_event=event_bus.publish,
+    player_max_dirty_age=PLAYER_MAX_DIRTY_AGE,
+    player_ttl=PLAYER_CACHE_TTL,
+    history_ttl=HISTORY_CACHE_TTL,
+    history_warm_days=HISTORY_WARM_DAYS,
+    listing_ttl=LISTING_TTL_HOURS * 3600,
+    bot_listing_ttl=BOT_LISTING_TTL_HOURS * 3600,
+    claim_workers=SWEEP_CLAIM_WORKERS,
+    settle_attempts=SETTLE_ATTEMPTS,
+    ledger_batch=LEDGER_BATCH_SIZE,
+    ledger_flush_interval=LEDGER_FLUSH_INTERVAL,
+    ledger_snapshot_lag=LEDGER_SNAPSHOT_LAG,
+)
+bot_pricing = economy.HistoryPricing(
+    lambda item: auth_server.history.average(item, BOT_PRICE_WINDOW), BOT_HISTORY_WEIGHT,
+)
+# Seeds are keyed with the session secret: the cookie only carries the session id
+traffic_recorder = traffic.TrafficRecorder(
+    TRAFFIC_RECORD_PATH, app.secret_key, max_sessions=TRAFFIC_MAX_SESSIONS,
+) if TRAFFIC_RECORD_PATH else None
+
+def make_bot_engine(agent):
+    engine = economy.EconomyEngine(bot_pricing.policy(), economy.LiveMarket(auth_server), random.Random())
+    if traffic_recorder is not None:
+        return traffic.RecordedEngine(engine, traffic_recorder)
+    return engine
+
+economy_scheduler = economy.EconomyScheduler(
+    make_bot_engine,
+    LeaderLease(storage_backend, "economy/lease", ttl=ECONOMY_LEASE_TTL),
+    storage_backend,
+    interval=ECONOMY_TICK_INTERVAL,
+    jitter=ECONOMY_TICK_JITTER,
+    agents=ECONOMY_AGENTS,
+)
+compactor = AuctionCompactor(
+    storage_backend,
+    default_ttl=LISTING_TTL_HOURS * 3600,
+    min_ttl=min(LISTING_TTL_HOURS, BOT_LISTING_TTL_HOURS) * 3600,
+    grace=COMPACTION_GRACE,
+    trade_retention=TRADES_RETENTION_DAYS * 86400,
+    excluded=BOT_NAMES,
+)
+compaction_lease = LeaderLease(storage_backend, "compaction/lease", ttl=COMPACTION_INTERVAL * 2)
+ledger_lease = LeaderLease(storage_backend, "ledger/lease", ttl=LEDGER_SNAPSHOT_INTERVAL * 2)
+response_cache = httpcache.PayloadCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_AGE)
+profiler = metrics.SlowRequestProfiler(PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS / 1000, PROFILE_DIR)
+metrics.MARKET_LISTINGS.set_function(auth_server.market.count)
+metrics.CACHED_PLAYERS.set_function(auth_server.players.size)
+metrics.EVENT_STREAMS.set_function(event_bus.subscriber_count)
+metrics.UNSETTLED_SALES.set_function(auth_server.unsettled)
 
 # ==========================================
 # FLASK ROUTES
 # ==========================================
 
+def route_label():
+    return request.url_rule.rule if request.url_rule else "<unmatched>"
+
+@app.before_request
+def start_request_metrics():
+    # Upstream storage calls made while serving this request are counted against its route
+    set_call_origin(f"{request.method} {route_label()}")
+    g.request_start = time.perf_counter()
+    profiler.start()
+
+@app.before_request
+def seed_request_rng():
+    """Synth rolls draw from request_rng(). Recorded requests get a generator seeded from
+    their client's session id (the seed itself stays server-side), and replays
+    (benchmarks/replay.py) send the recorded seed."""
+    if app.config.get('TRAFFIC_REPLAY') and 'X-Replay-Seed' in request.headers:
+        g.rng = traffic.session_rng(int(request.headers['X-Replay-Seed']), int(request.headers['X-Replay-Seq']))
+        g.replayed = True
+        traffic.start_call()
+    elif traffic_recorder is not None and traffic.is_recorded(request.path):
+        if not isinstance(session.get('traffic'), str):
+            session['traffic'] = traffic_recorder.new_session()
+        sid = session['traffic']
+        seed, n = traffic_recorder.begin(sid)
+        g.traffic = (sid, n, time.time(), session.get('username'))
+        g.rng = traffic.session_rng(seed, n)
+        traffic.start_call()
+
+def request_rng():
+    return g.get('rng') or random
+
+@app.after_request
+def record_traffic(response):
+    """Runs after the other hooks, so the logged status is the one sent (304s included).
+    Replays get the listing ids they created back, to map the recorded ones onto."""
+    recorded = g.get('traffic')
+    if recorded is not None:
+        sid, n, started, user = recorded
+        traffic_recorder.request(
+            sid, n, started, request.method, request.full_path.rstrip('?'), route_label(), user,
+            request.get_json(silent=True), response.status_code, time.perf_counter() - g.request_start,
+            traffic.end_call(),
+        )
+    elif g.get('replayed'):
+        response.headers['X-Replay-Created'] = ",".join(traffic.end_call())
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        metrics.HTTP_REQUESTS.observe(time.perf_counter() - start, request.method, route_label(), response.status_code)
+    profiler.finish(f"{request.method} {route_label()}")
+    return response
+
+@app.after_request
+def finalize_response(response):
+    """Revalidation and compression for JSON bodies (runs before the metrics hook,
+    so its cost is in the request timings)."""
+    if response.mimetype != 'application/json' or response.is_streamed or response.status_code != 200:
+        return response
+    payload = getattr(response, 'payload', None)
+    if request.method in ('GET', 'HEAD'):
+        if not response.get_etag()[0]:
+            response.set_etag(payload.hash if payload else httpcache.content_hash(response.get_data()))
+        if 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = 'no-cache'     # always revalidate, usually a 304
+        response.make_conditional(request)
+        if response.status_code != 200:
+            return response
+    body = payload.body if payload else response.get_data()
+    encoding = httpcache.choose_encoding(request.accept_encodings)
+    response.vary.add('Accept-Encoding')
+    if encoding and len(body) >= httpcache.MIN_COMPRESS_BYTES:
+        response.set_data(payload.encoded(encoding) if payload else httpcache.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)     # same entity, different bytes
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    set_call_origin(None)
+
 @app.route('/')
 def serve_index():
     # Serve the HTML frontend
     return render_template('index.html')
 
-def get_player_data():
-    """Helper to fetch and return the Player object from the database"""
-    if 'username' not in session:
-        return None
-    username = session['username']
-    
-    url = f"{auth_server.base_url}/users/{username}/data.json"
-    try:
-        resp = requests.get(url)
-        data = resp.json()
-        if data:
-            return Player(username, data)
-        else:
-            session.pop('username', None) # Log out if data is gone
-            return None
-    except Exception:
-        return None
+def payload_response(payload, cache_control=None):
+    """Serve a pre-serialized JSON body; finalize_response reuses its hash and compressed copies."""
+    response = Response(payload.body, mimetype='application/json')
+    response.payload = payload
+    if cache_control:
+        response.headers['Cache-Control'] = cache_control
+    return response
+
+def checkout_player():
+    """Exclusive access to the logged-in Player from the state cache (None if unavailable).
+    Changes made inside the block are written behind by the flusher."""
+    return auth_server.players.checkout(
+        session.get('username'),
+        on_missing=lambda: session.pop('username', None), # Log out if data is gone
+    )
+
+def with_player(view):
+    """Route decorator: passes the checked-out Player, or answers 401."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with checkout_player() as player:
+            if not player:
+                return jsonify({"success": False, "message": "Not authenticated"}), 401
+            return view(player, *args, **kwargs)
+    return wrapper
 
 # --- Auth Routes ---
 
@@ -310,38 +942,57 @@ def api_login():
 
 @app.route('/api/auth/logout', methods=['POST'])
 def api_logout():
-    session.pop('username', None)
+    username = session.pop('username', None)
+    if username:
+        auth_server.players.evict(username) # Flush pending progress now
     return jsonify({"success": True})
 
 
 # --- Game API Routes ---
 
+@app.route('/api/game/static', methods=['GET'])
+def api_static():
+    """Recipes, reference prices and materials. Fetch as ?v=<static_version from sync>:
+    that URL never changes content, so it may be cached forever."""
+    if request.args.get('v') == STATIC_VERSION:
+        return payload_response(STATIC_PAYLOAD, 'public, max-age=31536000, immutable')
+    return payload_response(STATIC_PAYLOAD, 'public, no-cache')
+
 @app.route('/api/game/sync', methods=['GET'])
-def api_sync():
-    player = get_player_data()
-    if not player:
-        return jsonify({"success": False, "message": "Not authenticated"}), 401
-        
+@with_player
+def api_sync(player):
     return jsonify({
         "success": True, 
         "player": player.to_dict(),
-        "recipes": BONECRAFT_RECIPES
+        "static_version": STATIC_VERSION
     })
 
+def spend_for_synths(player, materials, cost):
+    """Take synthesis fees and materials from stored state (take_items); the cached
+    player may be stale when another worker spent them. Returns an error response or None."""
+    try:
+        auth_server.take_items(player.name, materials, player, gil=cost)
+    except TransactionAborted as e:
+        return jsonify({"success": False, "message": str(e)})
+    except TransactionConflict:
+        return jsonify({"success": False, "message": "Server busy, please retry."}), 409
+    except Exception as e:
+        print(f"Synth spend error: {e}")
+        metrics.ERRORS.inc("synth")
+        return jsonify({"success": False, "message": "Network error during synthesis."}), 502
+    return None
+
 @app.route('/api/game/synth', methods=['POST'])
-def api_synth():
-    player = get_player_data()
-    if not player:
-        return jsonify({"success": False, "message": "Not authenticated"}), 401
-        
+@with_player
+def api_synth(player):
     data = request.get_json()
     recipe_name = data.get('recipe_name')
     
-    recipe = next((r for r in BONECRAFT_RECIPES if r["name"] == recipe_name), None)
+    recipe = RECIPES_BY_NAME.get(recipe_name)
     if not recipe:
         return jsonify({"success": False, "message": "Invalid recipe"}), 400
         
-    cost = int(recipe["price"] * 0.1) 
+    cost = synth_cost(recipe)
     material_name = recipe["material"]
     material_qty = recipe["qty"]
 
@@ -351,39 +1002,34 @@ def api_synth():
     if player.inventory.get(material_name, 0) < material_qty:
         return jsonify({"success": False, "message": f"Missing material: {material_qty}x {material_name}!"})
 
-    # Perform Transaction
-    player.gil -= cost
+    # Perform Transaction: fee and materials come out of storage with a conditional write
+    failed = spend_for_synths(player, {material_name: material_qty}, cost)
+    if failed:
+        return failed
     player.total_synths += 1
     
-    roll = random.randint(1, 100)
-    tier = recipe["tier"]
-    result = "NQ"
-    
-    if tier == 5: result = "BREAK" if roll <= 10 else ("HQ" if roll > 40 else "NQ")
-    elif tier == 4: result = "BREAK" if roll <= 15 else ("HQ" if roll > 50 else "NQ")
-    elif tier == 3: result = "BREAK" if roll <= 20 else ("HQ" if roll > 60 else "NQ")
-    elif tier == 2: result = "BREAK" if roll <= 25 else ("HQ" if roll > 70 else "NQ")
-    elif tier == 1: result = "BREAK" if roll <= 30 else ("HQ" if roll > 80 else "NQ")
-    else: result = "BREAK" if roll <= 35 else ("HQ" if roll > 90 else "NQ")
+    roll = request_rng().randint(1, 100)
+    result = SYNTH_ROLL_TABLE[synth_tier(recipe)][roll]
 
     synth_message = ""
+    items = {material_name: -material_qty}
     if result == "BREAK":
-        player.remove_item(material_name, material_qty)
         synth_message = f"Synthesis Failed! Materials lost. (Roll: {roll})"
     else:
-        player.remove_item(material_name, material_qty)
-        
         item_name = recipe["name"]
         if result == "HQ":
-            item_name = f"HQ {item_name} (+1)"
+            item_name = hq_item_name(recipe)
             synth_message = f"High Quality!! Got {item_name}"
         else:
             synth_message = f"Success. Got {item_name}"
         player.add_item(item_name)
+        items[item_name] = items.get(item_name, 0) + 1
+    auth_server.ledger.record(
+        "synth", deltas={player.name: delta(gil=-cost, synths=1, items=items)},
+        player=player.name, recipe=recipe["name"], result=result,
+    )
 
-    # Save state back to cloud
-    auth_server.sync_user_data(player.name, player.to_dict())
-    
+    # Synth count and crafted items are written back by the player cache flusher
     return jsonify({
         "success": True,
         "message": synth_message,
@@ -391,16 +1037,173 @@ def api_synth():
         "player": player.to_dict()
     })
 
+@app.route('/api/game/synth/batch', methods=['POST'])
+@with_player
+def api_synth_batch(player):
+    """Body: {"recipe_name": .., "count": n} or {"recipes": [{"recipe_name": .., "count": n}, ..]}.
+    All fees and materials are checked up front; it's all or nothing."""
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    lines = data.get('recipes') or [{"recipe_name": data.get('recipe_name'), "count": data.get('count', 1)}]
+    if not isinstance(lines, list) or not all(isinstance(line, dict) for line in lines):
+        return jsonify({"success": False, "message": "recipes must be a list of {recipe_name, count}."}), 400
+
+    orders = []
+    for line in lines:
+        name = line.get('recipe_name')
+        recipe = RECIPES_BY_NAME.get(name) if isinstance(name, str) else None
+        count = line.get('count')
+        if not recipe or not isinstance(count, int) or count <= 0:
+            return jsonify({"success": False, "message": "Invalid recipe or count"}), 400
+        orders.append((recipe, count))
+
+    total_count = sum(count for _, count in orders)
+    if total_count > MAX_BATCH_SYNTHS:
+        return jsonify({"success": False, "message": f"At most {MAX_BATCH_SYNTHS} synths per batch."}), 400
+
+    total_cost = sum(synth_cost(recipe) * count for recipe, count in orders)
+    materials_needed = {}
+    for recipe, count in orders:
+        materials_needed[recipe["material"]] = materials_needed.get(recipe["material"], 0) + recipe["qty"] * count
+
+    if player.gil < total_cost:
+        return jsonify({"success": False, "message": f"Not enough Gil for synthesis fees! ({total_cost:,}g needed)"})
+    for material_name, qty in materials_needed.items():
+        if player.inventory.get(material_name, 0) < qty:
+            return jsonify({"success": False, "message": f"Missing material: {qty}x {material_name}!"})
+
+    # Perform Transaction: materials are consumed whatever the outcome
+    failed = spend_for_synths(player, materials_needed, total_cost)
+    if failed:
+        return failed
+    player.total_synths += total_count
+
+    results = []
+    totals = {outcome: 0 for outcome in SYNTH_OUTCOMES}
+    items = {name: -qty for name, qty in materials_needed.items()}
+    for recipe, count in orders:
+        outcomes = roll_synths(recipe, count, request_rng())
+        if outcomes["NQ"]:
+            player.add_item(recipe["name"], outcomes["NQ"])
+            items[recipe["name"]] = items.get(recipe["name"], 0) + outcomes["NQ"]
+        if outcomes["HQ"]:
+            player.add_item(hq_item_name(recipe), outcomes["HQ"])
+            items[hq_item_name(recipe)] = items.get(hq_item_name(recipe), 0) + outcomes["HQ"]
+        for outcome, n in outcomes.items():
+            totals[outcome] += n
+        results.append(dict(outcomes, recipe_name=recipe["name"], count=count))
+    auth_server.ledger.record(
+        "synth", deltas={player.name: delta(gil=-total_cost, synths=total_count, items=items)},
+        player=player.name, results=results,
+    )
+
+    # Synth count and crafted items are written back by the player cache flusher
+    return jsonify({
+        "success": True,
+        "message": f"{total_count} synths: {totals['HQ']} HQ, {totals['NQ']} NQ, {totals['BREAK']} broke.",
+        "results": results,
+        "totals": totals,
+        "cost": total_cost,
+        "player": player.to_dict()
+    })
+
+def _float_arg(name):
+    value = request.args.get(name)
+    if value in (None, ""):
+        return None
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be finite")
+    return number
+
+def _page_arg(name, default):
+    """Integer page size from the query string, 1..MARKET_PAGE_MAX (ValueError outside)."""
+    value = int(request.args.get(name, default))
+    if not 1 <= value <= MARKET_PAGE_MAX:
+        raise ValueError(f"{name} must be between 1 and {MARKET_PAGE_MAX}")
+    return value
+
 @app.route('/api/ah/market', methods=['GET'])
 def api_market():
-    listings = auth_server.fetch_market_data()
-    return jsonify({"success": True, "listings": listings})
+    """Query params: item, min_price / max_price (per unit), sort (time|price|-price), limit, cursor."""
+    try:
+        item = request.args.get('item') or None
+        min_price = _float_arg('min_price')
+        max_price = _float_arg('max_price')
+        sort = request.args.get('sort', 'time')
+        limit = _page_arg('limit', MARKET_PAGE_DEFAULT)
+        if sort not in SORT_ORDERS:
+            raise ValueError
+    except ValueError:
+        return jsonify({"success": False, "message": "Invalid market query."}), 400
+
+    cursor = request.args.get('cursor')
+
+    def build():
+        listings, next_cursor = auth_server.market.query(
+            item=item, min_unit=min_price, max_unit=max_price,
+            sort=sort, limit=limit, cursor=cursor,
+        )
+        return {"success": True, "listings": listings, "next_cursor": next_cursor}
+
+    try:
+        key = ("market", item, min_price, max_price, sort, limit, cursor)
+        return payload_response(response_cache.get(key, auth_server.market.data_version(), build))
+    except InvalidCursor:
+        return jsonify({"success": False, "message": "Invalid cursor."}), 400
+    except Exception as e:
+        print(f"Market fetch error: {e}")
+        metrics.ERRORS.inc("market")
+        return jsonify({"success": True, "listings": [], "next_cursor": None})
+
+@app.route('/api/ah/best_ask', methods=['GET'])
+def api_best_ask():
+    """Cheapest listings by unit price: `depth` asks for `item`, or the best ask of every item."""
+    try:
+        depth = _page_arg('depth', 1)
+    except ValueError:
+        return jsonify({"success": False, "message": "Invalid depth."}), 400
+
+    item = request.args.get('item')
+    if item:
+        return jsonify({"success": True, "item": item, "asks": auth_server.market.best_asks(item, depth)})
+
+    best = {}
+    for name in auth_server.market.items():
+        asks = auth_server.market.best_asks(name, 1)
+        if asks:
+            best[name] = asks[0]
+    return jsonify({"success": True, "best_asks": best})
+
+@app.route('/api/ah/history', methods=['GET'])
+def api_history():
+    """Query params: item (required), resolution (1m|1h|1d), limit, since (unix seconds).
+    Candles are oldest first: {t, open, high, low, close (unit prices), volume, gil, trades}."""
+    item = request.args.get('item')
+    resolution = request.args.get('resolution', '1m')
+    try:
+        limit = min(int(request.args.get('limit', HISTORY_PAGE_DEFAULT)), RESOLUTIONS[resolution][1])
+        since = _float_arg('since')
+        if not item or limit <= 0:
+            raise ValueError
+    except (KeyError, ValueError):
+        return jsonify({"success": False, "message": "Invalid history query."}), 400
+
+    try:
+        candles = auth_server.history.candles(item, resolution, limit=limit, since=since)
+        average = auth_server.history.average(item, BOT_PRICE_WINDOW)
+    except Exception as e:
+        print(f"History fetch error: {e}")
+        metrics.ERRORS.inc("history")
+        return jsonify({"success": False, "message": "History unavailable."}), 502
+    return jsonify({
+        "success": True, "item": item, "resolution": resolution,
+        "candles": candles, "average": average, "average_window": BOT_PRICE_WINDOW,
+    })
 
 @app.route('/api/ah/list', methods=['POST'])
-def api_list_item():
-    player = get_player_data()
-    if not player:
-        return jsonify({"success": False, "message": "Not authenticated"}), 401
+@with_player
+def api_list_item(player):
 
     data = request.get_json()
     item_name = data.get('item')
@@ -413,53 +1216,36 @@ def api_list_item():
     if player.inventory.get(item_name, 0) < qty:
         return jsonify({"success": False, "message": "You don't have enough of this item."}), 400
     
-    # Remove from local inventory
-    player.remove_item(item_name, qty)
-    
-    # List to cloud
-    listing_id, listing_data = auth_server.list_item_to_cloud(item_name, price, player.name, qty)
+    # List to cloud; the items come out of the stored inventory with a conditional write
+    try:
+        listing_id, listing_data = auth_server.list_item_to_cloud(item_name, price, player.name, qty, player)
+    except TransactionAborted as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except TransactionConflict:
+        return jsonify({"success": False, "message": "Auction house busy, please retry."}), 409
     
     if listing_id:
-        # Save updated inventory to cloud
-        auth_server.sync_user_data(player.name, player.to_dict())
         return jsonify({"success": True, "message": f"Listed {qty}x {item_name} for {price:,}g."})
     else:
-        # Refund item if cloud list fails
-        player.add_item(item_name, qty)
         return jsonify({"success": False, "message": "Failed to list item to cloud."}), 500
 
 @app.route('/api/ah/buy', methods=['POST'])
-def api_buy_item():
-    player = get_player_data()
-    if not player:
-        return jsonify({"success": False, "message": "Not authenticated"}), 401
-    
+@with_player
+def api_buy_item(player):
     data = request.get_json()
     listing_id = data.get('listing_id')
 
-    # 1. Attempt to buy from cloud (atomic transaction)
-    success, msg, purchased_data = auth_server.buy_item_from_cloud(listing_id, player.name)
+    # 1. Buy from cloud (conditional writes: the listing can only be sold once)
+    success, msg, purchased_data = auth_server.buy_item_from_cloud(listing_id, player.name, player)
 
     if success:
         total_price = purchased_data['price']
         qty = purchased_data.get('qty', 1)
         item_name = purchased_data['item']
         
-        if player.gil < total_price:
-             # The item was bought from AH but user can't afford it. 
-             # In a real game, this shouldn't happen, but for simplicity: refund the AH.
-             # Here, we assume the frontend checked affordability first.
-             # We just prevent the local player from getting the item/losing Gil.
-             auth_server.list_item_to_cloud(item_name, total_price, purchased_data['seller'], qty) # Re-list item
-             return jsonify({"success": False, "message": "Transaction failed: Insufficient Gil."}), 400
-        
-        # 2. Update local player state
-        player.gil -= total_price
+        # 2. Gil was already debited in the cloud; the item is written behind by the player cache
         player.add_item(item_name, qty)
         
-        # 3. Save state back to cloud
-        auth_server.sync_user_data(player.name, player.to_dict())
-        
         return jsonify({
             "success": True,
             "message": f"Bought {qty}x {item_name} for {total_price:,}g.",
@@ -468,79 +1254,324 @@ def api_buy_item():
     else:
         return jsonify({"success": False, "message": msg}), 400
 
+@app.route('/api/ah/list_many', methods=['POST'])
+@with_player
+def api_list_items(player):
+    """Body: {"lines": [{"item", "price", "qty"}, ...]}. Every valid line is listed in one
+    write; each line gets {item, qty, price, success, message[, listing_id]}."""
+    lines = (request.get_json() or {}).get('lines')
+    if not isinstance(lines, list) or not lines or len(lines) > BULK_MAX_LINES:
+        return jsonify({"success": False, "message": f"Send 1 to {BULK_MAX_LINES} lines."}), 400
+
+    results, accepted, reserved = [], [], {}
+    for line in lines:
+        line = line if isinstance(line, dict) else {}
+        item_name, price, qty = line.get('item'), line.get('price'), line.get('qty')
+        result = {"item": item_name, "qty": qty, "price": price, "success": False}
+        results.append(result)
+        if not isinstance(price, int) or not isinstance(qty, int) or not item_name or price <= 0 or qty <= 0:
+            result["message"] = "Invalid listing details."
+        elif player.inventory.get(item_name, 0) - reserved.get(item_name, 0) < qty:
+            result["message"] = "You don't have enough of this item."
+        else:
+            reserved[item_name] = reserved.get(item_name, 0) + qty
+            accepted.append(result)
+    if not accepted:
+        return jsonify({"success": False, "message": "Nothing to list.", "lines": results}), 400
+
+    try:
+        listed = auth_server.list_items_to_cloud(
+            [(r["item"], r["price"], r["qty"]) for r in accepted], player.name, player,
+        )
+    except TransactionAborted as e:
+        for result in accepted:
+            result["message"] = str(e)
+        return jsonify({"success": False, "message": str(e), "lines": results}), 400
+    except TransactionConflict:
+        for result in accepted:
+            result["message"] = "Auction house busy, please retry."
+        return jsonify({"success": False, "message": "Auction house busy, please retry.", "lines": results}), 409
+    if listed is None:
+        for result in accepted:
+            result["message"] = "Failed to list item to cloud."
+        return jsonify({"success": False, "message": "Failed to list items to cloud.", "lines": results}), 500
+    for result, (listing_id, _) in zip(accepted, listed):
+        result.update(success=True, listing_id=listing_id, message=f"Listed {result['qty']}x {result['item']} for {result['price']:,}g.")
+    return jsonify({
+        "success": True,
+        "message": f"Listed {len(listed)} of {len(results)} lines.",
+        "lines": results,
+        "player": player.to_dict(),
+    })
+
+@app.route('/api/ah/buy_many', methods=['POST'])
+@with_player
+def api_buy_many(player):
+    """Body: {"item", "qty", "max_price" (per unit)}. Buys the cheapest whole listings that
+    fit in `qty` units; each planned listing comes back with a status
+    (ok, sold_out, changed, insufficient_funds, error)."""
+    data = request.get_json() or {}
+    item_name = data.get('item')
+    qty = data.get('qty')
+    max_price = data.get('max_price')
+    if not item_name or not isinstance(qty, int) or qty <= 0 \
+            or not isinstance(max_price, (int, float)) or max_price <= 0:
+        return jsonify({"success": False, "message": "Invalid order."}), 400
+
+    success, msg, lines = auth_server.sweep_buy(item_name, qty, max_price, player.name, player, BULK_MAX_LINES)
+    body = {"success": success, "message": msg, "lines": lines, "player": player.to_dict()}
+    return jsonify(body), (200 if success else 400)
+
 @app.route('/api/game/leaderboard', methods=['GET'])
 def api_leaderboard():
-    leaderboard_data = auth_server.fetch_leaderboard()
-    leaderboard_data.sort(key=lambda x: x['gil'], reverse=True)
-    return jsonify({"success": True, "leaderboard": leaderboard_data})
+    try:
+        version = auth_server.leaderboard.data_version()
+    except Exception as e:
+        print(f"Leaderboard fetch error: {e}")
+        metrics.ERRORS.inc("leaderboard")
+        version = None
+    rows = response_cache.get(
+        ("leaderboard", LEADERBOARD_SIZE), version, lambda: auth_server.fetch_leaderboard(LEADERBOARD_SIZE),
+    )
+    my_rank = None
+    if 'username' in session:
+        try:
+            my_rank = auth_server.leaderboard.rank(session['username'])
+        except Exception as e:
+            print(f"Leaderboard rank error: {e}")
+            metrics.ERRORS.inc("leaderboard")
+    # The shared rows are serialized once per version; only `me` is per player
+    body = b'{"success":true,"leaderboard":%s,"me":%s,"limit":%d}' % (
+        rows.body, httpcache.dumps(my_rank), LEADERBOARD_SIZE,
+    )
+    return Response(body, mimetype='application/json')
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    """Server-sent events: listing-added, listing-sold, leaderboard-changed (and resync).
+    503 when this worker already serves EVENTS_MAX_STREAMS streams; the client polls instead."""
+    if not event_stream_slots.acquire(blocking=False):
+        metrics.EVENT_STREAMS_REJECTED.inc()
+        return jsonify({"success": False, "message": "Too many live streams, poll instead."}), 503, {'Retry-After': '60'}
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    stream = stream_events(event_bus, last_event_id, heartbeat=EVENTS_HEARTBEAT, max_duration=EVENTS_MAX_STREAM)
+    response = Response(
+        stream_with_context(stream),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    # Runs when the server closes the response, even if the stream never started
+    response.call_on_close(event_stream_slots.release)
+    return response
+
+def admin_only(view):
+    """Require the X-Admin-Token header to match ADMIN_TOKEN."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token')
+        if not ADMIN_TOKEN or not token or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({"success": False, "message": "Forbidden."}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/admin/economy', methods=['GET', 'POST'])
+@admin_only
+def api_admin_economy():
+    """POST body: {"action": "start"|"stop", "interval": seconds, "agents": n} (all optional).
+    Settings are shared by all workers; the leader applies them within a lease renewal."""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        action = data.get('action')
+        if action not in (None, 'start', 'stop'):
+            return jsonify({"success": False, "message": "Unknown action."}), 400
+        try:
+            economy_scheduler.configure(
+                enabled=None if action is None else action == 'start',
+                interval=None if data.get('interval') is None else float(data['interval']),
+                agents=None if data.get('agents') is None else int(data['agents']),
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({"success": False, "message": f"Invalid setting: {e}"}), 400
+        except Exception as e:
+            print(f"Economy configure error: {e}")
+            metrics.ERRORS.inc("economy_admin")
+            return jsonify({"success": False, "message": "Storage error."}), 502
+    try:
+        status = economy_scheduler.status()
+    except Exception as e:
+        print(f"Economy status error: {e}")
+        metrics.ERRORS.inc("economy_admin")
+        return jsonify({"success": False, "message": "Storage error."}), 502
+    return jsonify({"success": True, "economy": status})
+
+@app.route('/api/admin/ledger/players/<name>', methods=['GET'])
+@admin_only
+def api_admin_ledger_player(name):
+    """A player as replayed from the ledger next to what storage holds, for audits."""
+    try:
+        auth_server.ledger.flush()
+        projected = auth_server.ledger.replay().players.get(name)
+        stored = storage_backend.get(f"users/{name}/data")
+    except Exception as e:
+        print(f"Ledger replay error: {e}")
+        metrics.ERRORS.inc("ledger")
+        return jsonify({"success": False, "message": "Storage error."}), 502
+    if stored:
+        stored = {"gil": stored.get("gil", 0), "synths": stored.get("total_synths", 0),
+                  "inventory": {k: v for k, v in (stored.get("inventory") or {}).items() if v}}
+    return jsonify({"success": True, "name": name, "ledger": projected, "stored": stored, "matches": projected == stored})
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    """Prometheus text exposition for this worker."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.cli.command('rebuild-leaderboard')
+def rebuild_leaderboard_command():
+    """One-off: rebuild /leaderboard from the full /users tree."""
+    count = auth_server.leaderboard.rebuild(storage_backend.get("users"))
+    print(f"Leaderboard rebuilt with {count} players.")
+
+@app.cli.command('ledger-snapshot')
+@click.option('--bootstrap', is_flag=True, help="Seed the first snapshot from /users and /auction_house.")
+def ledger_snapshot_command(bootstrap):
+    """Fold the ledger tail into a snapshot now."""
+    ledger = auth_server.ledger
+    if bootstrap:
+        if ledger.bootstrap(storage_backend.get("users"), storage_backend.get("auction_house"), excluded=BOT_NAMES):
+            print("Ledger bootstrapped from current state.")
+        else:
+            print("Ledger already has a snapshot.")
+    key = ledger.snapshot()
+    print(f"Snapshot {key}." if key else "Nothing new to snapshot.")
+
+@app.cli.command('ledger-export')
+@click.argument('path')
+def ledger_export_command(path):
+    """Write every ledger event to a JSON lines file, for offline rebuilds."""
+    auth_server.ledger.flush()
+    print(f"Exported {auth_server.ledger.export(path)} events to {path}.")
+
+@app.cli.command('ledger-rebuild')
+@click.option('--from', 'source', help="Replay an exported file from its first event instead of snapshot + tail.")
+@click.option('--write-leaderboard', is_flag=True, help="Replace /leaderboard with the replayed projection.")
+@click.option('--candles', help="Write replayed price history candles to this JSON file.")
+@click.option('--resolution', default="1h", type=click.Choice(list(RESOLUTIONS)))
+def ledger_rebuild_command(source, write_leaderboard, candles, resolution):
+    """Replay the ledger and rebuild the leaderboard and / or price history from it."""
+    start = time.perf_counter()
+    rollups = Rollups() if candles else None
+    if source:
+        state = replay(read_events(source), rollups=rollups)
+    else:
+        state = auth_server.ledger.replay()
+        if candles:
+            # Snapshots don't keep trades: candles need every segment
+            replay(auth_server.ledger.events(), rollups=rollups)
+    print(f"Replayed {state.events} events ({len(state.players)} players, {len(state.listings)} open listings) "
+          f"in {time.perf_counter() - start:.2f}s.")
+    if write_leaderboard:
+        count = auth_server.leaderboard.replace(state.leaderboard(BOT_NAMES))
+        print(f"Leaderboard rebuilt with {count} players.")
+    if candles:
+        with open(candles, "w") as f:
+            json.dump({item: [candle_dict(c) for c in rollups.candles(item, resolution)] for item in rollups.items()}, f)
+        print(f"Candles for {len(rollups.items())} items written to {candles}.")
+
+@app.cli.command('ledger-restore-player')
+@click.argument('name')
+def ledger_restore_player_command(name):
+    """Overwrite a player's gil, synths and inventory with the ledger's replayed state."""
+    auth_server.players.evict(name)
+    auth_server.ledger.flush()
+    projected = auth_server.ledger.replay().players.get(name)
+    if projected is None:
+        print(f"No ledger history for {name}.")
+        return
+    storage_backend.patch(f"users/{name}/data", {
+        "gil": projected["gil"], "total_synths": projected["synths"], "inventory": projected["inventory"] or None,
+    })
+    auth_server.leaderboard.update(name, gil=projected["gil"], synths=projected["synths"])
+    print(f"Restored {name}: {projected['gil']:,}g, {projected['synths']} synths, {sum(projected['inventory'].values())} items.")
 
 
 # ==========================================
-# BACKGROUND ECONOMY SIMULATION
+# BACKGROUND TASKS
 # ==========================================
 
-def run_economy_simulation():
-    """Runs in a separate thread to simulate bot activity."""
-    print("--- Starting Economy Simulation Thread ---")
+def run_event_watcher():
+    """While anyone is subscribed, pull other workers' market/leaderboard writes so they become events."""
+    while True:
+        if event_bus.has_subscribers():
+            for cache in (auth_server.market, auth_server.leaderboard):
+                try:
+                    cache.refresh()
+                except Exception as e:
+                    print(f"Event watcher error: {e}")
+                    metrics.ERRORS.inc("event_watcher")
+        time.sleep(EVENTS_POLL_INTERVAL)
+
+def run_compaction():
+    """Archive expired listings and old trades; only the compaction lease holder does the work."""
     while True:
         try:
-            # Bots list materials (30% chance every cycle)
-            if random.randint(1, 10000) <= 3000:
-                bot = random.choice(BOT_NAMES)
-                item_to_list = random.choice(BOT_LISTABLE_ITEMS)
-                
-                list_qty = 1
-                if random.random() < 0.5: list_qty = 12 
-                elif random.random() < 0.25: list_qty = 6 
-
-                # Determine base price (unit price)
-                base_price = 100
-                if item_to_list in ["Chicken Bone", "Sheep Tooth", "Giant Femur"]: base_price = 500
-                elif item_to_list in ["Beetle Shell", "Beetle Jaw", "Ram Horn"]: base_price = 1500
-                elif item_to_list in ["Turtle Shell", "Scorpion Shell"]: base_price = 3000
-                elif item_to_list in ["Demon Horn", "Black Tiger Fang", "Coral Fragment"]: base_price = 8000
-                elif item_to_list in ["Wyvern Scales", "Titanictus Shell", "Gavial Fish"]: base_price = 25000
-                
-                unit_price = int(base_price * random.uniform(0.8, 1.5))
-                total_price = unit_price * list_qty
-                
-                auth_server.list_item_to_cloud(item_to_list, total_price, bot, qty=list_qty)
-                
-            # Bots buy items (20% chance every cycle)
-            elif random.random() < 0.2:
-                listings = auth_server.fetch_market_data()
-                if listings:
-                    target = random.choice(listings)
-                    base_unit_price = 0
-                    
-                    # Estimate value for buy decision
-                    for r in BONECRAFT_RECIPES:
-                        if r['name'] in target['item']:
-                            base_unit_price = r['price'] * (3 if 'HQ' in target['item'] else 1)
-                            break
-                    if not base_unit_price and target['item'] in BOT_LISTABLE_ITEMS:
-                        # Use the same base price logic as listing
-                        if target['item'] in ["Bone Chip", "Seashell"]: base_unit_price = 100
-                        elif target['item'] in ["Chicken Bone", "Sheep Tooth", "Giant Femur"]: base_unit_price = 500
-                        elif target['item'] in ["Beetle Shell", "Beetle Jaw", "Ram Horn"]: base_unit_price = 1500
-                        elif target['item'] in ["Turtle Shell", "Scorpion Shell"]: base_unit_price = 3000
-                        elif target['item'] in ["Demon Horn", "Black Tiger Fang", "Coral Fragment"]: base_unit_price = 8000
-                        elif target['item'] in ["Wyvern Scales", "Titanictus Shell", "Gavial Fish"]: base_unit_price = 25000
-
-                    listing_unit_price = target['price'] / target.get('qty', 1)
-                        
-                    # Simplified bot purchase logic: only buy if price is good (or 5% chance anyway)
-                    if listing_unit_price < base_unit_price * 1.2 or random.random() < 0.05:
-                        buyer = random.choice(BOT_NAMES)
-                        auth_server.buy_item_from_cloud(target['id'], buyer)
-            
+            if compaction_lease.acquire():
+                result = compactor.run()
+                sellers = set()
+                for listing_id, listing in result["expired"].items():
+                    auth_server.market.remove(listing_id)
+                    seller = listing.get('seller')
+                    returned = {} if seller in BOT_NAMES else {seller: delta(items={listing['item']: listing.get('qty', 1)})}
+                    auth_server.ledger.record("expire", deltas=returned, closed=[listing_id], listing=listing_id, seller=seller)
+                    sellers.add(seller)
+                # Returned items were written as increments; reload those players
+                for seller in sellers - set(BOT_NAMES):
+                    auth_server.players.evict(seller)
+                metrics.LISTINGS_EXPIRED.inc(amount=len(result["expired"]))
+                metrics.TRADES_ARCHIVED.inc(amount=result["archived_trades"])
         except Exception as e:
-            print(f"Economy Error: {e}")
-            
-        time.sleep(random.uniform(3, 6)) # Wait 3-6 seconds before next tick
+            print(f"Compaction error: {e}")
+            metrics.ERRORS.inc("compaction")
+        time.sleep(COMPACTION_INTERVAL)
+
+def run_settlement_retries():
+    """Keep retrying sales whose settle update couldn't be written during the purchase."""
+    while True:
+        time.sleep(SETTLE_RETRY_INTERVAL)
+        try:
+            auth_server.retry_settlements()
+        except Exception as e:
+            print(f"Settlement retry error: {e}")
+            metrics.ERRORS.inc("settle")
+
+def run_ledger_snapshots():
+    """Fold the ledger tail into a snapshot now and then; only the ledger lease holder does."""
+    while True:
+        time.sleep(LEDGER_SNAPSHOT_INTERVAL)
+        try:
+            if ledger_lease.acquire():
+                auth_server.ledger.snapshot()
+        except Exception as e:
+            print(f"Ledger snapshot error: {e}")
+            metrics.ERRORS.inc("ledger")
 
-# Run the economy simulation in a daemon thread
-threading.Thread(target=run_economy_simulation, daemon=True).start()
+# Every worker runs the scheduler; only the lease holder actually ticks bots
+if ECONOMY_ENABLED:
+    threading.Thread(target=economy_scheduler.run, daemon=True).start()
+    atexit.register(economy_scheduler.stop)
+threading.Thread(target=run_event_watcher, daemon=True).start()
+if COMPACTION_ENABLED:
+    threading.Thread(target=run_compaction, daemon=True).start()
+threading.Thread(target=auth_server.players.run_flusher, daemon=True).start()
+atexit.register(auth_server.players.stop) # Flush dirty players on shutdown
+threading.Thread(target=auth_server.ledger.run_flusher, daemon=True).start()
+threading.Thread(target=run_ledger_snapshots, daemon=True).start()
+atexit.register(auth_server.ledger.stop)
+threading.Thread(target=run_settlement_retries, daemon=True).start()
+atexit.register(auth_server.retry_settlements)
+if traffic_recorder is not None:
+    threading.Thread(target=traffic_recorder.run_flusher, daemon=True).start()
+    atexit.register(traffic_recorder.stop)
 
 if __name__ == '__main__':
     # Use 0.0.0.0 for hosting on a public server
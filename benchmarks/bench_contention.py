@@ -0,0 +1,115 @@
+"""Contention benchmark for the auction house purchase path.
+
+Many buyers race for the same listing, round after round. Every round must
+have exactly one winner, the seller must be credited exactly once per sale
+and buyers must only be charged for what they won.
+
+    python benchmarks/bench_contention.py --buyers 32 --rounds 200 --workers 4
+
+Each "worker" is a separate CloudAuthServer with its own storage connection
+(like separate gunicorn workers); local runs share a temporary SQLite file.
+Pass --firebase-url to race against a Firebase (or fake Firebase) instead.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keep the app's own module-level server off the network
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("LOCAL_DB_PATH", ":memory:")
+
+from app import CloudAuthServer  # noqa: E402
+from storage import FirebaseBackend, LocalBackend  # noqa: E402
+
+STARTING_GIL = 5000
+PRICE = 10
+
+
+def make_servers(args):
+    if args.firebase_url:
+        return [CloudAuthServer(FirebaseBackend(args.firebase_url, pool_size=args.buyers)) for _ in range(args.workers)]
+    path = os.path.join(tempfile.mkdtemp(prefix="bonecraft-bench-"), "contention.db")
+    return [CloudAuthServer(LocalBackend(path)) for _ in range(args.workers)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buyers", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--firebase-url")
+    args = parser.parse_args()
+
+    servers = make_servers(args)
+    admin = servers[0]
+    run_id = f"{int(time.time())}"
+    seller = f"bench_seller_{run_id}"
+    buyers = [f"bench_buyer_{run_id}_{i}" for i in range(args.buyers)]
+    for name in [seller] + buyers:
+        admin.register(name, "bench")
+    admin.storage.put(f"users/{seller}/data/inventory/Bench Token", args.rounds)
+
+    wins = {name: 0 for name in buyers}
+    double_sells = 0
+    latencies = []
+    lock = threading.Lock()
+
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        listing_id, _ = admin.list_item_to_cloud("Bench Token", PRICE, seller, qty=1)
+        barrier = threading.Barrier(args.buyers)
+        round_wins = []
+
+        def race(i, name):
+            server = servers[i % len(servers)]
+            with server.players.checkout(name) as player:
+                barrier.wait()
+                t0 = time.perf_counter()
+                ok, _, _ = server.buy_item_from_cloud(listing_id, name, player)
+                elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+                if ok:
+                    round_wins.append(name)
+
+        threads = [threading.Thread(target=race, args=(i, name)) for i, name in enumerate(buyers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(round_wins) > 1:
+            double_sells += 1
+        for name in round_wins:
+            wins[name] += 1
+    elapsed = time.perf_counter() - start
+
+    sold = sum(wins.values())
+    seller_gil = admin.fetch_player_data(seller)["gil"]
+    overcharged = [
+        name for name in buyers
+        if admin.fetch_player_data(name)["gil"] != STARTING_GIL - PRICE * wins[name]
+    ]
+    latencies.sort()
+
+    print(f"rounds={args.rounds} buyers={args.buyers} workers={len(servers)}")
+    print(f"sold={sold} double_sells={double_sells} unsold={args.rounds - sold}")
+    print(f"seller_gil={seller_gil} expected={STARTING_GIL + PRICE * sold}")
+    print(f"buyers_with_wrong_gil={len(overcharged)}")
+    print(f"elapsed={elapsed:.2f}s attempts/s={len(latencies) / elapsed:.0f} "
+          f"p50={latencies[len(latencies) // 2] * 1000:.2f}ms "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms")
+
+    failed = double_sells or sold != args.rounds or seller_gil != STARTING_GIL + PRICE * sold or overcharged
+    if failed:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Memory benchmark for the in-process caches.
+
+Builds a market cache of --listings listings and --players cached players,
+and reports bytes per listing and per player as measured by tracemalloc,
+next to the same data held the old way (listings as dicts with a formatted
+time string, players with a dict inventory and a per-instance __dict__).
+The "MarketCache" and "PlayerStateCache entry" lines are what the caches
+actually hold per listing / player (order-book keys and cache bookkeeping
+included); the lines above them are the objects alone.
+
+    python benchmarks/bench_memory.py --listings 100000 --players 10000
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gamedata import BONECRAFT_RECIPES, BOT_LISTABLE_ITEMS, BOT_NAMES, MATERIAL_BASE_PRICES  # noqa: E402
+from market import TIME_FORMAT, Listing, MarketCache  # noqa: E402
+from players import Player, _Entry  # noqa: E402
+from storage import LocalBackend, push_id_at  # noqa: E402
+
+
+class DictPlayer:
+    """Player as it was before __slots__ and Inventory: for comparison only."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self._gil = data.get("gil", 5000)
+        self.inventory = {k: v for k, v in (data.get("inventory") or {}).items() if v > 0}
+        self._total_synths = data.get("total_synths", 0)
+        self.mutations = 0
+        self._gil_delta = 0
+        self._synths_delta = 0
+        self._item_deltas = {}
+
+
+def stored_listings(n, rng):
+    """(id, stored listing as JSON) pairs as the server writes them, oldest first."""
+    sellers = BOT_NAMES + [f"player{i}" for i in range(2000)]
+    start = int(time.time()) - 86400
+    result = []
+    for i in range(n):
+        ts = start + i * 86400 // n
+        item = rng.choice(BOT_LISTABLE_ITEMS)
+        qty = rng.choice((1, 1, 1, 3, 12))
+        result.append((push_id_at(ts) + f"{i:04x}", json.dumps({
+            "item": item, "price": MATERIAL_BASE_PRICES[item] * qty, "seller": rng.choice(sellers), "qty": qty,
+            "time": datetime.datetime.fromtimestamp(ts).strftime(TIME_FORMAT), "ts": ts, "expires": ts + 86400,
+        })))
+    return result
+
+
+def stored_players(n, rng):
+    """(name, stored /users/<name>/data as JSON) pairs."""
+    crafted = [r["name"] for r in BONECRAFT_RECIPES]
+    result = []
+    for i in range(n):
+        inventory = {item: rng.randint(1, 40) for item in rng.sample(BOT_LISTABLE_ITEMS, rng.randint(2, 8))}
+        for name in rng.sample(crafted, rng.randint(0, 4)):
+            inventory[name if rng.random() < 0.7 else f"HQ {name} (+1)"] = rng.randint(1, 10)
+        result.append((f"player{i}", json.dumps({"gil": rng.randint(0, 10 ** 6), "total_synths": rng.randint(0, 5000),
+                                                 "inventory": inventory})))
+    return result
+
+
+def measure(build):
+    """Bytes still allocated by what `build()` returns."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def report(label, total, n, baseline=None):
+    line = f"  {label:<34} {total / n:>8.0f} B each  {total / 2 ** 20:>8.1f} MiB"
+    if baseline:
+        line += f"  ({total / baseline:.0%} of dicts)"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listings", type=int, default=100000)
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    # Every build decodes its own copy (as a cache loading from storage would), so
+    # each is charged for the strings it keeps
+    listings = stored_listings(args.listings, rng)
+    players = stored_players(args.players, rng)
+
+    def dict_listings():
+        return {key: dict(json.loads(data), id=key) for key, data in listings}
+
+    def compact_listings():
+        return {key: Listing.from_dict(key, json.loads(data)) for key, data in listings}
+
+    def market_cache():
+        cache = MarketCache(LocalBackend(":memory:"))
+        for key, data in listings:
+            cache.add(key, json.loads(data))
+        return cache
+
+    def dict_players():
+        return {name: DictPlayer(name, json.loads(data)) for name, data in players}
+
+    def compact_players():
+        return {name: Player(name, json.loads(data)) for name, data in players}
+
+    def player_cache_entries():
+        return {name: _Entry(Player(name, json.loads(data))) for name, data in players}
+
+    print(f"{args.listings:,} listings")
+    baseline = measure(dict_listings)
+    report("dict", baseline, args.listings)
+    report("Listing object alone", measure(compact_listings), args.listings, baseline)
+    report("MarketCache (with order books)", measure(market_cache), args.listings)
+
+    print(f"{args.players:,} players")
+    baseline = measure(dict_players)
+    report("dict inventory, no slots", baseline, args.players)
+    report("Player + Inventory alone", measure(compact_players), args.players, baseline)
+    report("PlayerStateCache entry", measure(player_cache_entries), args.players)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Local stand-in for the Firebase Realtime Database REST API.
+
+Serves GET/PUT/PATCH/POST/DELETE on /<path>.json with Firebase semantics
+(server-value increments, ETag / if-match conditional writes, push IDs,
+orderBy="$key" range queries)
+on top of the embedded LocalBackend, with injected per-call latency so the
+app behaves as it would against the real thing.
+
+    python benchmarks/fake_firebase.py --port 9000 --latency-ms 40 --jitter-ms 20
+    FIREBASE_DB_URL=http://127.0.0.1:9000 python app.py
+
+GET /__stats returns upstream call counts per endpoint; DELETE /__stats resets them.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import LocalBackend, compute_etag, endpoint_label  # noqa: E402
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256    # the default backlog of 5 drops bursts of new connections
+
+
+class FakeFirebase:
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, jitter_ms=0.0, db_path=":memory:"):
+        self.store = LocalBackend(db_path)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self._counts_lock = threading.Lock()
+        self.counts = {}
+        self.server = _Server((host, port), _make_handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method, path):
+        label = endpoint_label(method, path)
+        with self._counts_lock:
+            self.counts[label] = self.counts.get(label, 0) + 1
+
+    def stats(self):
+        with self._counts_lock:
+            return {"total": sum(self.counts.values()), "endpoints": dict(self.counts)}
+
+    def reset_stats(self):
+        with self._counts_lock:
+            self.counts = {}
+
+    def delay(self):
+        ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"     # keep-alive, like the real endpoint
+        disable_nagle_algorithm = True    # headers and body go out as separate writes
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, value, etag=None):
+            body = json.dumps(value).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if etag is not None:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length)) if length else None
+
+        def _path(self):
+            path = unquote(urlsplit(self.path).path)
+            if path == "/__stats":
+                return None
+            if not path.endswith(".json"):
+                self._send(404, {"error": "Paths must end in .json"})
+                return False
+            return path[:-len(".json")].strip("/")
+
+        def _handle(self, method):
+            path = self._path()
+            if path is None:
+                if method == "DELETE":
+                    fake.reset_stats()
+                self._send(200, fake.stats())
+                return
+            if path is False:
+                return
+            fake.count(method, path)
+            fake.delay()
+            store = fake.store
+            want_etag = self.headers.get("X-Firebase-ETag") == "true"
+            try:
+                query = parse_qs(urlsplit(self.path).query)
+                if method == "GET" and query.get("orderBy") == ['"$key"']:
+                    start_at = json.loads(query["startAt"][0]) if "startAt" in query else None
+                    limit = int(query["limitToFirst"][0]) if "limitToFirst" in query else None
+                    self._send(200, dict(store.query(path, start_at, limit)) or None)
+                elif method == "GET":
+                    if want_etag:
+                        value, etag = store.get_with_etag(path)
+                        self._send(200, value, etag)
+                    else:
+                        self._send(200, store.get(path))
+                elif method == "PUT":
+                    value = self._body()
+                    if_match = self.headers.get("if-match")
+                    if if_match is not None:
+                        ok, current, etag = store.put_if_match(path, value, if_match)
+                        self._send(200 if ok else 412, current, etag)
+                    else:
+                        store.put(path, value)
+                        self._send(200, value, compute_etag(store.get(path)) if want_etag else None)
+                elif method == "PATCH":
+                    fields = self._body() or {}
+                    store.patch(path, fields)
+                    self._send(200, fields)
+                elif method == "POST":
+                    self._send(200, {"name": store.post(path, self._body())})
+                elif method == "DELETE":
+                    store.delete(path)
+                    self._send(200, None)
+            except (ValueError, TypeError) as e:
+                self._send(400, {"error": str(e)})
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_PUT(self):
+            self._handle("PUT")
+
+        def do_PATCH(self):
+            self._handle("PATCH")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform extra delay on top")
+    parser.add_argument("--db", default=":memory:", help="SQLite file to keep data between runs")
+    args = parser.parse_args()
+
+    fake = FakeFirebase(args.host, args.port, args.latency_ms, args.jitter_ms, args.db)
+    print(f"Fake Firebase listening on {fake.url} (latency {args.latency_ms}+{args.jitter_ms}ms)")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
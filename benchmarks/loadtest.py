@@ -0,0 +1,275 @@
+"""Load test for the Flask API against a local fake Firebase.
+
+Starts the fake Firebase (benchmarks/fake_firebase.py) with injected
+latency, serves `app` on a local port against it and lets many simulated
+players hammer it with a realistic mix of register / login / sync / synth /
+list / buy / market / leaderboard requests. Reports p50/p95/p99 latency,
+throughput and upstream calls per route (storage operations, as counted by
+the metrics registry).
+
+    python benchmarks/loadtest.py --players 50 --duration 30 --latency-ms 30
+    python benchmarks/loadtest.py --save-baseline      # record benchmarks/baselines/loadtest.json
+    python benchmarks/loadtest.py --check              # exit 1 on regressions against it
+
+Bots are off by default so runs are comparable; --with-bots turns them on.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_firebase import FakeFirebase  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "loadtest.json")
+
+# Relative weight of each action in a player's session (after register + login)
+TRAFFIC_MIX = {
+    "sync": 25,
+    "synth": 20,
+    "market": 20,
+    "leaderboard": 12,
+    "list": 8,
+    "buy": 8,
+    "login": 4,
+}
+
+# Materials every new player starts with, and cheap unit prices so buys can succeed
+STARTER_MATERIALS = ["Bone Chip", "Seashell", "Chicken Bone", "Sheep Tooth"]
+STARTER_RECIPES = ["Bone Hairpin", "Shell Ring", "Gelatin", "Bone Ring"]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}     # route -> [ms]
+        self.errors = {}        # route -> count of 5xx / transport errors
+
+    def record(self, route, ms, error):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(ms)
+            if error:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+class SimulatedPlayer:
+    def __init__(self, base_url, name, recorder, rng):
+        self.base_url = base_url
+        self.name = name
+        self.recorder = recorder
+        self.rng = rng
+        self.http = requests.Session()
+
+    def call(self, method, path, **kwargs):
+        route = f"{method} {path}"
+        start = time.perf_counter()
+        try:
+            resp = self.http.request(method, self.base_url + path, timeout=30, **kwargs)
+            error = resp.status_code >= 500
+            body = resp.json() if resp.headers.get("Content-Type", "").startswith("application/json") else None
+        except requests.RequestException:
+            error, body = True, None
+        self.recorder.record(route, (time.perf_counter() - start) * 1000, error)
+        return body or {}
+
+    def login(self):
+        self.call("POST", "/api/auth/login", json={"username": self.name, "password": "bench"})
+
+    def run(self, deadline):
+        self.call("POST", "/api/auth/register", json={"username": self.name, "password": "bench"})
+        self.login()
+        actions = list(TRAFFIC_MIX)
+        weights = list(TRAFFIC_MIX.values())
+        while time.monotonic() < deadline:
+            getattr(self, "do_" + self.rng.choices(actions, weights)[0])()
+
+    def do_login(self):
+        self.login()
+
+    def do_sync(self):
+        self.call("GET", "/api/game/sync")
+
+    def do_synth(self):
+        self.call("POST", "/api/game/synth", json={"recipe_name": self.rng.choice(STARTER_RECIPES)})
+
+    def do_market(self):
+        params = {"limit": 50}
+        if self.rng.random() < 0.5:
+            params["item"] = self.rng.choice(STARTER_MATERIALS)
+            params["sort"] = "price"
+        self.call("GET", "/api/ah/market", params=params)
+
+    def do_leaderboard(self):
+        self.call("GET", "/api/game/leaderboard")
+
+    def do_list(self):
+        item = self.rng.choice(STARTER_MATERIALS)
+        self.call("POST", "/api/ah/list", json={"item": item, "price": self.rng.randint(20, 80), "qty": 1})
+
+    def do_buy(self):
+        page = self.call("GET", "/api/ah/market", params={"item": self.rng.choice(STARTER_MATERIALS), "sort": "price", "limit": 5})
+        listings = [l for l in page.get("listings", []) if l.get("seller") != self.name]
+        if listings:
+            self.call("POST", "/api/ah/buy", json={"listing_id": self.rng.choice(listings)["id"]})
+
+
+def start_app(fake_url, with_bots):
+    os.environ["STORAGE_BACKEND"] = "firebase"
+    os.environ["FIREBASE_DB_URL"] = fake_url
+    os.environ["ECONOMY_ENABLED"] = "1" if with_bots else "0"
+    import app as app_module
+    from werkzeug.serving import make_server
+
+    app_module.app.config['SESSION_COOKIE_SECURE'] = False     # plain http on localhost
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return app_module, server, f"http://127.0.0.1:{server.server_port}"
+
+
+def summarize(recorder, elapsed, upstream_by_origin):
+    routes = {}
+    for route in sorted(recorder.latencies):
+        values = sorted(recorder.latencies[route])
+        upstream = upstream_by_origin.value(route)
+        routes[route] = {
+            "requests": len(values),
+            "rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 50), 2),
+            "p95_ms": round(percentile(values, 95), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+            "errors": recorder.errors.get(route, 0),
+            "upstream_per_request": round(upstream / len(values), 3),
+        }
+    total = sum(r["requests"] for r in routes.values())
+    background = upstream_by_origin.value("background")
+    return {
+        "requests": total,
+        "rps": round(total / elapsed, 1),
+        "background_upstream_calls": background,
+        "routes": routes,
+    }
+
+
+def print_report(summary, fake_stats):
+    print(f"\n{'route':<32} {'reqs':>7} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5} {'up/req':>7}")
+    for route, r in summary["routes"].items():
+        print(
+            f"{route:<32} {r['requests']:>7} {r['rps']:>7} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+            f"{r['p99_ms']:>8} {r['errors']:>5} {r['upstream_per_request']:>7}"
+        )
+    print(f"\n{summary['requests']} requests, {summary['rps']} req/s; "
+          f"{fake_stats['total']} upstream calls ({summary['background_upstream_calls']} from background work)")
+
+
+def compare(summary, baseline, tolerance):
+    """Regression messages for routes that got slower or chattier than the baseline."""
+    problems = []
+    for route, base in baseline["routes"].items():
+        now = summary["routes"].get(route)
+        if now is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            # Small absolute slack so sub-millisecond routes don't flap
+            limit = base[key] * (1 + tolerance) + 2
+            if now[key] > limit:
+                problems.append(f"{route} {key}: {now[key]} > {base[key]} (limit {limit:.2f})")
+        if now["upstream_per_request"] > base["upstream_per_request"] + 0.05:
+            problems.append(
+                f"{route} upstream_per_request: {now['upstream_per_request']} > {base['upstream_per_request']}"
+            )
+        if now["errors"] > base["errors"]:
+            problems.append(f"{route} errors: {now['errors']} > {base['errors']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of traffic")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="fake Firebase latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--with-bots", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="compare against the baseline, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative latency increase")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    fake = FakeFirebase(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms).start()
+    app_module, server, base_url = start_app(fake.url, args.with_bots)
+
+    recorder = Recorder()
+    run_id = int(time.time())
+    deadline = time.monotonic() + args.duration
+    players = [
+        SimulatedPlayer(base_url, f"load_{run_id}_{i}", recorder, random.Random(args.seed * 100003 + i))
+        for i in range(args.players)
+    ]
+    threads = [threading.Thread(target=p.run, args=(deadline,)) for p in players]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(recorder, elapsed, app_module.metrics.UPSTREAM_BY_ORIGIN)
+    summary["config"] = {
+        "players": args.players, "duration": args.duration,
+        "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "with_bots": args.with_bots,
+    }
+    fake_stats = fake.stats()
+    print_report(summary, fake_stats)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(summary, upstream=fake_stats), f, indent=2)
+
+    status = 0
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.check or os.path.exists(args.baseline):
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}")
+            status = 1
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline.get("config") != summary["config"]:
+                print(f"Note: baseline was recorded with {baseline.get('config')}")
+            problems = compare(summary, baseline, args.tolerance)
+            for problem in problems:
+                print(f"REGRESSION {problem}")
+            if not problems:
+                print("No regressions against baseline.")
+            elif args.check:
+                status = 1
+
+    server.shutdown()
+    app_module.auth_server.players.stop()
+    fake.stop()
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
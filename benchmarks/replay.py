@@ -0,0 +1,318 @@
+"""Replay recorded production traffic against local storage and compare builds.
+
+Record with TRAFFIC_RECORD_PATH set on the server (see app.py), then replay
+the log(s) in each build's checkout and diff the results:
+
+    TRAFFIC_RECORD_PATH='traffic-{worker}.jsonl.gz' gunicorn app:app
+    python benchmarks/replay.py run traffic-*.jsonl.gz --out before.json
+    python benchmarks/replay.py run traffic-*.jsonl.gz --out after.json     # other build
+    python benchmarks/replay.py diff before.json after.json
+
+The app is served on a local port over a fresh SQLite database
+(storage.LocalBackend), with live bots and compaction off: bot ticks are
+replayed from the log instead. Every recorded session keeps its own cookies
+and sends the recorded RNG seed with each request, so synth rolls and bot
+actions repeat exactly.
+
+--speed 0 (the default) replays everything in recorded order from one
+thread, as fast as possible; --speed 1 keeps the recorded gaps with sessions
+running concurrently, --speed 2 plays twice as fast.
+
+Players who were logged in before the recording started are registered and
+logged in first (untimed) and start from new-player state, so some of their
+requests may answer differently than in production. Responses whose status
+differs from the recorded one are counted per route as "mismatched".
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import economy  # noqa: E402
+import metrics  # noqa: E402
+from loadtest import percentile  # noqa: E402
+from traffic import REPLAY_PASSWORD, end_call, read_log, session_rng, start_call  # noqa: E402
+
+TICK_ROUTE = "economy tick"
+
+
+def start_app(db_path):
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["LOCAL_DB_PATH"] = db_path
+    os.environ["ECONOMY_ENABLED"] = "0"        # bot ticks come from the log
+    os.environ["COMPACTION_ENABLED"] = "0"
+    os.environ.pop("TRAFFIC_RECORD_PATH", None)
+    import app as app_module
+    from werkzeug.serving import make_server
+
+    app_module.app.config['SESSION_COOKIE_SECURE'] = False     # plain http on localhost
+    app_module.app.config['TRAFFIC_REPLAY'] = True             # honor X-Replay-Seed
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return app_module, server, f"http://127.0.0.1:{server.server_port}"
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}     # route -> [ms]
+        self.errors = {}        # route -> 5xx / transport errors
+        self.mismatched = {}    # route -> status differs from the recording
+
+    def add(self, route, ms, error, mismatched):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(ms)
+            if error:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            if mismatched:
+                self.mismatched[route] = self.mismatched.get(route, 0) + 1
+
+
+class ListingIds:
+    """Recorded listing id -> the id the replay created for the same listing."""
+
+    def __init__(self):
+        self._ids = {}
+
+    def learn(self, recorded, replayed):
+        self._ids.update(zip(recorded or (), replayed))
+
+    def rewrite(self, value):
+        """`value` (a request body) with recorded listing ids swapped for replayed ones."""
+        if isinstance(value, str):
+            return self._ids.get(value, value)
+        if isinstance(value, list):
+            return [self.rewrite(v) for v in value]
+        if isinstance(value, dict):
+            return {k: self.rewrite(v) for k, v in value.items()}
+        return value
+
+
+class ClientSession:
+    """One recorded browser session: its cookies, seed and logged-in player."""
+
+    def __init__(self, base_url, seed, results, ids):
+        self.base_url = base_url
+        self.seed = seed
+        self.results = results
+        self.ids = ids
+        self.http = requests.Session()
+        self.user = None
+
+    def _post(self, path, body):
+        return self.http.post(self.base_url + path, json=body, timeout=60)
+
+    def become(self, user):
+        """Untimed: log in as (or out of) whoever was logged in when the request was recorded."""
+        if user == self.user:
+            return
+        if user is None:
+            self._post("/api/auth/logout", None)
+        else:
+            credentials = {"username": user, "password": REPLAY_PASSWORD}
+            self._post("/api/auth/register", credentials)
+            self._post("/api/auth/login", credentials)
+        self.user = user
+
+    def replay(self, record):
+        self.become(record.get("u"))
+        route = f"{record['m']} {record['r']}"
+        headers = {"X-Replay-Seed": str(self.seed), "X-Replay-Seq": str(record["n"])}
+        body = self.ids.rewrite(record.get("b"))
+        start = time.perf_counter()
+        try:
+            resp = self.http.request(record["m"], self.base_url + record["p"], json=body, headers=headers, timeout=60)
+            status = resp.status_code
+        except requests.RequestException:
+            resp, status = None, None
+        self.results.add(route, (time.perf_counter() - start) * 1000,
+                         status is None or status >= 500, status != record["c"])
+        if resp is not None and resp.headers.get("X-Replay-Created"):
+            self.ids.learn(record.get("ids"), resp.headers["X-Replay-Created"].split(","))
+        if record["r"] == "/api/auth/login" and status == 200:
+            self.user = (record.get("b") or {}).get("username")
+        elif record["r"] == "/api/auth/logout":
+            self.user = None
+
+
+class BotSession:
+    """One recorded bot agent, ticked with the recorded seeds."""
+
+    def __init__(self, app_module, seed, results, ids):
+        self.engine = economy.EconomyEngine(
+            app_module.bot_pricing.policy(), economy.LiveMarket(app_module.auth_server), None,
+        )
+        self.seed = seed
+        self.results = results
+        self.ids = ids
+
+    def replay(self, record):
+        self.engine.rng = session_rng(self.seed, record["n"])
+        start_call()
+        start = time.perf_counter()
+        try:
+            self.engine.tick()
+            error = False
+        except Exception as e:
+            print(f"Bot tick error: {e}")
+            error = True
+        self.results.add(TICK_ROUTE, (time.perf_counter() - start) * 1000, error, False)
+        self.ids.learn(record.get("ids"), end_call())
+
+
+def make_sessions(records, app_module, base_url, results):
+    seeds = {r["s"]: r["seed"] for r in records if r["k"] == "s"}
+    ids = ListingIds()
+    sessions = {}
+    for r in records:
+        if r["k"] == "s" or r["s"] in sessions:
+            continue
+        seed = seeds.get(r["s"], 0)
+        if r["k"] == "tick":
+            sessions[r["s"]] = BotSession(app_module, seed, results, ids)
+        else:
+            sessions[r["s"]] = ClientSession(base_url, seed, results, ids)
+    return sessions
+
+
+def replay_paced(records, sessions, speed):
+    """Each session in its own thread, keeping the recorded gaps (divided by `speed`)."""
+    by_session = {}
+    for r in records:
+        if r["k"] != "s":
+            by_session.setdefault(r["s"], []).append(r)
+    t0 = records[0]["t"] if records else 0
+    start = time.monotonic()
+
+    def play(session, calls):
+        for record in calls:
+            delay = start + (record["t"] - t0) / 1000 / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            session.replay(record)
+
+    threads = [threading.Thread(target=play, args=(sessions[sid], calls)) for sid, calls in by_session.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def summarize(results, elapsed):
+    routes = {}
+    for route in sorted(results.latencies):
+        values = sorted(results.latencies[route])
+        upstream = metrics.UPSTREAM_BY_ORIGIN.value(route)
+        routes[route] = {
+            "requests": len(values),
+            "mean_ms": round(sum(values) / len(values), 2),
+            "p50_ms": round(percentile(values, 50), 2),
+            "p95_ms": round(percentile(values, 95), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+            "errors": results.errors.get(route, 0),
+            "mismatched": results.mismatched.get(route, 0),
+            "upstream_per_request": round(upstream / len(values), 3),
+        }
+    return {"requests": sum(r["requests"] for r in routes.values()), "elapsed_s": round(elapsed, 2), "routes": routes}
+
+
+def print_summary(summary):
+    print(f"\n{'route':<32} {'reqs':>7} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5} {'mism':>5} {'up/req':>7}")
+    for route, r in summary["routes"].items():
+        print(
+            f"{route:<32} {r['requests']:>7} {r['mean_ms']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+            f"{r['p99_ms']:>8} {r['errors']:>5} {r['mismatched']:>5} {r['upstream_per_request']:>7}"
+        )
+    print(f"\n{summary['requests']} calls replayed in {summary['elapsed_s']}s")
+
+
+def run(args):
+    records = read_log(args.logs)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bonecraft-replay-"), "replay.db")
+    app_module, server, base_url = start_app(db_path)
+    results = Results()
+    sessions = make_sessions(records, app_module, base_url, results)
+
+    start = time.perf_counter()
+    if args.speed > 0:
+        replay_paced(records, sessions, args.speed)
+    else:
+        for record in records:
+            if record["k"] != "s":
+                sessions[record["s"]].replay(record)
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed)
+    summary["config"] = {"logs": args.logs, "speed": args.speed}
+    print_summary(summary)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    server.shutdown()
+    app_module.auth_server.players.stop()
+    return 0
+
+
+def _change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before:+.0%}"
+
+
+def diff(args):
+    """Per-route latency of two replays of the same log; exit 1 if any p50 or p95 grew
+    by more than --tolerance (and 2ms, so sub-millisecond routes don't flap)."""
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get("config") != after.get("config"):
+        print(f"Note: different replays: {before.get('config')} vs {after.get('config')}")
+
+    print(f"\n{'route':<32} {'reqs':>7} {'p50 before':>11} {'after':>8} {'':>6} {'p95 before':>11} {'after':>8} {'':>6}")
+    regressions = []
+    for route in sorted(set(before["routes"]) | set(after["routes"])):
+        a, b = before["routes"].get(route), after["routes"].get(route)
+        if a is None or b is None:
+            print(f"{route:<32} only {'after' if a is None else 'before'}")
+            continue
+        print(
+            f"{route:<32} {b['requests']:>7} {a['p50_ms']:>11} {b['p50_ms']:>8} {_change(a['p50_ms'], b['p50_ms']):>6} "
+            f"{a['p95_ms']:>11} {b['p95_ms']:>8} {_change(a['p95_ms'], b['p95_ms']):>6}"
+        )
+        for key in ("p50_ms", "p95_ms"):
+            if b[key] > a[key] * (1 + args.tolerance) + 2:
+                regressions.append(f"{route} {key}: {a[key]} -> {b[key]}")
+    print(f"\nelapsed: {before['elapsed_s']}s -> {after['elapsed_s']}s")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="replay log files (one per worker) and report per-route timings")
+    run_parser.add_argument("logs", nargs="+")
+    run_parser.add_argument("--speed", type=float, default=0.0,
+                            help="0: as fast as possible, 1: recorded pace, 2: twice as fast")
+    run_parser.add_argument("--out", help="write the per-route summary to this file")
+    diff_parser = commands.add_parser("diff", help="compare two `run --out` summaries")
+    diff_parser.add_argument("before")
+    diff_parser.add_argument("after")
+    diff_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative latency increase")
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == "run" else diff(args))
+
+
+if __name__ == "__main__":
+    main()
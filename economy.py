@@ -0,0 +1,505 @@
+"""Bot economy: one policy and engine shared by the live app and offline runs.
+
+Offline balancing run (no network, seconds instead of weeks):
+
+    python economy.py --ticks 1000000 --seed 7 --sample-every 20000 --out curves.csv
+"""
+import argparse
+import array
+import csv
+import heapq
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from gamedata import BOT_LISTABLE_ITEMS, BOT_NAMES, MATERIAL_BASE_PRICES, reference_price
+from history import Rollups
+
+# ==========================================
+# BOT POLICY
+# Pure decision logic. Randomness is drawn in blocks (one C-level
+# random.choices call per field) so offline runs don't pay Python overhead
+# per decision; the live loop simply plans a block of one.
+# ==========================================
+
+LIST, BUY = "list", "buy"
+
+# Per tick: 30% list, else 20% buy (14% overall), else idle
+ACTION_KINDS = (LIST, BUY, None)
+ACTION_CUM_WEIGHTS = (0.30, 0.44, 1.0)
+
+# Stack sizes: 12 half the time, else 6 a quarter of the time, else singles
+LIST_QTYS = (12, 6, 1)
+LIST_QTY_CUM_WEIGHTS = (0.5, 0.625, 1.0)
+
+PRICE_SPREAD = (0.8, 1.5)       # listing unit price = base price * uniform(spread)
+BUY_BELOW = 1.2                 # bots buy asks under 120% of reference value...
+IMPULSE_BUY_CHANCE = 0.05       # ...or on a whim
+
+
+class BotPolicy:
+    def __init__(self, bots=BOT_NAMES, items=BOT_LISTABLE_ITEMS, base_price=None, value=reference_price):
+        self.bots = list(bots)
+        self.items = list(items)
+        # Unit price bots list materials at, and what they think anything is worth
+        self.base_price = base_price or (lambda item: MATERIAL_BASE_PRICES.get(item, 100))
+        self.value = value
+
+    def plan(self, rng, n):
+        """Draw the next `n` bot actions.
+
+        ("list", bot, item, qty, total_price)
+        ("buy", bot, pick, impulse) - pick/impulse are uniforms resolved
+        against the market when the action runs.
+        """
+        kinds = rng.choices(ACTION_KINDS, cum_weights=ACTION_CUM_WEIGHTS, k=n)
+        n_list = kinds.count(LIST)
+        n_buy = kinds.count(BUY)
+
+        sellers = iter(rng.choices(self.bots, k=n_list))
+        items = iter(rng.choices(self.items, k=n_list))
+        qtys = iter(rng.choices(LIST_QTYS, cum_weights=LIST_QTY_CUM_WEIGHTS, k=n_list))
+        lo, hi = PRICE_SPREAD
+        spreads = iter([lo + (hi - lo) * rng.random() for _ in range(n_list)])
+
+        buyers = iter(rng.choices(self.bots, k=n_buy))
+        picks = iter([rng.random() for _ in range(n_buy)])
+        impulses = iter([rng.random() for _ in range(n_buy)])
+
+        actions = []
+        for kind in kinds:
+            if kind is LIST:
+                item = next(items)
+                qty = next(qtys)
+                unit_price = int(self.base_price(item) * next(spreads))
+                actions.append((LIST, next(sellers), item, qty, unit_price * qty))
+            elif kind is BUY:
+                actions.append((BUY, next(buyers), next(picks), next(impulses)))
+            else:
+                actions.append(None)
+        return actions
+
+    def wants(self, item, unit_price, impulse):
+        return unit_price < self.value(item) * BUY_BELOW or impulse < IMPULSE_BUY_CHANCE
+
+
+class HistoryPricing:
+    """Bot price anchors from the rolling average of recent sales.
+
+    Anchoring on the average alone spirals to zero (bots buy the cheapest
+    asks, so every sale pulls the average down), so it is blended with the
+    static reference value; `python economy.py --pricing history` shows it
+    holding steady at weight 0.5.
+    """
+
+    def __init__(self, average, weight=0.5):
+        self.average = average      # average(item) -> unit price or None
+        self.weight = weight
+
+    def _blend(self, item, reference):
+        average = self.average(item)
+        if average is None:
+            return reference
+        return self.weight * average + (1 - self.weight) * reference
+
+    def base_price(self, item):
+        return self._blend(item, MATERIAL_BASE_PRICES.get(item, 100))
+
+    def value(self, item):
+        return self._blend(item, reference_price(item))
+
+    def policy(self, **kwargs):
+        return BotPolicy(base_price=self.base_price, value=self.value, **kwargs)
+
+
+class EconomyEngine:
+    """Runs policy actions against a market (ArrayMarket offline, LiveMarket in the app)."""
+
+    def __init__(self, policy, market, rng):
+        self.policy = policy
+        self.market = market
+        self.rng = rng
+        self.ticks = 0
+
+    def apply(self, action):
+        self.ticks += 1
+        if action is None:
+            return
+        if action[0] is LIST:
+            _, seller, item, qty, total_price = action
+            self.market.add_listing(item, qty, total_price, seller)
+        else:
+            _, buyer, pick, impulse = action
+            listed = self.market.listed_items()
+            if not listed:
+                return
+            item = listed[int(pick * len(listed))]
+            ask = self.market.best_ask(item)
+            if ask is not None:
+                handle, unit_price = ask
+                if self.policy.wants(item, unit_price, impulse):
+                    self.market.buy(handle, buyer)
+
+    def tick(self):
+        self.apply(self.policy.plan(self.rng, 1)[0])
+
+    def run(self, ticks, block=4096):
+        remaining = ticks
+        while remaining > 0:
+            n = min(block, remaining)
+            for action in self.policy.plan(self.rng, n):
+                self.apply(action)
+            remaining -= n
+
+
+# ==========================================
+# OFFLINE MARKET
+# Listings live in parallel arrays indexed by slot (freed slots are
+# reused); each item has a min-heap of (unit_price, slot) for best ask.
+# ==========================================
+
+class ArrayMarket:
+    def __init__(self, items, rollups=None, clock=None):
+        self.names = list(items)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        n = len(self.names)
+
+        # Listing slots
+        self.slot_item = array.array('i')
+        self.slot_qty = array.array('i')
+        self.slot_price = array.array('q')
+        self.free_slots = []
+
+        self.asks = [[] for _ in range(n)]
+        # Items with at least one listing, with each item's position for O(1) removal
+        self.listed = []
+        self.listed_pos = [-1] * n
+
+        # Per item counters
+        self.depth = array.array('q', [0] * n)          # listed units
+        self.listed_gil = array.array('q', [0] * n)     # gil value of open listings
+        self.traded_units = array.array('q', [0] * n)
+        self.traded_gil = array.array('q', [0] * n)
+
+        # Optional price history (history.Rollups) fed with every sale at clock() time
+        self.rollups = rollups
+        self.clock = clock
+
+    def _item_id(self, item):
+        item_id = self.ids.get(item)
+        if item_id is None:
+            item_id = self.ids[item] = len(self.names)
+            self.names.append(item)
+            self.asks.append([])
+            self.listed_pos.append(-1)
+            for counters in (self.depth, self.listed_gil, self.traded_units, self.traded_gil):
+                counters.append(0)
+        return item_id
+
+    def add_listing(self, item, qty, total_price, seller):
+        item_id = self._item_id(item)
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.slot_item[slot] = item_id
+            self.slot_qty[slot] = qty
+            self.slot_price[slot] = total_price
+        else:
+            slot = len(self.slot_item)
+            self.slot_item.append(item_id)
+            self.slot_qty.append(qty)
+            self.slot_price.append(total_price)
+
+        heapq.heappush(self.asks[item_id], (total_price / qty, slot))
+        if self.listed_pos[item_id] < 0:
+            self.listed_pos[item_id] = len(self.listed)
+            self.listed.append(self.names[item_id])
+        self.depth[item_id] += qty
+        self.listed_gil[item_id] += total_price
+        return slot
+
+    def listed_items(self):
+        return self.listed
+
+    def best_ask(self, item):
+        asks = self.asks[self.ids[item]]
+        return (asks[0][1], asks[0][0]) if asks else None
+
+    def buy(self, slot, buyer):
+        item_id = self.slot_item[slot]
+        heapq.heappop(self.asks[item_id])       # bots only ever buy the best ask
+        qty = self.slot_qty[slot]
+        price = self.slot_price[slot]
+        self.free_slots.append(slot)
+
+        self.depth[item_id] -= qty
+        self.listed_gil[item_id] -= price
+        self.traded_units[item_id] += qty
+        self.traded_gil[item_id] += price
+        if self.rollups is not None:
+            self.rollups.add(self.names[item_id], price / qty, qty, self.clock())
+
+        if not self.asks[item_id]:
+            # Swap-remove from the listed items
+            pos = self.listed_pos[item_id]
+            last = self.listed.pop()
+            if pos < len(self.listed):
+                self.listed[pos] = last
+                self.listed_pos[self.ids[last]] = pos
+            self.listed_pos[item_id] = -1
+        return True
+
+    def open_listings(self):
+        return len(self.slot_item) - len(self.free_slots)
+
+
+# ==========================================
+# LIVE MARKET
+# Same interface over the app's CloudAuthServer (market cache + storage).
+# ==========================================
+
+class LiveMarket:
+    def __init__(self, server):
+        self.server = server
+
+    def add_listing(self, item, qty, total_price, seller):
+        self.server.list_item_to_cloud(item, total_price, seller, qty=qty)
+
+    def listed_items(self):
+        return self.server.market.items()
+
+    def best_ask(self, item):
+        asks = self.server.market.best_asks(item)
+        if not asks:
+            return None
+        return asks[0]['id'], asks[0]['price'] / asks[0].get('qty', 1)
+
+    def buy(self, listing_id, buyer):
+        ok, _, _ = self.server.buy_item_from_cloud(listing_id, buyer)
+        return ok
+
+
+# ==========================================
+# SCHEDULER
+# Every web worker runs a scheduler, but only the one holding the leader
+# lease ticks bots. Agents are independent engines ticked on a fixed-rate
+# schedule (with jitter) on a small thread pool. Controls live in storage
+# so any worker can change them; the leader reads them on each renewal.
+# ==========================================
+
+class _Agent:
+    def __init__(self, engine, due):
+        self.engine = engine
+        self.due = due
+        self.future = None
+
+
+class EconomyScheduler:
+    def __init__(self, make_engine, lease, storage, config_path="economy/config",
+                 interval=4.5, jitter=1.5, agents=1, max_workers=4):
+        self.make_engine = make_engine      # make_engine(agent_index) -> EconomyEngine
+        self.lease = lease
+        self.storage = storage
+        self.config_path = config_path
+        self.defaults = {"enabled": True, "interval": interval, "agents": agents}
+        self.config = dict(self.defaults)
+        self.jitter = jitter
+        self.is_leader = False
+        self.ticks = 0
+        self.skipped = 0        # ticks dropped because the agent's previous tick was still running
+        self._agents = []
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="economy")
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+
+    # --- Controls (any worker) ---
+
+    def configure(self, enabled=None, interval=None, agents=None):
+        fields = {}
+        if enabled is not None:
+            fields["enabled"] = bool(enabled)
+        if interval is not None:
+            if interval <= 0:
+                raise ValueError("interval must be positive")
+            fields["interval"] = float(interval)
+        if agents is not None:
+            if agents < 0:
+                raise ValueError("agents must be >= 0")
+            fields["agents"] = int(agents)
+        if fields:
+            self.storage.patch(self.config_path, fields)
+            self.config.update(fields)
+            self._wake.set()
+        return dict(self.config)
+
+    def status(self):
+        return dict(
+            self.config,
+            leader=self.lease.current_holder(),
+            this_worker=self.lease.holder,
+            is_leader=self.is_leader,
+            ticks=self.ticks,
+            skipped=self.skipped,
+        )
+
+    # --- Leader loop ---
+
+    def _renew(self):
+        try:
+            self.is_leader = self.lease.acquire()
+            stored = self.storage.get(self.config_path) or {}
+            self.config = dict(self.defaults, **stored)
+        except Exception as e:
+            print(f"Economy lease error: {e}")
+            metrics.ERRORS.inc("economy_lease")
+            self.is_leader = False
+        if not self.is_leader or not self.config["enabled"]:
+            self._agents = []
+            return
+
+        # Grow or shrink the agent pool; new agents start at staggered offsets
+        now = time.monotonic()
+        wanted = self.config["agents"]
+        del self._agents[wanted:]
+        while len(self._agents) < wanted:
+            engine = self.make_engine(len(self._agents))
+            self._agents.append(_Agent(engine, now + random.uniform(0, self.config["interval"])))
+
+    def _run_due(self, now):
+        interval = self.config["interval"]
+        jitter = min(self.jitter, interval / 2)
+        for agent in self._agents:
+            if agent.due > now:
+                continue
+            if agent.future is None or agent.future.done():
+                agent.future = self._pool.submit(self._tick, agent.engine)
+                self.ticks += 1
+            else:
+                self.skipped += 1
+            # Fixed rate: the next slot follows the scheduled one, not the tick's end
+            agent.due += interval + random.uniform(-jitter, jitter)
+            if agent.due < now:
+                agent.due = now + interval      # fell behind; skip missed slots instead of bursting
+
+    def _tick(self, engine):
+        try:
+            engine.tick()
+            metrics.ECONOMY_TICKS.inc("ok")
+        except Exception as e:
+            print(f"Economy Error: {e}")
+            metrics.ECONOMY_TICKS.inc("error")
+
+    def run(self):
+        renew_every = self.lease.ttl / 3
+        next_renewal = 0
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            if now >= next_renewal or self._wake.is_set():
+                self._wake.clear()
+                self._renew()
+                next_renewal = now + renew_every
+            self._run_due(now)
+            wake_at = min([next_renewal] + [a.due for a in self._agents])
+            self._wake.wait(max(wake_at - time.monotonic(), 0.01))
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        self._pool.shutdown(wait=False)
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                self.lease.release()
+            except Exception as e:
+                print(f"Economy lease release error: {e}")
+
+
+# ==========================================
+# OFFLINE SIMULATION CLI
+# ==========================================
+
+SECONDS_PER_TICK = 4.5      # live loop sleeps uniform(3, 6) between ticks
+
+CSV_FIELDS = [
+    "tick", "sim_hours", "item", "best_ask", "avg_trade_price",
+    "depth_units", "listed_gil", "traded_units", "traded_gil",
+]
+
+
+def simulate(ticks, seed=None, sample_every=10000, pricing="reference", history_weight=0.5, window=3600):
+    """Run offline and yield one row per item every `sample_every` ticks.
+
+    pricing="history" anchors bots on the rolling average of simulated sales
+    (as the live app does) instead of the static reference prices.
+    """
+    engine = None
+    clock = lambda: engine.ticks * SECONDS_PER_TICK
+    if pricing == "history":
+        rollups = Rollups()
+        market = ArrayMarket(BOT_LISTABLE_ITEMS, rollups, clock)
+        policy = HistoryPricing(lambda item: rollups.average(item, window, clock()), history_weight).policy()
+    else:
+        market = ArrayMarket(BOT_LISTABLE_ITEMS)
+        policy = BotPolicy()
+    engine = EconomyEngine(policy, market, random.Random(seed))
+    last_units = [0] * len(market.names)
+    last_gil = [0] * len(market.names)
+
+    while engine.ticks < ticks:
+        engine.run(min(sample_every, ticks - engine.ticks))
+        for item_id, item in enumerate(market.names):
+            ask = market.best_ask(item)
+            units = market.traded_units[item_id] - last_units[item_id]
+            gil = market.traded_gil[item_id] - last_gil[item_id]
+            last_units[item_id] = market.traded_units[item_id]
+            last_gil[item_id] = market.traded_gil[item_id]
+            yield {
+                "tick": engine.ticks,
+                "sim_hours": round(engine.ticks * SECONDS_PER_TICK / 3600, 2),
+                "item": item,
+                "best_ask": round(ask[1], 2) if ask else "",
+                "avg_trade_price": round(gil / units, 2) if units else "",
+                "depth_units": market.depth[item_id],
+                "listed_gil": market.listed_gil[item_id],
+                "traded_units": market.traded_units[item_id],
+                "traded_gil": market.traded_gil[item_id],
+            }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ticks", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--sample-every", type=int, default=10000, help="ticks between samples")
+    parser.add_argument("--out", help="CSV file for price curves (default: stdout)")
+    parser.add_argument("--pricing", choices=("reference", "history"), default="reference",
+                        help="bots price from static reference values or the rolling sale average")
+    parser.add_argument("--history-weight", type=float, default=0.5, help="weight of the rolling average")
+    args = parser.parse_args(argv)
+
+    out = open(args.out, "w", newline="") if args.out else sys.stdout
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+
+    start = time.perf_counter()
+    last = {}
+    for row in simulate(args.ticks, args.seed, args.sample_every, args.pricing, args.history_weight):
+        writer.writerow(row)
+        last[row["item"]] = row
+    elapsed = time.perf_counter() - start
+    if args.out:
+        out.close()
+
+    total_listed = sum(r["listed_gil"] for r in last.values())
+    total_traded = sum(r["traded_gil"] for r in last.values())
+    print(
+        f"{args.ticks:,} ticks (~{args.ticks * SECONDS_PER_TICK / 86400:.1f} sim days) in {elapsed:.1f}s "
+        f"({args.ticks / elapsed:,.0f} ticks/s); gil listed {total_listed:,}, traded {total_traded:,}",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
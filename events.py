@@ -0,0 +1,115 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+# ==========================================
+# IN-PROCESS EVENT BUS
+# Publishers (market cache, leaderboard) push small delta events; each
+# server-sent-events stream owns a bounded queue. A short replay buffer
+# lets reconnecting clients catch up from Last-Event-ID.
+# ==========================================
+
+
+class Subscription:
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+
+class EventBus:
+    def __init__(self, max_queue=256, replay_size=512):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._recent = collections.deque(maxlen=replay_size)
+        self._last_id = 0
+        # Event ids are "<epoch>.<n>"; a different epoch (restart, other worker) means resync
+        self.epoch = os.urandom(4).hex()
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self._last_id += 1
+            event = (self._last_id, event_type, data)
+            self._recent.append(event)
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(event)
+            except queue.Full:
+                # Slow consumer: its stream ends and the client reconnects from Last-Event-ID
+                sub.overflowed = True
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def event_id(self, n):
+        return f"{self.epoch}.{n}"
+
+    def _parse_event_id(self, event_id):
+        epoch, _, n = (event_id or "").partition(".")
+        if epoch != self.epoch or not n.isdigit():
+            return None
+        return int(n)
+
+    def subscribe(self, last_event_id=None):
+        """Register a stream. Returns (subscription, current event number, missed events),
+        missed is None when the client can't be caught up and must resync."""
+        sub = Subscription(self.max_queue)
+        with self._lock:
+            self._subscribers.add(sub)
+            if not last_event_id:
+                return sub, self._last_id, []
+            last_seen = self._parse_event_id(last_event_id)
+            oldest = self._recent[0][0] if self._recent else self._last_id + 1
+            if last_seen is None or last_seen > self._last_id or oldest > last_seen + 1:
+                return sub, self._last_id, None
+            return sub, self._last_id, [e for e in self._recent if e[0] > last_seen]
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+
+def format_sse(event_id, event_type, data):
+    payload = json.dumps(data, separators=(',', ':'))
+    return f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n"
+
+
+def _frame(bus, event):
+    n, event_type, data = event
+    return format_sse(bus.event_id(n), event_type, data)
+
+
+def stream_events(bus, last_event_id=None, heartbeat=15.0, max_duration=300.0):
+    """Generator of SSE frames. Ends after `max_duration` so sync workers get recycled;
+    EventSource reconnects on its own and resumes from Last-Event-ID."""
+    sub, current_id, missed = bus.subscribe(last_event_id)
+    try:
+        yield "retry: 3000\n\n"
+        if missed is None:
+            yield format_sse(bus.event_id(current_id), "resync", {})
+        else:
+            for event in missed:
+                yield _frame(bus, event)
+
+        deadline = time.monotonic() + max_duration
+        while time.monotonic() < deadline:
+            if sub.overflowed:
+                # Drop the stream; the reconnect finds the gap and sends "resync"
+                return
+            try:
+                event = sub.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            yield _frame(bus, event)
+    finally:
+        bus.unsubscribe(sub)
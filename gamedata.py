@@ -0,0 +1,104 @@
+import threading
+
+# ==========================================
+# GAME DATA
+# Static recipe, material and bot tables shared by the web app and the
+# offline economy simulator.
+# ==========================================
+
+# Comprehensive Bonecraft recipes (Same as original)
+BONECRAFT_RECIPES = [
+    # Tier 5 (Amateur - Skill 1-10)
+    {"name": "Bone Hairpin", "price": 100, "tier": 5, "material": "Bone Chip", "qty": 1},
+    {"name": "Shell Ring", "price": 200, "tier": 5, "material": "Seashell", "qty": 1},
+    
+    # Tier 4 (Recruit - Skill 11-20)
+    {"name": "Gelatin", "price": 300, "tier": 4, "material": "Chicken Bone", "qty": 2},
+    {"name": "Bone Ring", "price": 450, "tier": 4, "material": "Sheep Tooth", "qty": 1},
+    {"name": "Bone Mask", "price": 600, "tier": 4, "material": "Giant Femur", "qty": 1},
+    {"name": "Carapace Powder", "price": 800, "tier": 4, "material": "Beetle Shell", "qty": 2},
+    
+    # Tier 3 (Initiate/Novice - Skill 21-40)
+    {"name": "Beetle Ring", "price": 1200, "tier": 3, "material": "Beetle Jaw", "qty": 1},
+    {"name": "Beetle Earring", "price": 1500, "tier": 3, "material": "Beetle Jaw", "qty": 1},
+    {"name": "Horn Ring", "price": 2500, "tier": 3, "material": "Ram Horn", "qty": 1},
+    {"name": "Turtle Shield", "price": 5000, "tier": 3, "material": "Turtle Shell", "qty": 1},
+    
+    # Tier 2 (Apprentice/Journeyman - Skill 41-60)
+    {"name": "Carapace Helm", "price": 8500, "tier": 2, "material": "Turtle Shell", "qty": 2},
+    {"name": "Scorpion Ring", "price": 15000, "tier": 2, "material": "Scorpion Shell", "qty": 1},
+    
+    # Tier 1 (Craftsman/Artisan - Skill 61-80)
+    {"name": "Demon's Ring", "price": 30000, "tier": 1, "material": "Demon Horn", "qty": 1},
+    {"name": "Tigerfang", "price": 45000, "tier": 1, "material": "Black Tiger Fang", "qty": 2},
+    {"name": "Coral Gorget", "price": 60000, "tier": 1, "material": "Coral Fragment", "qty": 3},
+
+    # Tier 0 (Adept/Veteran - Skill 81-100+)
+    {"name": "Dragon Mask", "price": 120000, "tier": 0, "material": "Wyvern Scales", "qty": 2},
+    {"name": "Trumpet Ring", "price": 500000, "tier": 0, "material": "Titanictus Shell", "qty": 1},
+    {"name": "Chronos Tooth", "price": 800000, "tier": 0, "material": "Titanictus Shell", "qty": 1},
+    {"name": "Gavial Mask", "price": 1000000, "tier": 0, "material": "Gavial Fish", "qty": 1},
+]
+
+# All primary materials used in the recipes, available for bot listing/purchase
+BOT_LISTABLE_ITEMS = [
+    "Bone Chip", "Seashell", "Chicken Bone", "Sheep Tooth", "Giant Femur", 
+    "Beetle Shell", "Beetle Jaw", "Ram Horn", "Turtle Shell", "Scorpion Shell", 
+    "Demon Horn", "Black Tiger Fang", "Coral Fragment", "Wyvern Scales", 
+    "Titanictus Shell", "Gavial Fish"
+]
+
+BOT_NAMES = ["SephirothXX", "VanaFan99", "CrafterMain", "GilBuyer", "ChocoRacer"]
+
+# Bot base unit price per material (the bots' idea of fair value)
+MATERIAL_BASE_PRICES = {
+    "Bone Chip": 100, "Seashell": 100,
+    "Chicken Bone": 500, "Sheep Tooth": 500, "Giant Femur": 500,
+    "Beetle Shell": 1500, "Beetle Jaw": 1500, "Ram Horn": 1500,
+    "Turtle Shell": 3000, "Scorpion Shell": 3000,
+    "Demon Horn": 8000, "Black Tiger Fang": 8000, "Coral Fragment": 8000,
+    "Wyvern Scales": 25000, "Titanictus Shell": 25000, "Gavial Fish": 25000,
+}
+
+# Fair unit value of every known item: materials, crafted items and their HQ (+1) versions
+REFERENCE_PRICES = dict(MATERIAL_BASE_PRICES)
+for _r in BONECRAFT_RECIPES:
+    REFERENCE_PRICES[_r["name"]] = _r["price"]
+    REFERENCE_PRICES[f"HQ {_r['name']} (+1)"] = _r["price"] * 3
+
+# Interned item ids: caches hold small ints (and index arrays by them) instead of
+# name strings. Materials come first so the common inventories stay short.
+ITEM_NAMES = list(BOT_LISTABLE_ITEMS)
+for _r in BONECRAFT_RECIPES:
+    ITEM_NAMES += [_r["name"], f"HQ {_r['name']} (+1)"]
+ITEM_IDS = {name: i for i, name in enumerate(ITEM_NAMES)}
+_item_ids_lock = threading.Lock()
+
+
+def item_id(name):
+    """Id of an item name; names not in the tables (old data) get the next free id."""
+    i = ITEM_IDS.get(name)
+    if i is None:
+        with _item_ids_lock:
+            i = ITEM_IDS.get(name)
+            if i is None:
+                i = len(ITEM_NAMES)
+                ITEM_NAMES.append(name)     # before ITEM_IDS, so readers never see a dangling id
+                ITEM_IDS[name] = i
+    return i
+
+
+def item_name(i):
+    return ITEM_NAMES[i]
+
+
+def reference_price(item_name):
+    """Fair unit value of an item, 0 if unknown."""
+    price = REFERENCE_PRICES.get(item_name)
+    if price is not None:
+        return price
+    # Loose match for names we don't know exactly (same rule as the old bot loop)
+    for r in BONECRAFT_RECIPES:
+        if r["name"] in item_name:
+            return r["price"] * (3 if "HQ" in item_name else 1)
+    return 0
@@ -0,0 +1,171 @@
+import collections
+import threading
+import time
+
+from storage import push_id_at
+
+# ==========================================
+# PRICE HISTORY
+# Every sale is appended to /trades/<push id> = {item, price, qty, unit_price,
+# time}. Each process folds trades into per-item OHLC + volume candles at
+# 1m / 1h / 1d, kept in fixed-size ring buffers, so reads never touch raw
+# trades. Other workers' sales are pulled incrementally by push ID range.
+# ==========================================
+
+# name -> (seconds per candle, candles kept)
+RESOLUTIONS = {
+    "1m": (60, 1440),       # one day
+    "1h": (3600, 720),      # thirty days
+    "1d": (86400, 365),     # one year
+}
+
+# Candle fields: bucket start, open, high, low, close, units, gil, trades
+START, OPEN, HIGH, LOW, CLOSE, UNITS, GIL, TRADES = range(8)
+
+
+def candle_dict(candle):
+    return {
+        "t": candle[START], "open": candle[OPEN], "high": candle[HIGH], "low": candle[LOW],
+        "close": candle[CLOSE], "volume": candle[UNITS], "gil": candle[GIL], "trades": candle[TRADES],
+    }
+
+
+class Rollups:
+    """In-memory candles for every item and resolution. Not thread-safe on its own."""
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = dict(resolutions)
+        self._series = {name: {} for name in self.resolutions}     # resolution -> item -> deque
+
+    def add(self, item, unit_price, qty, timestamp):
+        for name, (width, keep) in self.resolutions.items():
+            series = self._series[name].get(item)
+            if series is None:
+                series = self._series[name][item] = collections.deque(maxlen=keep)
+            _fold(series, int(timestamp // width * width), unit_price, qty)
+
+    def candles(self, item, resolution, limit=None, since=None):
+        """Oldest first."""
+        series = self._series[resolution].get(item) or ()
+        result = [c for c in series if since is None or c[START] >= since]
+        if limit is not None:
+            result = result[-limit:]
+        return result
+
+    def average(self, item, window, now):
+        """Volume weighted unit price over the last `window` seconds (None without trades)."""
+        series = self._series["1m"].get(item)
+        if not series:
+            return None
+        cutoff = now - window
+        units = gil = 0
+        for candle in reversed(series):
+            if candle[START] + 60 <= cutoff:
+                break
+            units += candle[UNITS]
+            gil += candle[GIL]
+        return gil / units if units else None
+
+    def items(self):
+        return list(self._series["1m"])
+
+
+def _fold(series, start, unit_price, qty):
+    # Trades arrive roughly in time order, so this is almost always the last candle
+    i = len(series) - 1
+    while i >= 0 and series[i][START] > start:
+        i -= 1
+    if i >= 0 and series[i][START] == start:
+        candle = series[i]
+        candle[HIGH] = max(candle[HIGH], unit_price)
+        candle[LOW] = min(candle[LOW], unit_price)
+        if i == len(series) - 1:
+            candle[CLOSE] = unit_price      # a late trade doesn't move an older close
+        candle[UNITS] += qty
+        candle[GIL] += unit_price * qty
+        candle[TRADES] += 1
+        return
+    candle = _new_candle(start, unit_price, qty)
+    if i == len(series) - 1:
+        series.append(candle)
+        return
+    if len(series) == series.maxlen:
+        if i < 0:
+            return      # older than everything kept
+        series.popleft()
+        i -= 1
+    series.insert(i + 1, candle)
+
+
+def _new_candle(start, unit_price, qty):
+    return [start, unit_price, unit_price, unit_price, unit_price, qty, unit_price * qty, 1]
+
+
+class PriceHistory:
+    def __init__(self, storage, collection="trades", ttl=5.0, warm_days=7, overlap=30.0):
+        self.storage = storage
+        self.collection = collection
+        self.ttl = ttl
+        self.warm_days = warm_days
+        self.overlap = overlap          # re-read this many seconds back for late / skewed push IDs
+        self.rollups = Rollups()
+        self._lock = threading.RLock()
+        self._seen = {}                 # trade key -> time, for keys inside the overlap window
+        self._synced_at = None          # wall clock of the last pull
+        self._polled_at = None          # monotonic, for the ttl
+
+    def new_trade(self, listing, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        qty = listing.get("qty", 1)
+        return {
+            "item": listing["item"],
+            "price": listing["price"],
+            "qty": qty,
+            "unit_price": listing["price"] / qty,
+            "time": timestamp,
+        }
+
+    def add(self, key, trade):
+        """Fold in a trade the caller already wrote to /<collection>/<key>."""
+        with self._lock:
+            self._fold(key, trade)
+
+    def _fold(self, key, trade):
+        if key in self._seen:
+            return
+        self._seen[key] = trade["time"]
+        self.rollups.add(trade["item"], trade["unit_price"], trade["qty"], trade["time"])
+
+    def _pull(self, page_size=1000):
+        now = time.time()
+        since = now - self.warm_days * 86400 if self._synced_at is None else self._synced_at - self.overlap
+        start_at = push_id_at(since)
+        while True:
+            page = self.storage.query(self.collection, start_at=start_at, limit=page_size)
+            for key, trade in page:
+                if trade and key != start_at:
+                    self._fold(key, trade)
+            if len(page) < page_size:
+                break
+            start_at = page[-1][0]
+        self._synced_at = now
+        # Keys older than the overlap window can't be re-read anymore
+        cutoff = now - 2 * self.overlap
+        self._seen = {k: t for k, t in self._seen.items() if t >= cutoff}
+
+    def _ensure_fresh(self):
+        if self._polled_at is None or time.monotonic() - self._polled_at >= self.ttl:
+            self._pull()
+            self._polled_at = time.monotonic()
+
+    # --- Reads ---
+
+    def candles(self, item, resolution="1m", limit=None, since=None):
+        with self._lock:
+            self._ensure_fresh()
+            return [candle_dict(c) for c in self.rollups.candles(item, resolution, limit, since)]
+
+    def average(self, item, window=3600):
+        with self._lock:
+            self._ensure_fresh()
+            return self.rollups.average(item, window, time.time())
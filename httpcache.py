@@ -0,0 +1,100 @@
+import collections
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:     # optional: gzip only without it
+    brotli = None
+
+# ==========================================
+# RESPONSE CACHING
+# Serialized JSON bodies are built once per data version and kept with a
+# content-hash ETag and their compressed variants, so polling clients cost
+# neither a re-serialization nor a re-compression until the data changes.
+# ETags come from the bytes, not the version counter, so they agree across
+# workers that hold the same data.
+# ==========================================
+
+# Bodies smaller than this aren't worth a Content-Encoding
+MIN_COMPRESS_BYTES = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(value):
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def content_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def choose_encoding(accept_encodings):
+    """Best content coding the client accepts (werkzeug's request.accept_encodings), or None."""
+    if brotli is not None and accept_encodings["br"]:
+        return "br"
+    if accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+class Payload:
+    """A serialized JSON body with its ETag; compressed variants are made on first use."""
+
+    def __init__(self, body):
+        self.body = body
+        self.hash = content_hash(body)
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        data = self._encoded.get(encoding)
+        if data is None:
+            # Two threads may both compress once; the results are identical
+            data = self._encoded[encoding] = compress(self.body, encoding)
+        return data
+
+    @classmethod
+    def of(cls, value):
+        return cls(dumps(value))
+
+
+class PayloadCache:
+    """Payloads by key, valid while the caller's data version is unchanged and for at
+    most `max_age` seconds (for content that also changes with time, like expiry).
+    Least recently used keys are dropped past `max_entries`."""
+
+    def __init__(self, max_entries=256, max_age=30.0):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()      # key -> (version, built_at, payload)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """Cached payload for `key` at `version`, else `build()` (a JSON-able value) serialized."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and now - entry[1] < self.max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        payload = Payload.of(build())
+        with self._lock:
+            self._entries[key] = (version, now, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
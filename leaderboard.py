@@ -0,0 +1,129 @@
+import bisect
+
+from storage import CollectionCache, increment
+
+# ==========================================
+# LEADERBOARD
+# Compact projection at /leaderboard/<name> = {"gil": .., "synths": ..},
+# written whenever a player's gil or synth count changes, so ranking
+# never has to read /users (password hashes, inventories and all).
+# ==========================================
+
+
+class Leaderboard(CollectionCache):
+    """Publishes "leaderboard-changed" through `on_event`."""
+
+    def __init__(self, storage, ttl=10.0, collection="leaderboard", excluded=(), on_event=None):
+        super().__init__(storage, collection, ttl, on_event)
+        self.excluded = set(excluded)
+        self._entries = {}        # name -> {"gil": .., "synths": ..}
+        self._ranking = []        # sorted (-gil, name), richest first
+
+    # --- Index maintenance (caller holds the lock) ---
+
+    def _clear(self):
+        self._entries = {}
+        self._ranking = []
+
+    def _keys(self):
+        return list(self._entries)
+
+    def _matches(self, name, entry):
+        cached = self._entries.get(name)
+        return cached is not None and cached == {"gil": entry.get("gil", 0), "synths": entry.get("synths", 0)}
+
+    def _insert(self, name, entry):
+        if name in self.excluded:
+            return
+        self.version += 1
+        self._unrank(name)
+        entry = {"gil": entry.get("gil", 0), "synths": entry.get("synths", 0)}
+        self._entries[name] = entry
+        bisect.insort(self._ranking, (-entry["gil"], name))
+        self._emit("leaderboard-changed", self._row(name))
+
+    def _discard(self, name):
+        entry = self._unrank(name)
+        if entry is not None:
+            self.version += 1
+            self._emit("leaderboard-changed", {"name": name, "removed": True})
+        return entry
+
+    def _unrank(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            key = (-entry["gil"], name)
+            i = bisect.bisect_left(self._ranking, key)
+            if i < len(self._ranking) and self._ranking[i] == key:
+                del self._ranking[i]
+        return entry
+
+    # --- Public API ---
+
+    def update(self, name, gil=None, synths=None):
+        """Record new values for a player; only changed fields are written."""
+        if name in self.excluded:
+            return
+        fields = {}
+        with self._lock:
+            current = self._entries.get(name)
+            if gil is not None and (current is None or current["gil"] != gil):
+                fields["gil"] = gil
+            if synths is not None and (current is None or current["synths"] != synths):
+                fields["synths"] = synths
+            if not fields:
+                return
+            self._insert(name, dict(current or {}, **fields))
+        self.storage.patch(f"{self.collection}/{name}", fields)
+
+    def stage_gil(self, name, delta):
+        """Apply a gil change locally and return the root-relative update that writes it,
+        for the caller to send with its own multi-path update ({} if nothing to write)."""
+        return self.stage(name, gil=delta)
+
+    def stage(self, name, gil=0, synths=0):
+        """stage_gil() for gil and synth count changes together."""
+        changes = {field: change for field, change in (("gil", gil), ("synths", synths)) if change}
+        if name in self.excluded or not changes:
+            return {}
+        with self._lock:
+            current = self._entries.get(name)
+            if current is not None:
+                self._insert(name, dict(current, **{f: current[f] + c for f, c in changes.items()}))
+        return {f"{self.collection}/{name}/{field}": increment(change) for field, change in changes.items()}
+
+    def top(self, k):
+        with self._lock:
+            self._ensure_fresh()
+            return [self._row(name) for _, name in self._ranking[:k]]
+
+    def rank(self, name):
+        """1-based position of `name` with its entry, or None if unranked."""
+        with self._lock:
+            self._ensure_fresh()
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            position = bisect.bisect_left(self._ranking, (-entry["gil"], name)) + 1
+            return dict(self._row(name), rank=position)
+
+    def _row(self, name):
+        entry = self._entries[name]
+        return {"name": name, "gil": entry["gil"], "synths": entry["synths"]}
+
+    def rebuild(self, users):
+        """Replace the projection from a full /users tree (one-off migration)."""
+        projection = {}
+        for name, profile in (users or {}).items():
+            if name in self.excluded or "data" not in profile:
+                continue
+            d = profile["data"]
+            projection[name] = {"gil": d.get("gil", 0), "synths": d.get("total_synths", 0)}
+        return self.replace(projection)
+
+    def replace(self, projection):
+        """Overwrite the whole projection with {name: {"gil", "synths"}} (e.g. from a ledger replay)."""
+        projection = {name: entry for name, entry in projection.items() if name not in self.excluded}
+        self.storage.put(self.collection, projection)
+        self.invalidate()
+        return len(projection)
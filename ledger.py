@@ -0,0 +1,280 @@
+import json
+import threading
+import time
+
+import metrics
+from storage import generate_push_id, push_id_at
+
+# ==========================================
+# EVENT LEDGER
+# Append-only record of every state change: synths, listings, purchases,
+# gil transfers. Each worker buffers events and writes them as one segment
+# /ledger_segments/<push id> = {"worker": .., "events": [..]} per batch.
+# Periodic snapshots of the folded state (/ledger_snapshots/<segment key>,
+# latest one named at /ledger/latest_snapshot) make replay snapshot + tail.
+# Segments are never rewritten.
+#
+# Event: {"type", "t" (unix seconds), "deltas": {player: {"gil", "synths",
+# "items": {item: n}}}, "opened": {listing id: listing}, "closed": [listing
+# ids], ..detail}. Folding only adds deltas and opens / closes listings, so
+# the order segments from different workers arrive in doesn't matter.
+# ==========================================
+
+# Closed listing ids are remembered this long (seconds), so a "list" that
+# replays after its "buy" (clock skew between workers) stays closed
+CLOSED_MEMORY = 3600
+
+
+def delta(gil=0, synths=0, items=None):
+    """One player's change, leaving out what didn't change."""
+    change = {}
+    if gil:
+        change["gil"] = gil
+    if synths:
+        change["synths"] = synths
+    items = {k: v for k, v in (items or {}).items() if v}
+    if items:
+        change["items"] = items
+    return change
+
+
+class LedgerState:
+    """Players and open listings folded from events."""
+
+    def __init__(self, players=None, listings=None, closed=None, events=0):
+        self.players = players or {}        # name -> {"gil", "synths", "inventory"}
+        self.listings = listings or {}      # listing id -> listing
+        self.closed = closed or {}          # listing id -> time closed
+        self.events = events                # events folded in, ever
+
+    def player(self, name):
+        state = self.players.get(name)
+        if state is None:
+            state = self.players[name] = {"gil": 0, "synths": 0, "inventory": {}}
+        return state
+
+    def apply(self, event):
+        for name, change in (event.get("deltas") or {}).items():
+            state = self.player(name)
+            state["gil"] += change.get("gil", 0)
+            state["synths"] += change.get("synths", 0)
+            inventory = state["inventory"]
+            for item, n in (change.get("items") or {}).items():
+                qty = inventory.get(item, 0) + n
+                if qty:
+                    inventory[item] = qty
+                else:
+                    inventory.pop(item, None)
+        for listing_id in event.get("closed") or ():
+            self.listings.pop(listing_id, None)
+            self.closed[listing_id] = event["t"]
+        for listing_id, listing in (event.get("opened") or {}).items():
+            if listing_id not in self.closed:
+                self.listings[listing_id] = listing
+        self.events += 1
+
+    def forget_closed(self, before):
+        self.closed = {k: t for k, t in self.closed.items() if t >= before}
+
+    def leaderboard(self, excluded=()):
+        """The /leaderboard projection: {name: {"gil", "synths"}}."""
+        return {
+            name: {"gil": p["gil"], "synths": p["synths"]}
+            for name, p in self.players.items() if name not in excluded
+        }
+
+    def to_dict(self):
+        return {"players": self.players, "listings": self.listings, "closed": self.closed, "events": self.events}
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        players = {
+            name: {"gil": p.get("gil", 0), "synths": p.get("synths", 0), "inventory": dict(p.get("inventory") or {})}
+            for name, p in (data.get("players") or {}).items()
+        }
+        return cls(players, dict(data.get("listings") or {}), dict(data.get("closed") or {}), data.get("events", 0))
+
+
+def replay(events, state=None, rollups=None):
+    """Fold events into `state` (a new one by default) and every purchase into
+    `rollups` (a history.Rollups, for rebuilding price history)."""
+    state = LedgerState() if state is None else state
+    for event in events:
+        state.apply(event)
+        if rollups is not None and event.get("type") == "buy":
+            rollups.add(event["item"], event["price"] / event["qty"], event["qty"], event["t"])
+    return state
+
+
+class Ledger:
+    def __init__(self, storage, collection="ledger", batch_size=500, flush_interval=2.0,
+                 snapshot_lag=60.0, keep_snapshots=3, max_buffer=100000):
+        self.storage = storage
+        self.collection = collection                    # small metadata
+        self.segments_path = f"{collection}_segments"   # top-level, so key range queries stay cheap
+        self.snapshots_path = f"{collection}_snapshots"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Snapshots stop this many seconds short of now, so a segment a slower worker
+        # writes a little late still lands in the tail instead of behind the snapshot
+        self.snapshot_lag = snapshot_lag
+        self.keep_snapshots = keep_snapshots
+        self.max_buffer = max_buffer
+        self.worker = metrics.WORKER
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = []
+        self._stopped = threading.Event()
+
+    # --- Writing ---
+
+    def record(self, event_type, deltas=None, opened=None, closed=None, **detail):
+        event = dict(detail, type=event_type, t=time.time())
+        deltas = {name: change for name, change in (deltas or {}).items() if change}
+        if deltas:
+            event["deltas"] = deltas
+        if opened:
+            event["opened"] = opened
+        if closed:
+            event["closed"] = list(closed)
+        with self._lock:
+            self._buffer.append(event)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write buffered events as one segment. Kept for the next try if that fails."""
+        with self._flush_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return True
+            try:
+                self.storage.put(f"{self.segments_path}/{generate_push_id()}", {"worker": self.worker, "events": events})
+                return True
+            except Exception as e:
+                print(f"Ledger flush error ({len(events)} events kept): {e}")
+                metrics.ERRORS.inc("ledger")
+                with self._lock:
+                    self._buffer = (events + self._buffer)[-self.max_buffer:]
+                return False
+
+    def run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    # --- Reading ---
+
+    def segments(self, after=None, before=None, page_size=200):
+        """(key, segment) oldest first, keys strictly after `after` and before `before`."""
+        start_at = after
+        while True:
+            page = self.storage.query(self.segments_path, start_at=start_at, limit=page_size)
+            for key, segment in page:
+                if key == start_at:
+                    continue
+                if before is not None and key >= before:
+                    return
+                yield key, segment
+            if len(page) < page_size:
+                return
+            start_at = page[-1][0]
+
+    def events(self, after=None, before=None):
+        for _, segment in self.segments(after, before):
+            yield from (segment or {}).get("events") or ()
+
+    def latest_snapshot(self):
+        """(segment key it covers through, LedgerState); (None, empty state) before the first."""
+        key = self.storage.get(f"{self.collection}/latest_snapshot")
+        snapshot = self.storage.get(f"{self.snapshots_path}/{key}") if key else None
+        if not snapshot:
+            return None, LedgerState()
+        return snapshot.get("through"), LedgerState.from_dict(snapshot.get("state"))
+
+    def replay(self):
+        """Current state: the latest snapshot plus every segment after it."""
+        through, state = self.latest_snapshot()
+        return replay(self.events(after=through), state)
+
+    # --- Snapshots ---
+
+    def _write_snapshot(self, through, state):
+        key = through or push_id_at(0)
+        self.storage.patch("", {
+            f"{self.snapshots_path}/{key}": {"through": through, "time": time.time(), "state": state.to_dict()},
+            f"{self.collection}/snapshot_index/{key}": True,    # so pruning doesn't read states
+            f"{self.collection}/latest_snapshot": key,
+        })
+        # Older snapshots beyond `keep_snapshots` go; segments stay for the audit trail
+        old = sorted(self.storage.get(f"{self.collection}/snapshot_index") or {})[:-self.keep_snapshots]
+        if old:
+            updates = {}
+            for k in old:
+                updates[f"{self.snapshots_path}/{k}"] = None
+                updates[f"{self.collection}/snapshot_index/{k}"] = None
+            self.storage.patch("", updates)
+        return key
+
+    def snapshot(self, now=None):
+        """Fold segments older than `snapshot_lag` into a new snapshot. Returns its key,
+        or None when there was nothing new to fold."""
+        now = time.time() if now is None else now
+        through, state = self.latest_snapshot()
+        last = None
+        for last, segment in self.segments(after=through, before=push_id_at(now - self.snapshot_lag)):
+            for event in (segment or {}).get("events") or ():
+                state.apply(event)
+        if last is None:
+            return None
+        state.forget_closed(now - CLOSED_MEMORY)
+        return self._write_snapshot(last, state)
+
+    def bootstrap(self, users, listings, excluded=()):
+        """First snapshot from the current /users and /auction_house trees, for data that
+        predates the ledger. The trees already include every event written so far, so
+        the snapshot covers all existing segments. Does nothing once a snapshot exists."""
+        if self.storage.get(f"{self.collection}/latest_snapshot"):
+            return False
+        self.flush()
+        through = None
+        for through, _ in self.segments():
+            pass
+        state = LedgerState()
+        for name, profile in (users or {}).items():
+            data = (profile or {}).get("data")
+            if name in excluded or not data:
+                continue
+            state.players[name] = {
+                "gil": data.get("gil", 0),
+                "synths": data.get("total_synths", 0),
+                "inventory": {k: v for k, v in (data.get("inventory") or {}).items() if v},
+            }
+        state.listings = dict(listings or {})
+        self._write_snapshot(through, state)
+        return True
+
+    # --- Offline ---
+
+    def export(self, path):
+        """Write every event, oldest segment first, to a JSON lines file. Returns the count."""
+        count = 0
+        with open(path, "w") as f:
+            for event in self.events():
+                f.write(json.dumps(event, separators=(",", ":")) + "\n")
+                count += 1
+        return count
+
+
+def read_events(path):
+    """Events from a file written by Ledger.export."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,377 @@
+import base64
+import bisect
+import datetime
+import json
+import math
+import sys
+import time
+
+from gamedata import ITEM_IDS, item_id, item_name
+from storage import CollectionCache, increment, push_id_at
+
+# ==========================================
+# AUCTION HOUSE CACHE
+# In-process copy of /auction_house with per-item order books.
+# ==========================================
+
+SORT_ORDERS = ("time", "price", "-price")
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Sorts after any listing time, used as an upper bisect bound
+_MAX_TIME = math.inf
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def listing_expires(listing, default_ttl):
+    """Unix time a listing expires. Listings from before expiry existed get `default_ttl`
+    from their listing time."""
+    expires = listing.get('expires')
+    if expires is not None:
+        return expires
+    return listed_at(listing) + default_ttl
+
+
+def listed_at(listing):
+    """Unix time (whole seconds) a stored listing was made; 0 if it can't tell."""
+    ts = listing.get('ts')
+    if ts is not None:
+        return int(ts)
+    try:
+        return int(datetime.datetime.strptime(listing['time'], TIME_FORMAT).timestamp())
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def is_expired(listing, now=None):
+    """Only listings that carry `expires`; older ones are left to compaction."""
+    expires = listing.get('expires')
+    return expires is not None and expires <= (time.time() if now is None else now)
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return tuple(json.loads(raw))
+    except Exception:
+        raise InvalidCursor("Malformed cursor")
+
+
+class Listing:
+    """A cached listing: item as an interned id, seller name interned, times as
+    integer unix seconds. `to_dict()` gives the stored / API shape back."""
+
+    __slots__ = ("id", "item_id", "seller", "price", "qty", "time", "expires")
+
+    def __init__(self, listing_id, item_id, seller, price, qty, time, expires=None):
+        self.id = listing_id
+        self.item_id = item_id
+        self.seller = seller
+        self.price = price
+        self.qty = qty
+        self.time = time
+        self.expires = expires
+
+    @classmethod
+    def from_dict(cls, listing_id, data):
+        expires = data.get('expires')
+        return cls(
+            listing_id, item_id(data['item']), sys.intern(data.get('seller') or ""),
+            data['price'], data.get('qty', 1), listed_at(data),
+            None if expires is None else math.ceil(expires),
+        )
+
+    @property
+    def item(self):
+        return item_name(self.item_id)
+
+    def unit_price(self):
+        return self.price / (self.qty or 1)
+
+    def is_expired(self, now):
+        return self.expires is not None and self.expires <= now
+
+    def matches(self, data):
+        """Whether stored `data` describes this listing unchanged."""
+        expires = data.get('expires')
+        return (data.get('item') == self.item and data.get('price') == self.price
+                and data.get('qty', 1) == self.qty and (data.get('seller') or "") == self.seller
+                and (None if expires is None else math.ceil(expires)) == self.expires)
+
+    def to_dict(self):
+        listing = {
+            "id": self.id, "item": self.item, "price": self.price, "seller": self.seller, "qty": self.qty,
+            "time": datetime.datetime.fromtimestamp(self.time).strftime(TIME_FORMAT), "ts": self.time,
+        }
+        if self.expires is not None:
+            listing["expires"] = self.expires
+        return listing
+
+
+class OrderBook:
+    """Listings of one item (or the whole market) kept in two sorted indexes:
+    (time, id) for recency and (unit_price, time, id) for price lookups."""
+
+    def __init__(self):
+        self.by_time = []
+        self.by_price = []
+
+    def __len__(self):
+        return len(self.by_time)
+
+    def add(self, listing):
+        bisect.insort(self.by_time, (listing.time, listing.id))
+        bisect.insort(self.by_price, (listing.unit_price(), listing.time, listing.id))
+
+    def discard(self, listing):
+        _remove_sorted(self.by_time, (listing.time, listing.id))
+        _remove_sorted(self.by_price, (listing.unit_price(), listing.time, listing.id))
+
+    def keys(self, sort, min_unit=None, max_unit=None, after=None):
+        """Yield index keys in `sort` order, resuming strictly after the `after` key."""
+        if sort == "time":
+            index = self.by_time
+            hi = len(index) if after is None else bisect.bisect_left(index, after)
+            for i in range(hi - 1, -1, -1):
+                yield index[i]
+            return
+
+        index = self.by_price
+        lo = 0 if min_unit is None else bisect.bisect_left(index, (min_unit,))
+        hi = len(index) if max_unit is None else bisect.bisect_right(index, (max_unit, _MAX_TIME))
+        if sort == "price":
+            if after is not None:
+                lo = max(lo, bisect.bisect_right(index, after))
+            for i in range(lo, hi):
+                yield index[i]
+        else:
+            if after is not None:
+                hi = min(hi, bisect.bisect_left(index, after))
+            for i in range(hi - 1, lo - 1, -1):
+                yield index[i]
+
+
+def _remove_sorted(index, key):
+    i = bisect.bisect_left(index, key)
+    if i < len(index) and index[i] == key:
+        del index[i]
+
+
+class MarketCache(CollectionCache):
+    """Publishes "listing-added" / "listing-sold" through `on_event`."""
+
+    def __init__(self, storage, ttl=5.0, collection="auction_house", on_event=None):
+        super().__init__(storage, collection, ttl, on_event)
+        self._listings = {}
+        self._all = OrderBook()
+        self._books = {}          # item id -> OrderBook
+
+    # --- Index maintenance (caller holds the lock) ---
+
+    def _clear(self):
+        self._listings = {}
+        self._all = OrderBook()
+        self._books = {}
+
+    def _keys(self):
+        return list(self._listings)
+
+    def _matches(self, listing_id, listing):
+        cached = self._listings.get(listing_id)
+        return cached is not None and cached.matches(listing)
+
+    def _insert(self, listing_id, listing):
+        listing = Listing.from_dict(listing_id, listing)
+        self.version += 1
+        replaced = self._listings.pop(listing_id, None)
+        if replaced is not None:
+            self._unindex(replaced)
+        else:
+            self._emit("listing-added", listing.to_dict())
+        self._listings[listing_id] = listing
+        self._all.add(listing)
+        book = self._books.get(listing.item_id)
+        if book is None:
+            book = self._books[listing.item_id] = OrderBook()
+        book.add(listing)
+        return listing
+
+    def _discard(self, listing_id):
+        listing = self._listings.pop(listing_id, None)
+        if listing is not None:
+            self.version += 1
+            self._unindex(listing)
+            self._emit("listing-sold", {"id": listing_id, "item": listing.item})
+        return listing
+
+    def _unindex(self, listing):
+        self._all.discard(listing)
+        book = self._books[listing.item_id]
+        book.discard(listing)
+        if not book:
+            del self._books[listing.item_id]
+
+    # --- Public API ---
+
+    def add(self, listing_id, listing):
+        with self._lock:
+            self._insert(listing_id, listing)
+
+    def remove(self, listing_id):
+        with self._lock:
+            listing = self._discard(listing_id)
+            return listing.to_dict() if listing else None
+
+    def count(self):
+        with self._lock:
+            self._ensure_fresh()
+            return len(self._listings)
+
+    def items(self):
+        """Names of items that currently have at least one listing."""
+        with self._lock:
+            self._ensure_fresh()
+            return [item_name(i) for i in self._books]
+
+    def query(self, item=None, min_unit=None, max_unit=None, sort="time", limit=50, cursor=None):
+        """One page of listings plus the cursor for the next page (None at the end).
+
+        Price bounds are per unit (price / qty). With `sort="time"` they are
+        applied as a filter; price sorts seek straight to the bounds.
+        """
+        if sort not in SORT_ORDERS:
+            raise ValueError(f"Unknown sort order: {sort}")
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        after = decode_cursor(cursor) if cursor else None
+        if after is not None and (len(after) != (2 if sort == "time" else 3) or not isinstance(after[-2], int)):
+            raise InvalidCursor("Cursor does not match sort order")     # or predates integer times
+        with self._lock:
+            self._ensure_fresh()
+            book = self._all if item is None else self._books.get(ITEM_IDS.get(item))
+            if book is None:
+                return [], None
+
+            page, last_key = [], None
+            now = time.time()
+            for key in book.keys(sort, min_unit, max_unit, after):
+                listing = self._listings[key[-1]]
+                if sort == "time" and not _in_range(listing, min_unit, max_unit):
+                    continue
+                if listing.is_expired(now):
+                    continue        # waiting for compaction to return it
+                if len(page) == limit:
+                    return page, encode_cursor(last_key)
+                page.append(listing.to_dict())
+                last_key = key
+            return page, None
+
+    def best_asks(self, item, depth=1):
+        """Cheapest `depth` listings of `item` by unit price."""
+        page, _ = self.query(item=item, sort="price", limit=depth)
+        return page
+
+
+def _in_range(listing, min_unit, max_unit):
+    price = listing.unit_price()
+    if min_unit is not None and price < min_unit:
+        return False
+    if max_unit is not None and price > max_unit:
+        return False
+    return True
+
+
+# ==========================================
+# COMPACTION
+# Moves expired listings out of /auction_house (items go back to the
+# seller) and old /trades into /auction_archive/<date>/, in multi-path
+# PATCHes of up to `batch` records. Listing and trade keys are push IDs, so
+# only the oldest key range ever needs scanning.
+# ==========================================
+
+class AuctionCompactor:
+    def __init__(self, storage, default_ttl, min_ttl, grace=300.0, trade_retention=30 * 86400,
+                 excluded=(), batch=500, archive="auction_archive"):
+        self.storage = storage
+        self.default_ttl = default_ttl        # for listings without `expires`
+        self.min_ttl = min_ttl                # shortest TTL any listing gets; bounds the scan
+        self.grace = grace                    # never touch a listing a purchase might still be claiming
+        self.trade_retention = trade_retention
+        self.excluded = set(excluded)         # sellers nothing is returned to (bots)
+        self.batch = batch
+        self.archive = archive
+
+    def _scan(self, collection, end_at):
+        """(key, value) pairs of `collection` with keys below `end_at`, oldest first."""
+        start_at = None
+        while True:
+            page = self.storage.query(collection, start_at=start_at, limit=self.batch)
+            for key, value in page:
+                if key == start_at:
+                    continue
+                if key >= end_at:
+                    return
+                yield key, value
+            if len(page) < self.batch:
+                return
+            start_at = page[-1][0]
+
+    def _flush(self, updates):
+        if updates:
+            self.storage.patch("", updates)
+
+    def expire_listings(self, now=None):
+        """Archive listings expired for longer than `grace`. Returns {listing id: listing}."""
+        now = time.time() if now is None else now
+        cutoff = now - self.grace
+        updates, expired = {}, {}
+        for listing_id, listing in self._scan("auction_house", push_id_at(cutoff - self.min_ttl)):
+            if not listing:
+                continue
+            expires = listing_expires(listing, self.default_ttl)
+            if expires > cutoff:
+                continue
+            day = datetime.datetime.fromtimestamp(expires, datetime.timezone.utc).strftime("%Y-%m-%d")
+            updates[f"auction_house/{listing_id}"] = None
+            updates[f"{self.archive}/{day}/expired/{listing_id}"] = listing
+            seller = listing.get('seller')
+            if seller and seller not in self.excluded:
+                path = f"users/{seller}/data/inventory/{listing['item']}"
+                # Several expired listings of one item and seller share a path in one PATCH
+                pending = updates.get(path)
+                qty = listing.get('qty', 1) + (pending[".sv"]["increment"] if pending else 0)
+                updates[path] = increment(qty)
+            expired[listing_id] = listing
+            if len(updates) >= self.batch:
+                self._flush(updates)
+                updates = {}
+        self._flush(updates)
+        return expired
+
+    def archive_trades(self, now=None):
+        """Move trades older than the retention period. Returns how many moved."""
+        now = time.time() if now is None else now
+        updates, moved = {}, 0
+        for key, trade in self._scan("trades", push_id_at(now - self.trade_retention)):
+            if not trade:
+                continue
+            day = datetime.datetime.fromtimestamp(trade.get('time', 0), datetime.timezone.utc).strftime("%Y-%m-%d")
+            updates[f"trades/{key}"] = None
+            updates[f"{self.archive}/{day}/sold/{key}"] = trade
+            moved += 1
+            if len(updates) >= self.batch:
+                self._flush(updates)
+                updates = {}
+        self._flush(updates)
+        return moved
+
+    def run(self, now=None):
+        return {"expired": self.expire_listings(now), "archived_trades": self.archive_trades(now)}
@@ -0,0 +1,350 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+
+from storage import StorageBackend, call_origin, endpoint_label
+
+# ==========================================
+# METRICS
+# Minimal Prometheus-style registry (counters, gauges, histograms) rendered
+# in the text exposition format at /metrics. Values are per process: with
+# several gunicorn workers each scrape sees the worker that answered, so
+# every series carries a `worker` label.
+# ==========================================
+
+WORKER = str(os.getpid())
+
+# Seconds; covers in-process hits up to slow upstream round trips
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [("worker", WORKER)] + list(zip(names, values)) + list(extra)
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}")
+        return tuple(str(v) for v in labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Set directly, or computed at scrape time from `set_function`."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._function = None
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception as e:
+                print(f"Gauge {self.name} error: {e}")
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _render_series(self, key, series):
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', le)])} {cumulative}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Histogram(
+    "bonecraft_http_request_seconds", "Time to produce a response, by route and status.",
+    ("method", "route", "status"),
+))
+UPSTREAM_CALLS = REGISTRY.register(Histogram(
+    "bonecraft_upstream_call_seconds", "Storage backend calls, by operation and path.",
+    ("operation", "path"),
+))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "bonecraft_upstream_errors_total", "Storage backend calls that raised.", ("operation", "path"),
+))
+UPSTREAM_BY_ORIGIN = REGISTRY.register(Counter(
+    "bonecraft_upstream_calls_by_origin_total", "Storage backend calls, by the route (or background task) making them.",
+    ("origin",),
+))
+ECONOMY_TICKS = REGISTRY.register(Counter(
+    "bonecraft_economy_ticks_total", "Bot economy ticks run in this worker.", ("outcome",),
+))
+LISTINGS_CREATED = REGISTRY.register(Counter(
+    "bonecraft_listings_created_total", "Auction house listings created.", ("source",),
+))
+PURCHASES = REGISTRY.register(Counter(
+    "bonecraft_purchases_total", "Purchase attempts, by outcome.", ("buyer", "outcome"),
+))
+LISTINGS_EXPIRED = REGISTRY.register(Counter(
+    "bonecraft_listings_expired_total", "Expired listings archived by compaction.",
+))
+TRADES_ARCHIVED = REGISTRY.register(Counter(
+    "bonecraft_trades_archived_total", "Trades moved out of /trades by compaction.",
+))
+ERRORS = REGISTRY.register(Counter(
+    "bonecraft_errors_total", "Errors caught and logged, by component.", ("component",),
+))
+MARKET_LISTINGS = REGISTRY.register(Gauge(
+    "bonecraft_market_listings", "Open listings in this worker's market cache.",
+))
+CACHED_PLAYERS = REGISTRY.register(Gauge(
+    "bonecraft_cached_players", "Players held in this worker's state cache.",
+))
+UNSETTLED_SALES = REGISTRY.register(Gauge(
+    "bonecraft_unsettled_sales", "Sales whose settle update is queued for retry in this worker.",
+))
+EVENT_STREAMS = REGISTRY.register(Gauge(
+    "bonecraft_event_streams", "Open server-sent event streams in this worker.",
+))
+EVENT_STREAMS_REJECTED = REGISTRY.register(Counter(
+    "bonecraft_event_streams_rejected_total", "Event streams refused because the worker was at EVENTS_MAX_STREAMS.",
+))
+
+
+def render():
+    return REGISTRY.render()
+
+
+# ==========================================
+# INSTRUMENTED STORAGE
+# Wraps any StorageBackend and times every call, labeled by operation
+# (storage method) and path pattern ("/users/*/data/gil").
+# ==========================================
+
+class InstrumentedBackend(StorageBackend):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _timed(self, operation, path, *args):
+        path_label = endpoint_label("", path).strip()
+        UPSTREAM_BY_ORIGIN.inc(call_origin())
+        start = time.perf_counter()
+        try:
+            return getattr(self.backend, operation)(path, *args)
+        except Exception:
+            UPSTREAM_ERRORS.inc(operation, path_label)
+            raise
+        finally:
+            UPSTREAM_CALLS.observe(time.perf_counter() - start, operation, path_label)
+
+    def get(self, path):
+        return self._timed("get", path)
+
+    def put(self, path, value):
+        return self._timed("put", path, value)
+
+    def patch(self, path, fields):
+        return self._timed("patch", path, fields)
+
+    def post(self, path, value):
+        return self._timed("post", path, value)
+
+    def delete(self, path):
+        return self._timed("delete", path)
+
+    def get_with_etag(self, path):
+        return self._timed("get_with_etag", path)
+
+    def put_if_match(self, path, value, etag):
+        return self._timed("put_if_match", path, value, etag)
+
+    def transaction(self, path, update, max_attempts=25, current=None):
+        return self._timed("transaction", path, update, max_attempts, current)
+
+    def gather(self, *calls):
+        # Calls overlap, so each is charged the whole batch's time (an upper bound)
+        origin = call_origin()
+        labels = [(name, endpoint_label("", args[0]).strip()) for name, *args in calls]
+        UPSTREAM_BY_ORIGIN.inc(origin, amount=len(calls))
+        start = time.perf_counter()
+        try:
+            return self.backend.gather(*calls)
+        except Exception:
+            for operation, path_label in labels:
+                UPSTREAM_ERRORS.inc(operation, path_label)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            for operation, path_label in labels:
+                UPSTREAM_CALLS.observe(elapsed, operation, path_label)
+
+    def query(self, path, start_at=None, limit=None):
+        return self._timed("query", path, start_at, limit)
+
+    def changes_since(self, collection, seq):
+        return self._timed("changes_since", collection, seq)
+
+    def __getattr__(self, name):
+        # Backend specific extras pass straight through
+        return getattr(self.backend, name)
+
+
+# ==========================================
+# SAMPLED PROFILING
+# A random fraction of requests runs under cProfile; those slower than the
+# threshold get their top functions printed and the stats saved to disk.
+# One profile at a time per process (cProfile can't nest across threads).
+# ==========================================
+
+class SlowRequestProfiler:
+    def __init__(self, sample_rate=0.0, slow_seconds=1.0, out_dir=None, top=25):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.out_dir = out_dir
+        self.top = top
+        self._busy = threading.Lock()
+        self._rng_lock = threading.Lock()
+        self._state = threading.local()
+        self._rng = random.Random()
+
+    def start(self):
+        if self.sample_rate <= 0:
+            return
+        with self._rng_lock:
+            if self._rng.random() >= self.sample_rate:
+                return
+        if not self._busy.acquire(blocking=False):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (debugger, coverage) owns the hook
+            self._busy.release()
+            return
+        self._state.profile = profile
+        self._state.start = time.perf_counter()
+
+    def finish(self, label):
+        profile = getattr(self._state, "profile", None)
+        if profile is None:
+            return
+        self._state.profile = None
+        try:
+            profile.disable()
+            elapsed = time.perf_counter() - self._state.start
+            if elapsed >= self.slow_seconds:
+                self._report(profile, label, elapsed)
+        finally:
+            self._busy.release()
+
+    def _report(self, profile, label, elapsed):
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(self.top)
+        print(f"--- Slow request {label} took {elapsed * 1000:.0f}ms ---\n{out.getvalue()}")
+        if self.out_dir:
+            os.makedirs(self.out_dir, exist_ok=True)
+            safe = "".join(c if c.isalnum() else "_" for c in label).strip("_")
+            profile.dump_stats(os.path.join(self.out_dir, f"{safe}-{int(time.time() * 1000)}.prof"))
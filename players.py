@@ -0,0 +1,368 @@
+import array
+import collections.abc
+import contextlib
+import threading
+import time
+
+import metrics
+from gamedata import ITEM_IDS, ITEM_NAMES, item_id
+from storage import increment
+
+# ==========================================
+# PLAYER STATE
+# Player records its mutations as deltas; PlayerStateCache keeps players
+# in memory and writes those deltas behind, coalescing many requests into
+# one PATCH of server-side increments (safe alongside other writers).
+# ==========================================
+
+
+class Inventory(collections.abc.MutableMapping):
+    """Item name -> count, stored as an array of counts indexed by interned item
+    id (gamedata.item_id). A count of 0 means the item isn't there; counts never
+    go below that."""
+
+    __slots__ = ("_counts",)
+
+    def __init__(self, items=None):
+        self._counts = array.array("i")
+        for name, qty in (items or {}).items():
+            if qty > 0:
+                self[name] = qty
+
+    def __getitem__(self, name):
+        i = ITEM_IDS.get(name)
+        if i is None or i >= len(self._counts) or not self._counts[i]:
+            raise KeyError(name)
+        return self._counts[i]
+
+    def __setitem__(self, name, qty):
+        i = item_id(name)
+        if i >= len(self._counts):
+            self._counts.extend([0] * (i + 1 - len(self._counts)))
+        self._counts[i] = max(qty, 0)
+
+    def __delitem__(self, name):
+        self[name]          # KeyError if absent
+        self._counts[ITEM_IDS[name]] = 0
+
+    def __iter__(self):
+        return (ITEM_NAMES[i] for i, qty in enumerate(self._counts) if qty)
+
+    def __len__(self):
+        return sum(1 for qty in self._counts if qty)
+
+    def to_dict(self):
+        return {ITEM_NAMES[i]: qty for i, qty in enumerate(self._counts) if qty}
+
+    def __repr__(self):
+        return f"Inventory({self.to_dict()!r})"
+
+
+class Player:
+    __slots__ = ("name", "_gil", "inventory", "_total_synths", "mutations",
+                 "_gil_delta", "_synths_delta", "_item_deltas", "_leaderboard_gil")
+
+    def __init__(self, name, data):
+        self.name = name
+        self._gil = data.get("gil", 5000)
+        self.inventory = Inventory(data.get("inventory"))
+        self._total_synths = data.get("total_synths", 0)
+        self.mutations = 0
+        self._reset_changes()
+
+    def _reset_changes(self):
+        self._gil_delta = 0
+        self._synths_delta = 0
+        self._item_deltas = {}
+        self._leaderboard_gil = 0   # mirrored gil changes the leaderboard hasn't seen yet
+
+    @property
+    def gil(self):
+        return self._gil
+
+    @gil.setter
+    def gil(self, value):
+        self.mutations += 1
+        self._gil_delta += value - self._gil
+        self._gil = value
+
+    @property
+    def total_synths(self):
+        return self._total_synths
+
+    @total_synths.setter
+    def total_synths(self, value):
+        self.mutations += 1
+        self._synths_delta += value - self._total_synths
+        self._total_synths = value
+
+    def to_dict(self):
+        return {
+            "gil": self.gil,
+            "inventory": self.inventory.to_dict(),
+            "total_synths": self.total_synths
+        }
+
+    def add_item(self, item_name, qty=1):
+        self.mutations += 1
+        self.inventory[item_name] = self.inventory.get(item_name, 0) + qty
+        self._item_deltas[item_name] = self._item_deltas.get(item_name, 0) + qty
+
+    def remove_item(self, item_name, qty=1):
+        if self.inventory.get(item_name, 0) >= qty:
+            self.mutations += 1
+            left = self.inventory[item_name] - qty
+            if left > 0:
+                self.inventory[item_name] = left
+            else:
+                del self.inventory[item_name]
+            self._item_deltas[item_name] = self._item_deltas.get(item_name, 0) - qty
+            return True
+        return False
+
+    def mirror_gil(self, delta, leaderboard=False):
+        """Reflect a gil change that was already written to storage (not flushed again).
+        With `leaderboard`, the next flush still sends it to the leaderboard."""
+        self._gil += delta
+        if leaderboard:
+            self.mutations += 1
+            self._leaderboard_gil += delta
+
+    def mirror_item(self, item_name, delta):
+        """Reflect an inventory change that was already written to storage (not flushed again)."""
+        qty = self.inventory.get(item_name, 0) + delta
+        if qty > 0:
+            self.inventory[item_name] = qty
+        else:
+            self.inventory.pop(item_name, None)
+
+    def pending_gil(self):
+        """Gil spent or earned in memory but not flushed yet."""
+        return self._gil_delta
+
+    def pending_synths(self):
+        return self._synths_delta
+
+    def pending_leaderboard_gil(self):
+        """Gil change the leaderboard is still missing: unflushed plus mirrored spends."""
+        return self._gil_delta + self._leaderboard_gil
+
+    def pending_item(self, item_name):
+        """Units of an item gained (or used up) in memory but not flushed yet."""
+        return self._item_deltas.get(item_name, 0)
+
+    # --- Change tracking ---
+
+    def has_changes(self):
+        return bool(self._gil_delta or self._synths_delta or self._leaderboard_gil or any(self._item_deltas.values()))
+
+    def pending_fields(self):
+        """Unflushed changes as a PATCH body for /users/<name>/data."""
+        fields = {}
+        if self._gil_delta:
+            fields["gil"] = increment(self._gil_delta)
+        if self._synths_delta:
+            fields["total_synths"] = increment(self._synths_delta)
+        for item_name, delta in self._item_deltas.items():
+            if delta:
+                fields[f"inventory/{item_name}"] = increment(delta)
+        return fields
+
+    def mark_flushed(self):
+        self._reset_changes()
+
+    def rebase(self, data):
+        """Adopt fresh server state, replaying any changes not flushed yet on top."""
+        self._gil = data.get("gil", 0) + self._gil_delta
+        self._total_synths = data.get("total_synths", 0) + self._synths_delta
+        inventory = dict(data.get("inventory") or {})
+        for item_name, delta in self._item_deltas.items():
+            inventory[item_name] = inventory.get(item_name, 0) + delta
+        self.inventory = Inventory(inventory)
+
+
+class _Entry:
+    __slots__ = ("player", "lock", "dirty_since", "credits", "loaded_at", "used_at")
+
+    def __init__(self, player):
+        self.player = player
+        self.lock = threading.RLock()
+        self.dirty_since = None
+        self.credits = 0            # gil other paths already wrote to storage, mirrored at next checkout
+        self.loaded_at = time.monotonic()
+        self.used_at = self.loaded_at
+
+
+class PlayerStateCache:
+    """`load(name)` returns the stored data dict (or None); `flush(name, player)`
+    writes the player's pending changes (Player.pending_fields()). Nothing is
+    read back: a player is reloaded once it has been clean for `clean_ttl`.
+
+    A clean entry is trusted for `clean_ttl` without asking storage, so other
+    workers' changes show up late. Anything that spends must therefore check
+    storage itself with a conditional write, counting the player's unflushed
+    changes (pending_gil / pending_item), as purchases and listings do."""
+
+    def __init__(self, load, flush, max_dirty_age=5.0, clean_ttl=30.0):
+        self._load = load
+        self._flush = flush
+        self.max_dirty_age = max_dirty_age
+        self.clean_ttl = clean_ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stopped = threading.Event()
+
+    def _entry(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is not None:
+            return entry
+
+        data = self._load(username)
+        if not data:
+            return None
+        with self._lock:
+            # Another thread may have loaded it meanwhile; keep the first
+            return self._entries.setdefault(username, _Entry(Player(username, data)))
+
+    def _is_current(self, username, entry):
+        with self._lock:
+            return self._entries.get(username) is entry
+
+    @contextlib.contextmanager
+    def checkout(self, username, on_missing=None):
+        """Exclusive access to a player for one request. Yields None if the player
+        can't be loaded; `on_missing` is called when storage has no such player."""
+        while True:
+            try:
+                entry = self._entry(username) if username else None
+            except Exception as e:
+                print(f"Player load failed for {username}: {e}")
+                metrics.ERRORS.inc("player_load")
+                yield None
+                return
+            if entry is None:
+                if username and on_missing is not None:
+                    on_missing()
+                yield None
+                return
+            with entry.lock:
+                if not self._is_current(username, entry):
+                    continue        # evicted while we waited for the lock
+                now = time.monotonic()
+                if entry.dirty_since is None and now - entry.loaded_at > self.clean_ttl:
+                    # Clean but old: other workers may have written since
+                    credits = self._queued_credits(entry)
+                    data = self._load(username)
+                    if data:
+                        entry.player.rebase(data)
+                        self._drop_credits(entry, credits)
+                    entry.loaded_at = now
+                self._apply_credits(entry)
+                entry.used_at = now
+                mutations = entry.player.mutations
+                try:
+                    yield entry.player
+                finally:
+                    if entry.player.mutations != mutations and entry.dirty_since is None:
+                        entry.dirty_since = time.monotonic()
+                return
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+    def credit(self, username, gil):
+        """Mirror gil another path already wrote to storage into a cached player.
+
+        Only queued here: the caller usually holds another player's entry lock,
+        and two buyers crediting each other must not wait on each other."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                entry.credits += gil
+
+    # --- Queued credits (caller holds the entry lock) ---
+
+    def _queued_credits(self, entry):
+        with self._lock:
+            return entry.credits
+
+    def _drop_credits(self, entry, gil):
+        """Forget credits already contained in freshly loaded data."""
+        with self._lock:
+            entry.credits -= gil
+
+    def _apply_credits(self, entry):
+        with self._lock:
+            gil, entry.credits = entry.credits, 0
+        if gil:
+            entry.player.mirror_gil(gil)
+
+    def flush(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is None:
+            return True
+        with entry.lock:
+            if not entry.player.has_changes():
+                entry.dirty_since = None
+                return True
+            try:
+                self._flush(username, entry.player)
+            except Exception as e:
+                print(f"Player flush failed for {username}: {e}")
+                metrics.ERRORS.inc("player_flush")
+                return False
+            entry.player.mark_flushed()
+            entry.dirty_since = None
+            return True
+
+    def flush_due(self):
+        """Flush players dirty for longer than max_dirty_age, drop idle clean ones."""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._entries.items())
+        for username, entry in entries:
+            if entry.dirty_since is not None and now - entry.dirty_since >= self.max_dirty_age:
+                self.flush(username)
+            elif entry.dirty_since is None and now - entry.used_at > self.clean_ttl:
+                if entry.lock.acquire(blocking=False):
+                    try:
+                        if entry.dirty_since is None:
+                            with self._lock:
+                                self._entries.pop(username, None)
+                    finally:
+                        entry.lock.release()
+
+    def flush_all(self):
+        with self._lock:
+            usernames = list(self._entries)
+        return all([self.flush(username) for username in usernames])
+
+    def evict(self, username):
+        """Flush and forget a player (logout)."""
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is None:
+            return True
+        with entry.lock:
+            ok = self.flush(username)
+            if ok:
+                with self._lock:
+                    self._entries.pop(username, None)
+            return ok
+
+    def run_flusher(self):
+        """Background loop; bounds how long a mutation can stay only in memory."""
+        interval = max(self.max_dirty_age / 2, 0.05)
+        while not self._stopped.wait(interval):
+            try:
+                self.flush_due()
+            except Exception as e:
+                print(f"Player flusher error: {e}")
+                metrics.ERRORS.inc("player_flusher")
+
+    def stop(self):
+        self._stopped.set()
+        self.flush_all()
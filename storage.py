@@ -0,0 +1,632 @@
+import hashlib
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ==========================================
+# STORAGE BACKENDS
+# Both backends expose the same Firebase-shaped JSON tree: slash separated
+# paths ("users/bob/data"), null for missing nodes, no empty objects.
+# ==========================================
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+_push_lock = threading.Lock()
+_last_push_time = 0
+_last_rand_chars = [0] * 12
+
+
+def generate_push_id():
+    """Chronologically sortable 20 char key, same scheme as Firebase push IDs."""
+    global _last_push_time
+    with _push_lock:
+        now = int(time.time() * 1000)
+        duplicate_time = now == _last_push_time
+        _last_push_time = now
+
+        time_chars = []
+        for _ in range(8):
+            time_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        push_id = "".join(reversed(time_chars))
+
+        if not duplicate_time:
+            for i in range(12):
+                _last_rand_chars[i] = random.randint(0, 63)
+        else:
+            # Same millisecond: increment the random part so keys stay ordered
+            i = 11
+            while i >= 0 and _last_rand_chars[i] == 63:
+                _last_rand_chars[i] = 0
+                i -= 1
+            _last_rand_chars[i] += 1
+
+        return push_id + "".join(PUSH_CHARS[c] for c in _last_rand_chars)
+
+
+def push_id_at(timestamp):
+    """Smallest push ID that could be generated at `timestamp` (unix seconds), for key range queries."""
+    now = int(timestamp * 1000)
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(PUSH_CHARS[now % 64])
+        now //= 64
+    return "".join(reversed(time_chars)) + PUSH_CHARS[0] * 12
+
+
+def increment(delta):
+    """Firebase server value: add `delta` to the number stored at the write path."""
+    return {".sv": {"increment": delta}}
+
+
+def _is_increment(value):
+    return isinstance(value, dict) and isinstance(value.get(".sv"), dict) and "increment" in value[".sv"]
+
+
+class TransactionAborted(Exception):
+    """Raised by a transaction update function to give up without writing."""
+
+
+class TransactionConflict(Exception):
+    """A transaction kept losing compare-and-set races."""
+
+
+def split_path(path):
+    return [p for p in path.strip("/").split("/") if p]
+
+
+class StorageBackend:
+    """Interface used by CloudAuthServer. Paths never carry the .json suffix."""
+
+    def get(self, path):
+        raise NotImplementedError
+
+    def put(self, path, value):
+        raise NotImplementedError
+
+    def patch(self, path, fields):
+        """Update several children of `path`; keys may be multi-segment paths."""
+        raise NotImplementedError
+
+    def post(self, path, value):
+        """Append `value` under a new push ID and return the key."""
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def query(self, path, start_at=None, limit=None):
+        """Children of `path` ordered by key, from `start_at` (inclusive), at most `limit`.
+        Returns a list of (key, value)."""
+        children = self.get(path) or {}
+        keys = sorted(k for k in children if start_at is None or k >= start_at)
+        if limit is not None:
+            keys = keys[:limit]
+        return [(k, children[k]) for k in keys]
+
+    def changes_since(self, collection, seq):
+        """(latest_seq, changed child keys) from a change log, or keys=None when the
+        caller must reload (no log, `seq` is None or has been trimmed away)."""
+        return None, None
+
+    def get_with_etag(self, path):
+        """(value, etag) for a later put_if_match."""
+        raise NotImplementedError
+
+    def put_if_match(self, path, value, etag):
+        """Write only if the node still has `etag`. Returns (ok, current value, current etag)."""
+        raise NotImplementedError
+
+    def gather(self, *calls):
+        """Run independent calls, each a tuple (method name, *args), and return their
+        results in order. Backends that can overlap network round trips do; the
+        default runs them one after another. The first exception is raised."""
+        return [getattr(self, name)(*args) for name, *args in calls]
+
+    def transaction(self, path, update, max_attempts=25, current=None):
+        """Optimistic read-modify-write of one node, retried on conflict.
+
+        `update(current)` returns the new value (None deletes) or raises
+        TransactionAborted. Returns the value that was committed. `current` is
+        a (value, etag) the caller already read, e.g. as part of a gather().
+        """
+        value, etag = current if current is not None else self.get_with_etag(path)
+        for attempt in range(max_attempts):
+            new_value = update(value)
+            ok, value, etag = self.put_if_match(path, new_value, etag)
+            if ok:
+                return new_value
+            time.sleep(random.uniform(0, 0.002 * (attempt + 1)))
+        raise TransactionConflict(path)
+
+
+# ==========================================
+# FIREBASE REALTIME DATABASE (REST)
+# ==========================================
+
+def endpoint_label(method, path):
+    """Collapse user names and listing IDs so counters group by endpoint."""
+    parts = split_path(path)
+    if len(parts) >= 2:
+        parts[1] = "*"
+    return f"{method} /{'/'.join(parts)}"
+
+
+_call_origin = threading.local()
+
+
+def set_call_origin(origin):
+    """Attribute upstream calls made by this thread to `origin` (e.g. the Flask route); None resets."""
+    _call_origin.value = origin
+
+
+def call_origin():
+    return getattr(_call_origin, "value", None) or "background"
+
+
+class FirebaseBackend(StorageBackend):
+    def __init__(self, base_url, pool_size=10, timeout=5.0, read_retries=2, retry_backoff=0.2):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        # One keep-alive session per process: connections (and TLS sessions) are reused.
+        # Only GET is retried; writes are not idempotent (POST) or are left to the caller.
+        retry = Retry(
+            total=read_retries,
+            connect=read_retries,
+            read=read_retries,
+            status=read_retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._gather_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="firebase")
+
+    def _url(self, path):
+        return f"{self.base_url}/{path.strip('/')}.json"
+
+    def _request(self, method, path, allow_status=(), **kwargs):
+        resp = self.session.request(method, self._url(path), timeout=self.timeout, **kwargs)
+        if resp.status_code not in allow_status:
+            resp.raise_for_status()
+        return resp
+
+    def get(self, path):
+        return self._request("GET", path).json()
+
+    def query(self, path, start_at=None, limit=None):
+        # Firebase filters server side but returns an unordered object
+        params = {"orderBy": '"$key"'}
+        if start_at is not None:
+            params["startAt"] = json.dumps(start_at)
+        if limit is not None:
+            params["limitToFirst"] = limit
+        children = self._request("GET", path, params=params).json() or {}
+        return sorted(children.items())
+
+    def put(self, path, value):
+        self._request("PUT", path, json=value)
+
+    def patch(self, path, fields):
+        self._request("PATCH", path, json=fields)
+
+    def post(self, path, value):
+        return self._request("POST", path, json=value).json().get('name')
+
+    def delete(self, path):
+        self._request("DELETE", path)
+
+    def get_with_etag(self, path):
+        resp = self._request("GET", path, headers={"X-Firebase-ETag": "true"})
+        return resp.json(), resp.headers.get("ETag")
+
+    def put_if_match(self, path, value, etag):
+        # A mismatch answers 412 with the current value and its ETag
+        resp = self._request(
+            "PUT", path, json=value, allow_status=(412,),
+            headers={"if-match": etag, "X-Firebase-ETag": "true"},
+        )
+        if resp.status_code == 412:
+            return False, resp.json(), resp.headers.get("ETag")
+        return True, value, resp.headers.get("ETag")
+
+    def gather(self, *calls):
+        if len(calls) < 2:
+            return super().gather(*calls)
+        origin = call_origin()
+
+        def run(call):
+            set_call_origin(origin)
+            try:
+                return getattr(self, call[0])(*call[1:])
+            finally:
+                set_call_origin(None)
+
+        return list(self._gather_pool.map(run, calls))
+
+
+# ==========================================
+# EMBEDDED LOCAL ENGINE (SQLite)
+# Each child of a top-level collection ("users/bob", "auction_house/-Nx..")
+# is stored as one JSON document, deeper paths are resolved inside it.
+# ==========================================
+
+def _prune(value):
+    """Drop nulls and empty objects the way Firebase does on write."""
+    if isinstance(value, dict):
+        pruned = {}
+        for k, v in value.items():
+            v = _prune(v)
+            if v is not None:
+                pruned[str(k)] = v
+        return pruned or None
+    return value
+
+
+def compute_etag(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def _dig(node, parts):
+    for part in parts:
+        if not isinstance(node, dict):
+            return None
+        node = node.get(part)
+    return node
+
+
+def _assign(node, parts, value):
+    """Return a copy of `node` with `value` written at `parts`."""
+    if not parts:
+        if _is_increment(value):
+            base = node if isinstance(node, (int, float)) and not isinstance(node, bool) else 0
+            return base + value[".sv"]["increment"]
+        return _prune(value)
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _assign(node.get(parts[0]), parts[1:], value)
+    if child is None:
+        node.pop(parts[0], None)
+    else:
+        node[parts[0]] = child
+    return node or None
+
+
+class LocalBackend(StorageBackend):
+    CHANGE_LOG_RETAIN = 10000
+
+    def __init__(self, db_path=":memory:"):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        if db_path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " collection TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (collection, key))"
+        )
+        # Change log: one row per written document, key '*' for whole-collection writes
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " collection TEXT NOT NULL,"
+            " key TEXT NOT NULL)"
+        )
+        self._writes_since_trim = 0
+
+    # --- Low level document access (caller holds the lock) ---
+
+    def _load_doc(self, collection, key):
+        row = self._conn.execute(
+            "SELECT value FROM documents WHERE collection = ? AND key = ?", (collection, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _log_change(self, collection, key):
+        self._conn.execute("INSERT INTO changes (collection, key) VALUES (?, ?)", (collection, key))
+        self._writes_since_trim += 1
+        if self._writes_since_trim >= 1000:
+            self._writes_since_trim = 0
+            self._conn.execute(
+                "DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?",
+                (self.CHANGE_LOG_RETAIN,),
+            )
+
+    def _save_doc(self, collection, key, value):
+        self._log_change(collection, key)
+        if value is None:
+            self._conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND key = ?", (collection, key)
+            )
+        else:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (collection, key, value) VALUES (?, ?, ?)",
+                (collection, key, json.dumps(value, separators=(',', ':'))),
+            )
+
+    def _load_collection(self, collection):
+        rows = self._conn.execute(
+            "SELECT key, value FROM documents WHERE collection = ?", (collection,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows} or None
+
+    def _write(self, parts, value):
+        if not parts:
+            for (collection,) in self._conn.execute("SELECT DISTINCT collection FROM documents").fetchall():
+                self._log_change(collection, '*')
+            self._conn.execute("DELETE FROM documents")
+            for collection, children in (_prune(value) or {}).items():
+                self._write([collection], children)
+        elif len(parts) == 1:
+            self._log_change(parts[0], '*')
+            self._conn.execute("DELETE FROM documents WHERE collection = ?", (parts[0],))
+            children = _prune(value)
+            if isinstance(children, dict):
+                for key, child in children.items():
+                    self._save_doc(parts[0], key, child)
+        else:
+            collection, key = parts[0], parts[1]
+            doc = self._load_doc(collection, key)
+            self._save_doc(collection, key, _assign(doc, parts[2:], value))
+
+    def _transaction(self):
+        return _LocalTransaction(self)
+
+    # --- StorageBackend interface ---
+
+    def get(self, path):
+        parts = split_path(path)
+        with self._lock:
+            if not parts:
+                rows = self._conn.execute("SELECT DISTINCT collection FROM documents").fetchall()
+                return {c: self._load_collection(c) for (c,) in rows} or None
+            if len(parts) == 1:
+                return self._load_collection(parts[0])
+            return _dig(self._load_doc(parts[0], parts[1]), parts[2:])
+
+    def query(self, path, start_at=None, limit=None):
+        parts = split_path(path)
+        if len(parts) != 1:
+            return super().query(path, start_at, limit)
+        sql = "SELECT key, value FROM documents WHERE collection = ?"
+        args = [parts[0]]
+        if start_at is not None:
+            sql += " AND key >= ?"
+            args.append(start_at)
+        sql += " ORDER BY key"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def put(self, path, value):
+        with self._transaction():
+            self._write(split_path(path), value)
+
+    def patch(self, path, fields):
+        base = split_path(path)
+        with self._transaction():
+            for key, value in fields.items():
+                self._write(base + split_path(key), value)
+
+    def post(self, path, value):
+        key = generate_push_id()
+        self.put(f"{path.strip('/')}/{key}", value)
+        return key
+
+    def delete(self, path):
+        self.put(path, None)
+
+    def get_with_etag(self, path):
+        with self._lock:
+            value = self.get(path)
+            return value, compute_etag(value)
+
+    def put_if_match(self, path, value, etag):
+        with self._transaction():
+            current = self.get(path)
+            current_etag = compute_etag(current)
+            if current_etag != etag:
+                return False, current, current_etag
+            self._write(split_path(path), value)
+        stored = _prune(value)
+        return True, stored, compute_etag(stored)
+
+    def changes_since(self, collection, seq):
+        with self._lock:
+            latest, oldest = self._conn.execute("SELECT MAX(seq), MIN(seq) FROM changes").fetchone()
+            latest = latest or 0
+            if seq is None or (oldest is not None and seq < oldest - 1):
+                return latest, None
+            rows = self._conn.execute(
+                "SELECT DISTINCT key FROM changes WHERE collection = ? AND seq > ?", (collection, seq)
+            ).fetchall()
+            keys = {key for (key,) in rows}
+            if '*' in keys:
+                return latest, None
+            return latest, keys
+
+
+class _LocalTransaction:
+    """Serialises writers in this process (lock) and across processes (BEGIN IMMEDIATE)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        self.backend._lock.acquire()
+        self.backend._conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.backend._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.backend._lock.release()
+        return False
+
+
+# ==========================================
+# COLLECTION CACHE
+# In-process mirror of one top-level collection. Local writes are applied
+# by the owner; other writers are picked up from the backend change log
+# when it has one (local engine) or by a full reload after `ttl` seconds.
+# ==========================================
+
+class CollectionCache:
+    def __init__(self, storage, collection, ttl, on_event=None):
+        self.storage = storage
+        self.collection = collection
+        self.ttl = ttl
+        self.on_event = on_event
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._change_seq = None
+        self._primed = False
+        self._silent = False
+        self.version = 0            # bumped by subclasses on every change to the cached data
+
+    # Subclasses maintain their indexes in these (caller holds the lock)
+    def _clear(self):
+        raise NotImplementedError
+
+    def _insert(self, key, value):
+        raise NotImplementedError
+
+    def _discard(self, key):
+        raise NotImplementedError
+
+    def _keys(self):
+        raise NotImplementedError
+
+    def _matches(self, key, value):
+        """True if the cached entry for `key` already reflects `value`."""
+        raise NotImplementedError
+
+    def _emit(self, event_type, data):
+        if self.on_event is not None and not self._silent:
+            self.on_event(event_type, data)
+
+    def _reload(self):
+        seq, _ = self.storage.changes_since(self.collection, None)
+        children = self.storage.get(self.collection) or {}
+        if not self._primed:
+            # First load is a bulk fill, not a stream of changes
+            self._silent = True
+            try:
+                self._clear()
+                for key, value in children.items():
+                    self._insert(key, value)
+            finally:
+                self._silent = False
+            self._primed = True
+        else:
+            # Later reloads only touch what changed, so events stay deltas
+            for key in [k for k in self._keys() if k not in children]:
+                self._discard(key)
+            for key, value in children.items():
+                if not self._matches(key, value):
+                    self._insert(key, value)
+        self._loaded_at = time.monotonic()
+        self._change_seq = seq
+
+    def _apply_changes(self):
+        """Pull only changed children from the backend change log. False if unavailable."""
+        if self._change_seq is None:
+            return False
+        seq, keys = self.storage.changes_since(self.collection, self._change_seq)
+        if keys is None:
+            return False
+        for key in keys:
+            value = self.storage.get(f"{self.collection}/{key}")
+            if not value:
+                self._discard(key)
+            elif not self._matches(key, value):
+                self._insert(key, value)
+        self._change_seq = seq
+        self._loaded_at = time.monotonic()
+        return True
+
+    def _ensure_fresh(self):
+        if self._loaded_at is not None:
+            if self._apply_changes():
+                return
+            if time.monotonic() - self._loaded_at < self.ttl:
+                return
+        self._reload()
+
+    def refresh(self):
+        """Pick up other writers' changes now (used by the event watcher)."""
+        with self._lock:
+            self._ensure_fresh()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def data_version(self):
+        """Current `version` after picking up other writers' changes (for response caching)."""
+        with self._lock:
+            self._ensure_fresh()
+            return self.version
+
+
+# ==========================================
+# LEADER LEASE
+# A node {"holder": .., "expires": <unix seconds>} claimed and renewed with
+# conditional writes, so exactly one process (of any worker or host sharing
+# the backend) holds it at a time. A crashed holder is replaced after `ttl`.
+# ==========================================
+
+class LeaderLease:
+    def __init__(self, storage, path, ttl=15.0, holder=None):
+        self.storage = storage
+        self.path = path
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{os.urandom(2).hex()}"
+
+    def acquire(self):
+        """Claim or renew the lease. True while this process holds it."""
+        now = time.time()
+        current, etag = self.storage.get_with_etag(self.path)
+        if current and current.get("holder") != self.holder and current.get("expires", 0) > now:
+            return False
+        ok, _, _ = self.storage.put_if_match(self.path, {"holder": self.holder, "expires": now + self.ttl}, etag)
+        return ok
+
+    def release(self):
+        current, etag = self.storage.get_with_etag(self.path)
+        if current and current.get("holder") == self.holder:
+            self.storage.put_if_match(self.path, None, etag)
+
+    def current_holder(self):
+        current = self.storage.get(self.path)
+        if current and current.get("expires", 0) > time.time():
+            return current.get("holder")
+        return None
+
+
+def create_backend(kind, firebase_url=None, local_db_path=":memory:", **firebase_options):
+    if kind == "local":
+        return LocalBackend(local_db_path)
+    if kind == "firebase":
+        return FirebaseBackend(firebase_url, **firebase_options)
+    raise ValueError(f"Unknown storage backend: {kind}")
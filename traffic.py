@@ -0,0 +1,184 @@
+import collections
+import gzip
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+
+import metrics
+
+# ==========================================
+# TRAFFIC RECORDING
+# Opt-in log of API requests for benchmarks/replay.py. Every client session
+# and every bot agent gets a random id and a seed derived from it with a
+# server-side key (clients only ever see the id, so they can't predict their
+# rolls); call n of a session draws its randomness (synth rolls, bot actions)
+# from session_rng(seed, n), so a replay rolls what the recording rolled.
+# Numbering starts at a random offset each time a worker (re)sees a session.
+# One JSON object per line:
+#   {"k": "s", "s": session, "seed": seed, "t": ms}        session seen
+#   {"k": "r", "s", "n", "t", "m": method, "p": path with query, "r": route,
+#    "u": user logged in, "b": JSON body, "c": status, "ms": duration}
+#   {"k": "tick", "s", "n", "t", "ms"}                      bot agent tick
+# "t" is unix time in milliseconds. Calls that created listings also carry
+# "ids", the new listing ids in order, so a replay can map later purchases
+# onto the listings it created itself. Paths ending in .gz are gzipped.
+# ==========================================
+
+# Passwords never reach the log; replayed logins all use this one
+REPLAY_PASSWORD = "replay"
+
+# Long-lived streams and admin calls (which carry the admin token) aren't recorded
+NOT_RECORDED = ("/api/events", "/api/admin/")
+
+
+_call = threading.local()
+
+
+def session_rng(seed, n):
+    return random.Random(seed << 32 | n)
+
+
+def start_call():
+    """Collect the listing ids this thread creates until end_call()."""
+    _call.created = []
+
+
+def listing_created(listing_id):
+    created = getattr(_call, "created", None)
+    if created is not None:
+        created.append(listing_id)
+
+
+def end_call():
+    created = getattr(_call, "created", None)
+    _call.created = None
+    return created or []
+
+
+def is_recorded(path):
+    return path.startswith("/api/") and not path.startswith(NOT_RECORDED)
+
+
+def _open(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+def _scrub(body):
+    if isinstance(body, dict) and "password" in body:
+        return dict(body, password=REPLAY_PASSWORD)
+    return body
+
+
+class TrafficRecorder:
+    def __init__(self, path, key, flush_interval=2.0, batch_size=256, max_sessions=10000):
+        self.path = path.replace("{worker}", metrics.WORKER)     # one file per gunicorn worker
+        self.key = key.encode() if isinstance(key, str) else key    # shared by all workers
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._sessions = collections.OrderedDict()     # session id -> next call number, least recent first
+        self._buffer = []
+        self._stopped = threading.Event()
+
+    def new_session(self):
+        """A session id for a client or agent not seen before."""
+        return uuid.uuid4().hex[:16]
+
+    def seed(self, sid):
+        return int.from_bytes(hmac.new(self.key, sid.encode(), hashlib.sha256).digest()[:4], "big")
+
+    def begin(self, sid):
+        """Number the next call of a session. Returns (seed, n); the first call in this
+        worker logs the seed. Sessions idle the longest are forgotten beyond
+        `max_sessions` and start over at a fresh random offset, so rolls don't repeat."""
+        with self._lock:
+            n = self._sessions.pop(sid, None)
+            if n is None:
+                n = random.SystemRandom().getrandbits(31)
+                self._buffer.append({"k": "s", "s": sid, "seed": self.seed(sid), "t": _ms(time.time())})
+                if len(self._sessions) >= self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions[sid] = n + 1
+            return self.seed(sid), n
+
+    def request(self, sid, n, started, method, path, route, user, body, status, elapsed, created=()):
+        self._append(_with_ids({
+            "k": "r", "s": sid, "n": n, "t": _ms(started), "m": method, "p": path, "r": route,
+            "u": user, "b": _scrub(body), "c": status, "ms": round(elapsed * 1000, 2),
+        }, created))
+
+    def tick(self, sid, n, started, elapsed, created=()):
+        self._append(_with_ids({"k": "tick", "s": sid, "n": n, "t": _ms(started), "ms": round(elapsed * 1000, 2)}, created))
+
+    def _append(self, record):
+        with self._lock:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+            if not records:
+                return
+            try:
+                with _open(self.path, "at") as f:
+                    f.writelines(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+            except Exception as e:
+                print(f"Traffic log write error ({len(records)} records dropped): {e}")
+                metrics.ERRORS.inc("traffic")
+
+    def run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+
+class RecordedEngine:
+    """An economy.EconomyEngine whose ticks are logged as calls of one agent session."""
+
+    def __init__(self, engine, recorder):
+        self.engine = engine
+        self.recorder = recorder
+        self.sid = f"bot-{recorder.new_session()}"
+
+    def tick(self):
+        seed, n = self.recorder.begin(self.sid)
+        self.engine.rng = session_rng(seed, n)
+        started, start = time.time(), time.perf_counter()
+        start_call()
+        try:
+            self.engine.tick()
+        finally:
+            self.recorder.tick(self.sid, n, started, time.perf_counter() - start, end_call())
+
+
+def _ms(timestamp):
+    return int(timestamp * 1000)
+
+
+def _with_ids(record, created):
+    if created:
+        record["ids"] = list(created)
+    return record
+
+
+def read_log(paths):
+    """Records of one or more logs (say, one per worker) merged into time order."""
+    records = []
+    for path in paths:
+        with _open(path, "rt") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r["t"])
+    return records